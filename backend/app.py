@@ -3,39 +3,277 @@ from aiohttp import web
 import asyncio
 import json
 import os
-from datetime import datetime
+from datetime import datetime, timedelta
 from dotenv import load_dotenv
-import uuid
+import base64
+import itertools
 import logging
+import math
+import time
+from collections import OrderedDict
 import aiosqlite
-from hashlib import sha256
+from registry import ConnectionRegistry
+from ids import generate_id, generate_token
+from fanout import PROTOCOL_COMPACT, PROTOCOLS, OutboundConnection, SlowConsumerPolicy, fan_out
+from migrations import apply_migrations
+from storage import Storage, connection_pragmas
+from presence import PresenceTracker, TypingTracker
+from ratelimit import AdmissionControl, RateLimiter, parse_rule, parse_rules
+from respcache import ResponseCache
+from static import IMMUTABLE, REVALIDATE, StaticSite
+from receipts import ReceiptTracker
+from bus import create_bus
+from media import HASH_RE, MediaStore, UploadBusy, UploadConflict, UploadMismatch
+from passwords import PasswordHasher
+from cache import MessageCache
+from directory import UserDirectory
+from metrics import LoopLagProbe, registry as metrics_registry
+from archive import ArchiveIndex, ArchiveStore, Compactor
+from transfer import IMPORT_BATCH_SIZE, MAX_LINE_BYTES, encode_lines, import_messages, split_lines
 
 load_dotenv()
 
-logging.basicConfig(level=logging.INFO)
+logging.basicConfig(level=os.getenv('LOG_LEVEL', 'INFO').upper())
 logger = logging.getLogger(__name__)
 
 # === DATABASE CONFIG ===
 DB_PATH = os.getenv('DB_PATH', 'messenger.db')
 
-db = None
-user_sessions = {}
-active_connections = {}
+DB_READERS = int(os.getenv('DB_READERS', '4'))
+# FULL — fsync WAL на каждой фиксации: ответ писателя значит, что запись на диске.
+# NORMAL быстрее, но последние пакеты могут пропасть при отключении питания
+DB_SYNCHRONOUS = os.getenv('DB_SYNCHRONOUS', 'FULL')
+DB_CACHE_SIZE_MB = int(os.getenv('DB_CACHE_SIZE_MB', '64'))
+DB_MMAP_SIZE_MB = int(os.getenv('DB_MMAP_SIZE_MB', '256'))
 
-def generate_id():
-    return str(uuid.uuid4())
+# === SESSION CONFIG ===
+# Сессия истекает, если её сокет не подключался столько дней
+SESSION_TTL_DAYS = float(os.getenv('SESSION_TTL_DAYS', '30'))
+SESSION_SWEEP_SECONDS = float(os.getenv('SESSION_SWEEP_SECONDS', '3600'))
+# Код закрытия WebSocket для неизвестной или истёкшей сессии
+WS_SESSION_EXPIRED = 4001
 
-def hash_password(password):
-    """Хешировать пароль"""
-    return sha256(password.encode()).hexdigest()
+# === PASSWORD CONFIG ===
+# Стоимость scrypt: память = 128 * N * R байт на один расчёт
+PASSWORD_SCRYPT_N = int(os.getenv('PASSWORD_SCRYPT_N', str(2 ** 14)))
+PASSWORD_SCRYPT_R = int(os.getenv('PASSWORD_SCRYPT_R', '8'))
+PASSWORD_SCRYPT_P = int(os.getenv('PASSWORD_SCRYPT_P', '1'))
+PASSWORD_HASH_WORKERS = int(os.getenv('PASSWORD_HASH_WORKERS', '2'))
+
+# === WRITER CONFIG ===
+WRITER_MAX_BATCH = int(os.getenv('WRITER_MAX_BATCH', '256'))
+WRITER_BATCH_WINDOW_MS = float(os.getenv('WRITER_BATCH_WINDOW_MS', '2'))
+
+# === MEDIA CONFIG ===
+MEDIA_DIR = os.getenv('MEDIA_DIR', 'media')
+MAX_UPLOAD_SIZE = int(os.getenv('MAX_UPLOAD_SIZE', str(2 * 1024 ** 3)))
+UPLOAD_CHUNK_SIZE = int(os.getenv('UPLOAD_CHUNK_SIZE', str(4 * 1024 ** 2)))
+# Брошенная загрузка (строка uploads и .part) удаляется после UPLOAD_TTL_HOURS без новых кусков
+UPLOAD_TTL_HOURS = int(os.getenv('UPLOAD_TTL_HOURS', '24'))
+UPLOAD_SWEEP_SECONDS = int(os.getenv('UPLOAD_SWEEP_SECONDS', '3600'))
+
+# === STATIC CONFIG ===
+# Фронтенд отдаётся этим же приложением; сборка с хешами и сжатием — при старте
+SERVE_FRONTEND = os.getenv('SERVE_FRONTEND', '1') == '1'
+FRONTEND_DIR = os.getenv('FRONTEND_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'frontend'))
+STATIC_BUILD_DIR = os.getenv('STATIC_BUILD_DIR', 'static_build')
+
+# === EVENT BUS CONFIG ===
+# memory — один процесс; sqlite — несколько воркеров на одной машине
+EVENT_BUS = os.getenv('EVENT_BUS', 'memory')
+BUS_PATH = os.getenv('BUS_PATH', DB_PATH + '.bus')
+BUS_POLL_MS = float(os.getenv('BUS_POLL_MS', '20'))
+# Воркер без отметки дольше таймаута считается упавшим, его пользователи — offline
+BUS_HEARTBEAT_SECONDS = float(os.getenv('BUS_HEARTBEAT_SECONDS', '2'))
+BUS_WORKER_TIMEOUT_SECONDS = float(os.getenv('BUS_WORKER_TIMEOUT_SECONDS', '10'))
+
+# === WEBSOCKET CONFIG ===
+WS_SEND_QUEUE_SIZE = int(os.getenv('WS_SEND_QUEUE_SIZE', '256'))
+WS_EPHEMERAL_DROP_AT = int(os.getenv('WS_EPHEMERAL_DROP_AT', '64'))
+# Окно склейки событий для клиентов с подпротоколом messenger.v2*
+WS_BATCH_WINDOW_MS = float(os.getenv('WS_BATCH_WINDOW_MS', '10'))
+# permessage-deflate, если клиент его предлагает
+WS_COMPRESS = os.getenv('WS_COMPRESS', '1') == '1'
+# Сколько чатов держать в кеше участников для рассылки
+WS_MEMBERS_CACHE_CHATS = int(os.getenv('WS_MEMBERS_CACHE_CHATS', '10000'))
+
+# === RATE LIMIT CONFIG ===
+# Token bucket: "токенов в секунду:всплеск"; 0 — без ограничения
+RATE_LIMIT_ENABLED = os.getenv('RATE_LIMIT_ENABLED', '1') == '1'
+# REST — на пару (пользователь сессии из X-Session-Id или адрес клиента, маршрут);
+# у дорогих маршрутов свои правила
+RATE_LIMIT_REST = parse_rule(os.getenv('RATE_LIMIT_REST', '20:60'))
+RATE_LIMIT_ROUTES = parse_rules(os.getenv(
+    'RATE_LIMIT_ROUTES',
+    '/api/users/login=1:10,/api/users/register=0.2:5,/api/search=2:10,'
+    '/api/chats/{chat_id}/import=0.1:2,/media/{digest}=0,/assets/{name}=0,/metrics=0,/api/stats=0'
+))
+# Заголовок с адресом клиента от своего обратного прокси (X-Forwarded-For, X-Real-IP).
+# Пусто — адрес соединения; без прокси не задавать: заголовок подделает любой
+RATE_LIMIT_CLIENT_IP_HEADER = os.getenv('RATE_LIMIT_CLIENT_IP_HEADER', '')
+# Сколько сессий помнить для выбора ключа лимита
+RATE_LIMIT_SESSION_CACHE = int(os.getenv('RATE_LIMIT_SESSION_CACHE', '10000'))
+# WebSocket — на сессию: все кадры и отдельно send_message
+RATE_LIMIT_WS_FRAMES = parse_rule(os.getenv('RATE_LIMIT_WS_FRAMES', '20:60'))
+RATE_LIMIT_WS_MESSAGES = parse_rule(os.getenv('RATE_LIMIT_WS_MESSAGES', '5:20'))
+# После стольких отклонённых кадров подряд сокет закрывается
+WS_MAX_VIOLATIONS = int(os.getenv('WS_MAX_VIOLATIONS', '100'))
+# Лимиты одновременных сокетов на пользователя и на воркер; 0 — без ограничения
+WS_MAX_PER_USER = int(os.getenv('WS_MAX_PER_USER', '10'))
+WS_MAX_CONNECTIONS = int(os.getenv('WS_MAX_CONNECTIONS', '20000'))
+
+# === LOAD SHEDDING CONFIG ===
+# Выше этих порогов новая работа получает 503 с Retry-After; 0 — не проверять
+SHED_LOOP_LAG_MS = float(os.getenv('SHED_LOOP_LAG_MS', '500'))
+SHED_WRITE_QUEUE = int(os.getenv('SHED_WRITE_QUEUE', '5000'))
+SHED_RETRY_AFTER = int(os.getenv('SHED_RETRY_AFTER', '2'))
+# Наблюдаемость нужна именно под нагрузкой
+SHED_EXEMPT_ROUTES = {'/metrics', '/api/stats'}
+
+# === PRESENCE CONFIG ===
+PRESENCE_FLUSH_SECONDS = float(os.getenv('PRESENCE_FLUSH_SECONDS', '5'))
+TYPING_THROTTLE_SECONDS = float(os.getenv('TYPING_THROTTLE_SECONDS', '2'))
+TYPING_TTL_SECONDS = float(os.getenv('TYPING_TTL_SECONDS', '6'))
+
+# === RECEIPTS CONFIG ===
+# Отметки о прочтении пишутся в БД и рассылаются не чаще раза в интервал
+RECEIPT_FLUSH_MS = float(os.getenv('RECEIPT_FLUSH_MS', '1000'))
+
+# === HISTORY CONFIG ===
+HISTORY_PAGE_SIZE = int(os.getenv('HISTORY_PAGE_SIZE', '50'))
+HISTORY_MAX_PAGE_SIZE = int(os.getenv('HISTORY_MAX_PAGE_SIZE', '200'))
+PREVIEW_LENGTH = 200
+
+# === USERS CONFIG ===
+USERS_PAGE_SIZE = int(os.getenv('USERS_PAGE_SIZE', '50'))
+USERS_MAX_PAGE_SIZE = int(os.getenv('USERS_MAX_PAGE_SIZE', '200'))
+AUTOCOMPLETE_LIMIT = int(os.getenv('AUTOCOMPLETE_LIMIT', '10'))
+AUTOCOMPLETE_MAX_LIMIT = int(os.getenv('AUTOCOMPLETE_MAX_LIMIT', '50'))
+
+# === MESSAGE CACHE CONFIG ===
+# Хвост истории в памяти: сообщений на чат и общий бюджет
+MESSAGE_CACHE_PER_CHAT = int(os.getenv('MESSAGE_CACHE_PER_CHAT', '100'))
+MESSAGE_CACHE_MB = int(os.getenv('MESSAGE_CACHE_MB', '32'))
+
+# === RESPONSE CACHE CONFIG ===
+# Готовые JSON списка чатов и пользователей; ETag для условных GET
+RESPONSE_CACHE_MB = int(os.getenv('RESPONSE_CACHE_MB', '16'))
+
+# === SYNC CONFIG ===
+# Если клиент отстал сильнее, ему дешевле перезагрузить чат целиком
+SYNC_MAX_GAP = int(os.getenv('SYNC_MAX_GAP', '500'))
+
+# === EXPORT/IMPORT CONFIG ===
+EXPORT_PAGE_SIZE = int(os.getenv('EXPORT_PAGE_SIZE', '1000'))
+IMPORT_BATCH = int(os.getenv('IMPORT_BATCH', str(IMPORT_BATCH_SIZE)))
+IMPORT_MAX_LINE_BYTES = int(os.getenv('IMPORT_MAX_LINE_BYTES', str(MAX_LINE_BYTES)))
+
+# === ARCHIVE CONFIG ===
+# Сообщения старше ARCHIVE_AFTER_DAYS переезжают из SQLite в сегменты; 0 — не архивировать
+ARCHIVE_DIR = os.getenv('ARCHIVE_DIR', 'archive')
+ARCHIVE_AFTER_DAYS = float(os.getenv('ARCHIVE_AFTER_DAYS', '90'))
+ARCHIVE_INTERVAL_SECONDS = float(os.getenv('ARCHIVE_INTERVAL_SECONDS', '3600'))
+ARCHIVE_MIN_MESSAGES = int(os.getenv('ARCHIVE_MIN_MESSAGES', '200'))
+ARCHIVE_SEGMENT_MESSAGES = int(os.getenv('ARCHIVE_SEGMENT_MESSAGES', '5000'))
+ARCHIVE_BLOCK_MESSAGES = int(os.getenv('ARCHIVE_BLOCK_MESSAGES', '64'))
+# Поисковый индекс архива — отдельный файл; при потере перестраивается из сегментов
+ARCHIVE_INDEX_PATH = os.getenv('ARCHIVE_INDEX_PATH', os.path.join(ARCHIVE_DIR, 'search.db'))
+
+# === METRICS CONFIG ===
+LOOP_LAG_INTERVAL_MS = float(os.getenv('LOOP_LAG_INTERVAL_MS', '250'))
+# В DEBUG пишется только каждое N-е отправленное сообщение
+MESSAGE_LOG_SAMPLE = int(os.getenv('MESSAGE_LOG_SAMPLE', '100'))
+
+# === SEARCH CONFIG ===
+SEARCH_PAGE_SIZE = int(os.getenv('SEARCH_PAGE_SIZE', '20'))
+SEARCH_MAX_PAGE_SIZE = int(os.getenv('SEARCH_MAX_PAGE_SIZE', '100'))
+# Ранжируются только самые свежие совпадения — стоимость запроса ограничена
+SEARCH_CANDIDATES = int(os.getenv('SEARCH_CANDIDATES', '2000'))
+
+storage = None
+bus = create_bus(EVENT_BUS, BUS_PATH, BUS_POLL_MS / 1000, BUS_HEARTBEAT_SECONDS, BUS_WORKER_TIMEOUT_SECONDS)
+media_store = MediaStore(MEDIA_DIR)
+static_site = StaticSite(FRONTEND_DIR, STATIC_BUILD_DIR)
+password_hasher = PasswordHasher(PASSWORD_SCRYPT_N, PASSWORD_SCRYPT_R, PASSWORD_SCRYPT_P, PASSWORD_HASH_WORKERS)
+registry = ConnectionRegistry(WS_MEMBERS_CACHE_CHATS)
+send_policy = SlowConsumerPolicy(WS_SEND_QUEUE_SIZE, WS_EPHEMERAL_DROP_AT)
+rate_limiter = RateLimiter()
+# session_id -> user_id для ключей лимита; LRU
+rate_limit_sessions = OrderedDict()
+presence = PresenceTracker(PRESENCE_FLUSH_SECONDS)
+typing_tracker = TypingTracker(TYPING_THROTTLE_SECONDS, TYPING_TTL_SECONDS)
+receipts = ReceiptTracker(RECEIPT_FLUSH_MS / 1000)
+directory = UserDirectory()
+response_cache = ResponseCache(RESPONSE_CACHE_MB * 1024 ** 2)
+message_cache = MessageCache(MESSAGE_CACHE_PER_CHAT, MESSAGE_CACHE_MB * 1024 ** 2)
+archive_store = ArchiveStore(ARCHIVE_DIR, ARCHIVE_BLOCK_MESSAGES)
+archive_index = ArchiveIndex(ARCHIVE_INDEX_PATH)
+compactor = Compactor(ARCHIVE_INTERVAL_SECONDS)
+
+# === МЕТРИКИ ===
+HTTP_REQUEST_SECONDS = metrics_registry.histogram(
+    'messenger_http_request_duration_seconds', 'HTTP request latency by route', ('method', 'route', 'status')
+)
+MESSAGES_SENT = metrics_registry.counter(
+    'messenger_messages_total', 'Messages stored', ('transport',)
+)
+LOOP_LAG_SECONDS = metrics_registry.histogram(
+    'messenger_event_loop_lag_seconds', 'How late the event loop wakes up a sleeping probe',
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+)
+metrics_registry.gauge(
+    'messenger_ws_connections', 'Open WebSocket connections on this worker'
+).set_function(registry.connection_count)
+metrics_registry.gauge(
+    'messenger_sessions', 'Sessions with an open WebSocket on this worker'
+).set_function(registry.session_count)
+metrics_registry.gauge(
+    'messenger_members_cached_chats', 'Chats whose participant list is cached for fan-out'
+).set_function(registry.chat_count)
+metrics_registry.gauge(
+    'messenger_db_write_queue_depth', 'Write operations waiting for the group commit'
+).set_function(lambda: storage.writer.queue_depth() if storage else 0)
+metrics_registry.gauge(
+    'messenger_presence_pending', 'Presence changes not yet flushed to the database'
+).set_function(presence.pending)
+metrics_registry.gauge(
+    'messenger_receipts_pending', 'Read pointers not yet flushed to the database'
+).set_function(receipts.pending)
+metrics_registry.gauge(
+    'messenger_message_cache_bytes', 'Estimated memory held by the message cache'
+).set_function(lambda: message_cache.bytes)
+RATE_LIMITED = metrics_registry.counter(
+    'messenger_rate_limited_total', 'Requests and WebSocket frames rejected by rate limits', ('scope',)
+)
+LOAD_SHED = metrics_registry.counter(
+    'messenger_load_shed_total', 'Requests rejected while the server was overloaded', ('reason',)
+)
+WS_REJECTED = metrics_registry.counter(
+    'messenger_ws_rejected_total', 'WebSocket connections refused by connection limits', ('reason',)
+)
+loop_lag_probe = LoopLagProbe(LOOP_LAG_SECONDS, LOOP_LAG_INTERVAL_MS / 1000)
+admission = AdmissionControl(
+    lambda: loop_lag_probe.last_lag,
+    lambda: storage.writer.queue_depth() if storage else 0,
+    SHED_LOOP_LAG_MS / 1000,
+    SHED_WRITE_QUEUE
+)
+message_log_counter = itertools.count()
+background_tasks = []
+
+async def hash_password(password):
+    """Хешировать пароль (scrypt в пуле потоков)"""
+    return await password_hasher.hash(password)
 
 async def init_db():
     """Инициализация базы данных"""
-    global db
+    global storage
     
     try:
-        db = await aiosqlite.connect(DB_PATH)
+        # Схема и миграции — на отдельном служебном соединении
+        db = await aiosqlite.connect(DB_PATH, timeout=60)
         db.row_factory = aiosqlite.Row
+        await db.execute('PRAGMA journal_mode = WAL')
         logger.info(f"✅ Database connected: {DB_PATH}")
         
         # Создаём таблицы если их нет
@@ -84,37 +322,344 @@ async def init_db():
         ''')
         
         await db.commit()
-        logger.info("✅ Database tables initialized")
+        
+        version = await apply_migrations(db)
+        await db.close()
+        logger.info(f"✅ Database tables initialized (schema v{version})")
+        
+        storage = Storage(
+            DB_PATH,
+            readers=DB_READERS,
+            pragmas=connection_pragmas(DB_SYNCHRONOUS, DB_CACHE_SIZE_MB, DB_MMAP_SIZE_MB),
+            max_batch=WRITER_MAX_BATCH,
+            window=WRITER_BATCH_WINDOW_MS / 1000
+        )
+        await storage.open()
     except Exception as e:
         logger.error(f"❌ Database initialization error: {e}")
         raise
 
-async def broadcast_to_chat(chat_id, event_type, data):
-    """Отправить сообщение всем участникам чата"""
+async def flush_presence(updates):
+    """Записать накопленные статусы одной операцией писателя и сообщить их остальным воркерам.
+    В БД идёт общий статус с учётом других воркеров, а не только этого"""
+    await storage.executemany([
+        ('UPDATE users SET status = ? WHERE id = ?', (presence.get_status(user_id) or status, user_id))
+        for user_id, status in updates.items()
+    ])
     try:
-        cursor = await db.execute(
-            'SELECT user_id FROM chat_participants WHERE chat_id = ?',
+        await bus.publish('presence', {'worker_id': bus.worker_id, 'statuses': updates})
+    except Exception as e:
+        logger.error(f"Presence publish error: {e}")
+
+def set_presence(user_id, status):
+    """Сменить статус; ответы со статусами пользователя устаревают"""
+    if presence.set_status(user_id, status):
+        invalidate_user(user_id)
+
+def invalidate_user(user_id):
+    response_cache.bump('users')
+    response_cache.bump(('user', user_id))
+
+async def flush_receipts(updates):
+    """Записать указатели прочтения одной операцией писателя.
+    Указатель не уезжает назад и не обгоняет последний номер чата"""
+    await storage.executemany([
+        ('''
+            UPDATE chat_participants
+            SET last_read_seq = MAX(last_read_seq, MIN(?, (SELECT last_seq FROM chats WHERE id = ?)))
+            WHERE chat_id = ? AND user_id = ?
+        ''', (seq, chat_id, chat_id, user_id))
+        for (chat_id, user_id), seq in updates.items()
+    ])
+
+async def publish_receipts(chat_id, readers):
+    """Одно событие на чат за интервал со всеми сдвинувшимися указателями"""
+    await broadcast_to_chat(chat_id, 'read_receipt', {
+        'chat_id': chat_id,
+        'readers': [{'username': username, 'seq': seq} for username, seq in readers.items()]
+    })
+
+async def expire_typing(chat_id, username):
+    """Погасить индикатор, для которого клиент не прислал stop_typing"""
+    await broadcast_to_chat(chat_id, 'user_typing', {
+        'chat_id': chat_id,
+        'username': username,
+        'is_typing': False
+    })
+
+async def create_session(user_id):
+    """Выдать сессию; она хранится в БД и видна всем воркерам"""
+    session_id = generate_token()
+    await storage.execute(
+        'INSERT INTO sessions (id, user_id, last_seen) VALUES (?, ?, CURRENT_TIMESTAMP)',
+        (session_id, user_id)
+    )
+    return session_id
+
+async def resolve_session(session_id):
+    """Найти пользователя сессии: сначала среди сокетов воркера, затем в БД.
+    Истёкшая сессия даёт None; подключение продлевает её не чаще раза в сутки"""
+    user_id = registry.get_user(session_id)
+    if user_id is not None:
+        return user_id
+    row = await storage.fetchone('''
+        SELECT user_id, last_seen > datetime('now', '-1 day') AS fresh
+        FROM sessions
+        WHERE id = ? AND last_seen > datetime('now', ?)
+    ''', (session_id, f'-{SESSION_TTL_DAYS} days'))
+    if row is None:
+        return None
+    if not row['fresh']:
+        await storage.execute('UPDATE sessions SET last_seen = CURRENT_TIMESTAMP WHERE id = ?', (session_id,))
+    return row['user_id']
+
+async def sweep_sessions():
+    """Удалить сессии, не подключавшиеся дольше SESSION_TTL_DAYS"""
+    deleted = await storage.execute(
+        "DELETE FROM sessions WHERE last_seen <= datetime('now', ?)",
+        (f'-{SESSION_TTL_DAYS} days',)
+    )
+    if deleted:
+        logger.info(f"✅ Expired sessions removed: {deleted}")
+
+async def run_periodically(interval, job, name):
+    """Повторять job() раз в interval секунд; ошибка не останавливает цикл"""
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await job()
+        except Exception as e:
+            logger.error(f"{name} error: {e}")
+
+def start_background(interval, job, name):
+    background_tasks.append(asyncio.create_task(run_periodically(interval, job, name)))
+
+async def stop_background(app):
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    background_tasks.clear()
+
+async def start_presence():
+    presence.start(flush_presence)
+    typing_tracker.start(expire_typing)
+    receipts.start(flush_receipts, publish_receipts)
+
+async def stop_presence(app):
+    await receipts.close()
+    await typing_tracker.close()
+    await presence.close()
+
+async def close_bus(app):
+    await bus.close()
+
+async def close_password_hasher(app):
+    password_hasher.close()
+
+async def close_metrics(app):
+    await loop_lag_probe.close()
+
+def too_many_requests(retry_after, error='Слишком много запросов', status=429):
+    """Отказ с Retry-After в целых секундах"""
+    return web.json_response(
+        {'error': error},
+        status=status,
+        headers={
+            'Retry-After': str(max(1, math.ceil(retry_after))),
+            'Access-Control-Expose-Headers': 'Retry-After'
+        }
+    )
+
+def client_address(request):
+    """Адрес клиента: из заголовка доверенного прокси, если он настроен"""
+    if RATE_LIMIT_CLIENT_IP_HEADER:
+        forwarded = request.headers.get(RATE_LIMIT_CLIENT_IP_HEADER)
+        if forwarded:
+            # Прокси дописывает адрес, с которого к нему пришли, в конец списка
+            return forwarded.rsplit(',', 1)[-1].strip()
+    return request.remote
+
+async def rate_limit_key(request):
+    """Чей лимит расходует запрос: пользователя предъявленной сессии или адреса клиента"""
+    session_id = request.headers.get('X-Session-Id')
+    if session_id:
+        user_id = registry.get_user(session_id) or await cached_session_user(session_id)
+        if user_id is not None:
+            return ('user', user_id)
+    return ('ip', client_address(request))
+
+async def cached_session_user(session_id):
+    """Пользователь сессии через LRU; неизвестная сессия не кешируется.
+    Устаревшая запись меняет только ведро лимита, а не права доступа"""
+    user_id = rate_limit_sessions.get(session_id)
+    if user_id is not None:
+        rate_limit_sessions.move_to_end(session_id)
+        return user_id
+    row = await storage.fetchone('SELECT user_id FROM sessions WHERE id = ?', (session_id,))
+    if row is None:
+        return None
+    rate_limit_sessions[session_id] = row['user_id']
+    if len(rate_limit_sessions) > RATE_LIMIT_SESSION_CACHE:
+        rate_limit_sessions.popitem(last=False)
+    return row['user_id']
+
+def limit_ws_frame(session_id, msg_type):
+    """0 — кадр можно обработать; иначе через сколько секунд повторить"""
+    if not RATE_LIMIT_ENABLED:
+        return 0.0
+    retry_after = rate_limiter.acquire(('ws', session_id), RATE_LIMIT_WS_FRAMES)
+    if retry_after or msg_type != 'send_message':
+        return retry_after
+    retry_after = rate_limiter.acquire(('ws_send', session_id), RATE_LIMIT_WS_MESSAGES)
+    if retry_after:
+        return retry_after
+    # Запись сообщения встала бы в перегруженную очередь писателя
+    reason = admission.overloaded()
+    if reason:
+        LOAD_SHED.labels(reason).inc()
+        return SHED_RETRY_AFTER
+    return 0.0
+
+def log_message_sent(message_id, transport):
+    """Учесть отправку; строка лога — только для каждого N-го сообщения"""
+    MESSAGES_SENT.labels(transport).inc()
+    if logger.isEnabledFor(logging.DEBUG) and next(message_log_counter) % MESSAGE_LOG_SAMPLE == 0:
+        logger.debug(f"✅ Message sent via {transport}: {message_id}")
+
+async def close_archive(app):
+    await compactor.close()
+    await archive_store.close()
+    await archive_index.close()
+
+async def close_db(app):
+    """Закрыть писатель и пул читателей"""
+    if storage:
+        await storage.close()
+
+async def load_chat_members(chat_id):
+    """Загрузить участников чата в реестр, если их ещё нет в кеше"""
+    if registry.members(chat_id) is not None:
+        return
+    participants = await storage.fetchall(
+        'SELECT user_id FROM chat_participants WHERE chat_id = ?',
+        (chat_id,)
+    )
+    registry.set_members(chat_id, [p['user_id'] for p in participants])
+
+async def store_message(message_id, chat_id, sender_id, sender_username, msg_type, text, file_url=None, filename=None):
+    """Записать сообщение вместе со сводкой чата; своё сообщение автор прочитал.
+    Возвращает сообщение в формате истории или None, если чата нет"""
+    preview = text[:PREVIEW_LENGTH] if text else None
+    
+    def operation(conn):
+        # Номер выдаётся в транзакции писателя — монотонен и между воркерами
+        row = conn.execute(
+            'UPDATE chats SET last_seq = last_seq + 1 WHERE id = ? RETURNING last_seq',
             (chat_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        seq = row[0]
+        
+        created_at = conn.execute('''
+            INSERT INTO messages (id, chat_id, sender_id, type, text, file_url, filename, seq)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            RETURNING created_at
+        ''', (message_id, chat_id, sender_id, msg_type, text, file_url, filename, seq)).fetchone()[0]
+        conn.execute('''
+            INSERT INTO chat_summaries
+                (chat_id, last_message_id, last_sender_username, last_message_type, last_message_text, last_activity)
+            VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT (chat_id) DO UPDATE SET
+                last_message_id = excluded.last_message_id,
+                last_sender_username = excluded.last_sender_username,
+                last_message_type = excluded.last_message_type,
+                last_message_text = excluded.last_message_text,
+                last_activity = excluded.last_activity
+        ''', (chat_id, message_id, sender_username, msg_type, preview, created_at))
+        # Непрочитанное остальных растёт само вместе с last_seq — трогаем одну строку
+        conn.execute(
+            'UPDATE chat_participants SET last_read_seq = ? WHERE chat_id = ? AND user_id = ?',
+            (seq, chat_id, sender_id)
         )
-        participants = await cursor.fetchall()
-        
-        participant_ids = [p['user_id'] for p in participants]
-        
-        for user_id in participant_ids:
-            session_ids = [sid for sid, uid in user_sessions.items() if uid == user_id]
-            for session_id in session_ids:
-                ws = active_connections.get(session_id)
-                if ws and not ws.closed:
-                    try:
-                        await ws.send_json({
-                            'type': event_type,
-                            'data': data
-                        })
-                    except Exception as e:
-                        logger.error(f"Error sending message: {e}")
+        return {
+            'id': message_id,
+            'chat_id': chat_id,
+            'seq': seq,
+            'sender_username': sender_username,
+            'type': msg_type,
+            'text': text,
+            'file_url': file_url,
+            'filename': filename,
+            'timestamp': created_at
+        }
+    
+    message = await storage.submit(operation)
+    if message:
+        # Write-through: кеш видит сообщение сразу после коммита
+        message_cache.append(message)
+        response_cache.bump(('chat', chat_id))
+    return message
+
+async def broadcast_to_chat(chat_id, event_type, data):
+    """Отправить сообщение всем участникам чата на всех воркерах"""
+    try:
+        await bus.publish('event', {
+            'chat_id': chat_id,
+            'type': event_type,
+            'data': data
+        })
     except Exception as e:
         logger.error(f"Broadcast error: {e}")
 
+# События, после которых меняется строка чата в списке чатов
+CHAT_LIST_EVENTS = frozenset({'new_message', 'read_receipt'})
+
+async def deliver_from_bus(channel, message):
+    """Доставить событие шины сокетам этого воркера"""
+    if channel == 'user':
+        # Новый пользователь должен находиться автодополнением на всех воркерах
+        directory.add(message['id'], message['username'], message['avatar'])
+        response_cache.bump('users')
+        return
+    if channel == 'presence':
+        if message['worker_id'] != bus.worker_id:
+            presence.apply_remote(message['worker_id'], message['statuses'])
+        # Статусы в БД обновлены — кеш ответов устарел на всех воркерах
+        for user_id in message['statuses']:
+            invalidate_user(user_id)
+        return
+    if channel == 'worker_down':
+        gone = presence.forget_worker(message['worker_id'])
+        # В БД и остальным воркерам новые статусы пишет только заметивший
+        if message['reported_by'] == bus.worker_id:
+            presence.republish(gone)
+        for user_id in gone:
+            invalidate_user(user_id)
+        return
+    if channel == 'worker_rejoined':
+        # Остальные воркеры уже забыли наших пользователей
+        presence.republish()
+        return
+    chat_id = message['chat_id']
+    if channel == 'event':
+        if message['type'] == 'new_message':
+            # Сообщения с других воркеров тоже попадают в кеш
+            message_cache.append(message['data'])
+        if message['type'] in CHAT_LIST_EVENTS:
+            response_cache.bump(('chat', chat_id))
+        await load_chat_members(chat_id)
+        fan_out(registry.sockets_for_chat(chat_id), message['type'], message['data'])
+    elif channel == 'members':
+        registry.set_members(chat_id, message['user_ids'])
+        # Новый чат появился в списках участников
+        for user_id in message['user_ids']:
+            response_cache.bump(('chats', user_id))
+    elif channel == 'invalidate':
+        # История чата изменилась в обход рассылки (импорт)
+        message_cache.invalidate(chat_id)
+        response_cache.bump(('chat', chat_id))
+
 # === REST API ===
 
 async def register(request):
@@ -132,17 +677,17 @@ async def register(request):
             return web.json_response({'error': 'Username минимум 3 символа'}, status=400)
         
         user_id = generate_id()
-        password_hash = hash_password(password)
+        password_hash = await hash_password(password)
         avatar = f'https://ui-avatars.com/api/? name={username}&background=667eea&color=fff'
         
         try:
-            await db.execute('''
+            await storage.execute('''
                 INSERT INTO users (id, username, email, password_hash, avatar, status)
                 VALUES (?, ?, ?, ?, ?, ?)
             ''', (user_id, username, email, password_hash, avatar, 'offline'))
-            await db.commit()
             
             logger.info(f"✅ User registered: {username}")
+            await announce_user(user_id, username, avatar)
             
             return web.json_response({
                 'success': True,
@@ -172,23 +717,27 @@ async def login(request):
         if not username or not password:
             return web.json_response({'error': 'Username и пароль обязательны'}, status=400)
         
-        password_hash = hash_password(password)
-        
-        cursor = await db.execute(
-            'SELECT id, username, email, avatar, status FROM users WHERE username = ?  AND password_hash = ?',
-            (username, password_hash)
+        user = await storage.fetchone(
+            'SELECT id, username, email, avatar, status, password_hash FROM users WHERE username = ?',
+            (username,)
         )
-        user = await cursor.fetchone()
         
-        if not user:
+        valid, needs_rehash = await password_hasher.verify(password, user['password_hash'] if user else None)
+        
+        if not valid:
             return web.json_response({'error': 'Неверный username или пароль'}, status=401)
         
-        # Обновляем статус на online
-        await db.execute('UPDATE users SET status = ? WHERE id = ?', ('online', user['id']))
-        await db.commit()
+        # Старый sha256 или устаревшие параметры — тихо переводим на текущий scrypt
+        if needs_rehash:
+            await storage.execute(
+                'UPDATE users SET password_hash = ? WHERE id = ?',
+                (await hash_password(password), user['id'])
+            )
+        
+        # Статус online попадёт в БД при следующем сбросе presence
+        set_presence(user['id'], 'online')
         
-        session_id = generate_id()
-        user_sessions[session_id] = user['id']
+        session_id = await create_session(user['id'])
         
         logger.info(f"✅ User logged in: {username}")
         
@@ -207,11 +756,55 @@ async def login(request):
         logger.error(f"Login error: {e}")
         return web.json_response({'error': str(e)}, status=500)
 
+async def load_directory():
+    """Построить индекс автодополнения по всем пользователям"""
+    rows = await storage.fetchall('SELECT id, username, avatar FROM users')
+    directory.load(tuple(row) for row in rows)
+    logger.info(f"✅ User directory loaded: {len(directory)} users")
+
+async def announce_user(user_id, username, avatar):
+    """Добавить пользователя в индексы автодополнения всех воркеров"""
+    try:
+        await bus.publish('user', {'id': user_id, 'username': username, 'avatar': avatar})
+    except Exception as e:
+        logger.error(f"Announce user error: {e}")
+
+def encode_user_cursor(username):
+    """Курсор списка пользователей: последний username страницы"""
+    raw = json.dumps({'username': username}).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+def decode_user_cursor(cursor):
+    padded = cursor + '=' * (-len(cursor) % 4)
+    username = json.loads(base64.urlsafe_b64decode(padded))['username']
+    if not isinstance(username, str):
+        raise ValueError('bad cursor')
+    return username
+
 async def get_all_users(request):
-    """Получить всех пользователей"""
+    """Страница пользователей по возрастанию username (курсор after)"""
     try:
-        cursor = await db.execute('SELECT id, username, email, avatar, status FROM users')
-        users = await cursor.fetchall()
+        try:
+            after = request.query.get('after')
+            after_username = decode_user_cursor(after) if after else ''
+            limit = int(request.query.get('limit', USERS_PAGE_SIZE))
+        except (ValueError, KeyError, TypeError):
+            return web.json_response({'error': 'Неверные параметры пагинации'}, status=400)
+        limit = max(1, min(limit, USERS_MAX_PAGE_SIZE))
+        
+        key = ('users', after_username, limit)
+        entry = response_cache.get(key)
+        if entry is not None:
+            return response_cache.respond(request, entry)
+        token = response_cache.begin()
+        
+        # Проход по уникальному индексу username; лишняя строка — признак has_more
+        users = await storage.fetchall(
+            'SELECT id, username, email, avatar, status FROM users WHERE username > ? ORDER BY username LIMIT ?',
+            (after_username, limit + 1)
+        )
+        has_more = len(users) > limit
+        users = users[:limit]
         
         users_list = [
             {
@@ -219,15 +812,44 @@ async def get_all_users(request):
                 'username': user['username'],
                 'email': user['email'],
                 'avatar': user['avatar'],
-                'status': user['status']
+                'status': presence.get_status(user['id']) or user['status']
             }
             for user in users
         ]
-        return web.json_response(users_list, status=200)
+        body = json.dumps({
+            'users': users_list,
+            'has_more': has_more,
+            'next': encode_user_cursor(users_list[-1]['username']) if has_more else None
+        }).encode()
+        # Статусы и новые регистрации меняют любую страницу — одна общая версия
+        entry = response_cache.put(key, ['users'], body, token)
+        return response_cache.respond(request, entry)
     except Exception as e:
         logger.error(f"Get users error: {e}")
         return web.json_response({'error': str(e)}, status=500)
 
+async def autocomplete_users(request):
+    """Подсказки по началу username из индекса в памяти, без SQLite"""
+    query = request.query.get('q', '').strip()
+    try:
+        limit = int(request.query.get('limit', AUTOCOMPLETE_LIMIT))
+    except ValueError:
+        return web.json_response({'error': 'Неверный limit'}, status=400)
+    limit = max(1, min(limit, AUTOCOMPLETE_MAX_LIMIT))
+    
+    users = directory.prefix(query, limit) if query else []
+    return web.json_response({
+        'users': [
+            {
+                'id': user_id,
+                'username': username,
+                'avatar': avatar,
+                'status': presence.get_status(user_id) or 'offline'
+            }
+            for username, user_id, avatar in users
+        ]
+    }, status=200)
+
 async def search_user(request):
     """Найти пользователя по username"""
     try:
@@ -236,24 +858,31 @@ async def search_user(request):
         if not username:
             return web.json_response({'error': 'Username не указан'}, status=400)
         
-        cursor = await db.execute(
+        key = ('user', username)
+        entry = response_cache.get(key)
+        if entry is not None:
+            return response_cache.respond(request, entry)
+        token = response_cache.begin()
+        
+        user = await storage.fetchone(
             'SELECT id, username, email, avatar, status FROM users WHERE username = ?',
             (username,)
         )
-        user = await cursor.fetchone()
         
         if not user:
             return web.json_response({'error': 'Пользователь не найден'}, status=404)
         
-        return web.json_response({
+        body = json.dumps({
             'success': True,
             'user': {
                 'id': user['id'],
                 'username': user['username'],
                 'avatar': user['avatar'],
-                'status': user['status']
+                'status': presence.get_status(user['id']) or user['status']
             }
-        }, status=200)
+        }).encode()
+        entry = response_cache.put(key, [('user', user['id'])], body, token)
+        return response_cache.respond(request, entry)
     except Exception as e:
         logger.error(f"Search user error: {e}")
         return web.json_response({'error': str(e)}, status=500)
@@ -275,28 +904,21 @@ async def create_chat(request):
         
         try:
             # Получаем ID создателя
-            cursor = await db.execute(
+            creator = await storage.fetchone(
                 'SELECT id FROM users WHERE username = ?',
                 (creator_username,)
             )
-            creator = await cursor.fetchone()
             
             if not creator:
                 return web.json_response({'error': 'Создатель не найден'}, status=404)
             
-            # Создаём чат
-            await db.execute('''
-                INSERT INTO chats (id, type, name, avatar, creator_id)
-                VALUES (?, ?, ?, ?, ?)
-            ''', (chat_id, chat_type, name if name else None, avatar if avatar else None, creator['id']))
-            
-            # Добавляем участников
+            # Проверяем участников до записи, чтобы не оставить чат без участников
+            member_ids = []
             for username in participants:
-                cursor = await db.execute(
+                user = await storage.fetchone(
                     'SELECT id FROM users WHERE username = ?',
                     (username,)
                 )
-                user = await cursor.fetchone()
                 
                 if not user:
                     return web.json_response(
@@ -304,12 +926,19 @@ async def create_chat(request):
                         status=404
                     )
                 
-                await db.execute(
-                    'INSERT INTO chat_participants (chat_id, user_id) VALUES (?, ?)',
-                    (chat_id, user['id'])
-                )
+                member_ids.append(user['id'])
             
-            await db.commit()
+            # Чат и участники — одной атомарной операцией писателя
+            statements = [('''
+                INSERT INTO chats (id, type, name, avatar, creator_id)
+                VALUES (?, ?, ?, ?, ?)
+            ''', (chat_id, chat_type, name if name else None, avatar if avatar else None, creator['id']))]
+            statements.extend(
+                ('INSERT INTO chat_participants (chat_id, user_id) VALUES (?, ?)', (chat_id, user_id))
+                for user_id in member_ids
+            )
+            await storage.executemany(statements)
+            await bus.publish('members', {'chat_id': chat_id, 'user_ids': member_ids})
             logger.info(f"✅ Chat created: {chat_id}")
             
             return web.json_response({
@@ -331,75 +960,349 @@ async def create_chat(request):
         return web.json_response({'error': str(e)}, status=500)
 
 async def get_user_chats(request):
-    """Получить чаты пользователя"""
+    """Получить чаты пользователя, отсортированные по последней активности"""
     try:
         username = request.match_info['username']
         
-        cursor = await db.execute('SELECT id FROM users WHERE username = ?', (username,))
-        user = await cursor.fetchone()
+        key = ('chats', username)
+        entry = response_cache.get(key)
+        if entry is not None:
+            return response_cache.respond(request, entry)
+        token = response_cache.begin()
         
-        if not user:
-            return web.json_response({'error': 'Пользователь не найден'}, status=404)
+        # Один запрос: чаты, сводки, непрочитанное и участники.
+        # LEFT JOIN от users отличает "нет чатов" от "нет пользователя"
+        rows = await storage.fetchall('''
+            SELECT c.id, c.type, c.name, c.avatar, c.created_at, c.last_seq,
+                   s.last_message_id, s.last_sender_username, s.last_message_type, s.last_message_text,
+                   COALESCE(s.last_activity, c.created_at) AS last_activity,
+                   me.id AS user_id, cp.last_read_seq,
+                   (
+                       SELECT MAX(p.last_read_seq)
+                       FROM chat_participants p
+                       WHERE p.chat_id = c.id AND p.user_id != me.id
+                   ) AS peer_read_seq,
+                   (
+                       SELECT group_concat(u.username, char(31))
+                       FROM chat_participants p
+                       JOIN users u ON u.id = p.user_id
+                       WHERE p.chat_id = c.id
+                   ) AS participants
+            FROM users me
+            LEFT JOIN chat_participants cp ON cp.user_id = me.id
+            LEFT JOIN chats c ON c.id = cp.chat_id
+            LEFT JOIN chat_summaries s ON s.chat_id = c.id
+            WHERE me.username = ?
+            ORDER BY last_activity DESC
+        ''', (username,))
         
-        cursor = await db.execute('''
-            SELECT c.id, c.type, c.name, c.avatar, c.created_at
-            FROM chats c
-            JOIN chat_participants cp ON c.id = cp.chat_id
-            WHERE cp.user_id = ? 
-        ''', (user['id'],))
-        chats = await cursor.fetchall()
+        if not rows:
+            return web.json_response({'error': 'Пользователь не найден'}, status=404)
         
         chats_list = []
-        for chat in chats:
-            cursor = await db.execute(
-                'SELECT u.username FROM chat_participants cp JOIN users u ON cp.user_id = u.id WHERE cp.chat_id = ? ',
-                (chat['id'],)
-            )
-            participants = await cursor.fetchall()
-            
+        for chat in rows:
+            if not chat['id']:
+                continue
+            # Непрочитанное — разность номеров, без подсчёта строк
+            last_read_seq = max(chat['last_read_seq'], receipts.pointer(chat['id'], chat['user_id']))
             chats_list.append({
                 'id': chat['id'],
                 'type': chat['type'],
                 'name': chat['name'],
                 'avatar': chat['avatar'],
-                'participants': [p['username'] for p in participants],
-                'created_at': chat['created_at'] if chat['created_at'] else None
+                'participants': chat['participants'].split('\x1f') if chat['participants'] else [],
+                'created_at': chat['created_at'] if chat['created_at'] else None,
+                'last_message': {
+                    'id': chat['last_message_id'],
+                    'sender_username': chat['last_sender_username'],
+                    'type': chat['last_message_type'],
+                    'text': chat['last_message_text']
+                } if chat['last_message_id'] else None,
+                'last_activity': chat['last_activity'],
+                'unread_count': max(0, chat['last_seq'] - last_read_seq),
+                'last_seq': chat['last_seq'],
+                'last_read_seq': last_read_seq,
+                'peer_read_seq': chat['peer_read_seq'] or 0
             })
         
-        return web.json_response(chats_list, status=200)
+        # Список зависит от состава чатов пользователя и от каждого из чатов
+        scopes = [('chats', rows[0]['user_id'])] + [('chat', chat['id']) for chat in chats_list]
+        entry = response_cache.put(key, scopes, json.dumps(chats_list).encode(), token)
+        return response_cache.respond(request, entry)
     except Exception as e:
         logger.error(f"Get chats error: {e}")
         return web.json_response({'error': str(e)}, status=500)
 
+def mark_read(chat_id, participant, seq=None):
+    """Сдвинуть указатель прочтения (до seq или до конца чата).
+    participant — строка с user_id, username и last_seq чата"""
+    last_seq = participant['last_seq']
+    seq = last_seq if seq is None else min(seq, last_seq)
+    if not receipts.mark(chat_id, participant['user_id'], participant['username'], seq):
+        return False
+    # Непрочитанное в списке чатов учитывает ещё не записанные отметки
+    response_cache.bump(('chat', chat_id))
+    return True
+
+async def mark_chat_read(request):
+    """Отметить чат прочитанным; в БД попадёт со следующим сбросом отметок"""
+    try:
+        chat_id = request.match_info['chat_id']
+        data = await request.json()
+        username = data.get('username', '')
+        seq = data.get('seq')
+        if seq is not None and not isinstance(seq, int):
+            return web.json_response({'error': 'Некорректный seq'}, status=400)
+        
+        participant = await storage.fetchone('''
+            SELECT u.id AS user_id, u.username, c.last_seq
+            FROM users u
+            JOIN chat_participants cp ON cp.user_id = u.id
+            JOIN chats c ON c.id = cp.chat_id
+            WHERE u.username = ? AND cp.chat_id = ?
+        ''', (username, chat_id))
+        
+        if not participant:
+            return web.json_response({'error': 'Участник чата не найден'}, status=404)
+        
+        mark_read(chat_id, participant, seq)
+        return web.json_response({'success': True}, status=200)
+    except Exception as e:
+        logger.error(f"Mark read error: {e}")
+        return web.json_response({'error': str(e)}, status=500)
+
+def encode_cursor(seq):
+    """Курсор истории: непрозрачная строка с номером сообщения в чате"""
+    raw = json.dumps({'seq': seq}).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+def decode_cursor(cursor):
+    padded = cursor + '=' * (-len(cursor) % 4)
+    seq = json.loads(base64.urlsafe_b64decode(padded))['seq']
+    if not isinstance(seq, int):
+        raise ValueError('bad cursor')
+    return seq
+
+def message_to_dict(msg):
+    return {
+        'id': msg['id'],
+        'chat_id': msg['chat_id'],
+        'seq': msg['seq'],
+        'sender_username': msg['sender_username'],
+        'type': msg['type'],
+        'text': msg['text'],
+        'file_url': msg['file_url'],
+        'filename': msg['filename'],
+        'timestamp': msg['created_at'] if msg['created_at'] else None
+    }
+
+async def query_history(chat_id, before_seq=None, after_seq=None, limit=HISTORY_PAGE_SIZE):
+    """Страница истории по индексу (chat_id, seq); вернуть (сообщения, есть ли ещё)"""
+    query = '''
+        SELECT m.id, m.chat_id, m.seq, u.username as sender_username, m.type, m.text, m.file_url, m.filename, m.created_at
+        FROM messages m
+        JOIN users u ON m.sender_id = u.id
+        WHERE m.chat_id = ?
+    '''
+    params = [chat_id]
+    if after_seq is not None:
+        query += ' AND m.seq > ? ORDER BY m.seq ASC LIMIT ?'
+        params.append(after_seq)
+    else:
+        if before_seq is not None:
+            query += ' AND m.seq < ?'
+            params.append(before_seq)
+        query += ' ORDER BY m.seq DESC LIMIT ?'
+    # Берём на одну строку больше, чтобы узнать, есть ли ещё страница
+    params.append(limit + 1)
+    
+    want = limit + 1
+    messages = [message_to_dict(msg) for msg in await storage.fetchall(query, params)]
+    
+    # seq в чате идут без пропусков: пропуск на границе значит, что часть — в архиве
+    if after_seq is None:
+        lowest = messages[-1]['seq'] if messages else before_seq
+        if len(messages) < want and (lowest is None or lowest > 1):
+            high = lowest - 1 if lowest is not None else None
+            messages += await read_archive(chat_id, None, high, want - len(messages), descending=True)
+    elif not messages or messages[0]['seq'] > after_seq + 1:
+        high = messages[0]['seq'] - 1 if messages else None
+        archived = await read_archive(chat_id, after_seq + 1, high, want)
+        messages = (archived + messages)[:want]
+    
+    has_more = len(messages) > limit
+    messages = messages[:limit]
+    if after_seq is None:
+        messages.reverse()
+    
+    return messages, has_more
+
+async def read_archive(chat_id, low, high, limit, descending=False):
+    """Сообщения чата из сегментов архива в диапазоне seq [low, high]"""
+    low = low if low is not None else 0
+    high = high if high is not None else 2 ** 62
+    order = 'DESC' if descending else 'ASC'
+    segments = await storage.fetchall(f'''
+        SELECT path, first_seq, last_seq FROM archive_segments
+        WHERE chat_id = ? AND last_seq >= ? AND first_seq <= ?
+        ORDER BY first_seq {order}
+    ''', (chat_id, low, high))
+    
+    messages = []
+    for segment in segments:
+        messages += await archive_store.read(
+            segment['path'], max(low, segment['first_seq']), min(high, segment['last_seq']),
+            limit - len(messages), descending
+        )
+        if len(messages) >= limit:
+            break
+    return messages
+
+async def archive_chat(chat_id, cutoff):
+    """Перенести самые старые сообщения чата в новый сегмент; вернуть их число"""
+    rows = await storage.fetchall('''
+        SELECT m.id, m.chat_id, m.seq, u.username as sender_username, m.type, m.text, m.file_url, m.filename, m.created_at,
+               julianday(m.created_at) < julianday(?) AS expired
+        FROM messages m
+        LEFT JOIN users u ON m.sender_id = u.id
+        WHERE m.chat_id = ?
+        ORDER BY m.seq
+        LIMIT ?
+    ''', (cutoff, chat_id, ARCHIVE_SEGMENT_MESSAGES))
+    
+    # Только непрерывный префикс достаточно старых сообщений.
+    # julianday сравнивает моменты, а не строки: формат времени у импортированных может отличаться
+    messages = []
+    for row in rows:
+        if not row['expired'] or (messages and row['seq'] != messages[-1]['seq'] + 1):
+            break
+        messages.append(message_to_dict(row))
+    if len(messages) < ARCHIVE_MIN_MESSAGES:
+        return 0
+    
+    first_seq, last_seq = messages[0]['seq'], messages[-1]['seq']
+    path = archive_store.new_path(chat_id, first_seq, last_seq)
+    size = await archive_store.write(path, messages)
+    
+    def operation(conn):
+        # Другой воркер мог успеть перенести этот же диапазон
+        count = conn.execute(
+            'SELECT COUNT(*) FROM messages WHERE chat_id = ? AND seq BETWEEN ? AND ?',
+            (chat_id, first_seq, last_seq)
+        ).fetchone()[0]
+        if count != len(messages):
+            return False
+        conn.execute('''
+            INSERT INTO archive_segments (chat_id, first_seq, last_seq, path, message_count, bytes)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', (chat_id, first_seq, last_seq, path, len(messages), size))
+        conn.execute(
+            'DELETE FROM messages WHERE chat_id = ? AND seq BETWEEN ? AND ?',
+            (chat_id, first_seq, last_seq)
+        )
+        return True
+    
+    try:
+        moved = await storage.submit(operation)
+    except Exception:
+        await archive_store.discard(path)
+        raise
+    if not moved:
+        await archive_store.discard(path)
+        return 0
+    # Не попавший в индекс сегмент доиндексирует index_archive()
+    try:
+        await archive_index.add(path, messages)
+    except Exception as e:
+        logger.error(f"Archive index error: {e}")
+    return len(messages)
+
+async def index_archive():
+    """Доиндексировать сегменты, которых нет в поисковом индексе архива; вернуть их число"""
+    indexed = await archive_index.indexed()
+    segments = await storage.fetchall('SELECT path, first_seq, last_seq, message_count FROM archive_segments')
+    added = 0
+    for segment in segments:
+        if segment['path'] in indexed:
+            continue
+        try:
+            messages = await archive_store.read(
+                segment['path'], segment['first_seq'], segment['last_seq'], segment['message_count']
+            )
+            added += await archive_index.add(segment['path'], messages)
+        except Exception as e:
+            logger.error(f"Archive index error for {segment['path']}: {e}")
+    if added:
+        logger.info(f"🔎 Indexed {added} archive segments")
+    return added
+
+async def compact_archive():
+    """Один проход компактора по всем чатам со старой историей"""
+    await index_archive()
+    cutoff = (datetime.utcnow() - timedelta(days=ARCHIVE_AFTER_DAYS)).strftime('%Y-%m-%d %H:%M:%S')
+    chats = await storage.fetchall('''
+        SELECT c.id FROM chats c
+        WHERE julianday((SELECT m.created_at FROM messages m WHERE m.chat_id = c.id ORDER BY m.seq LIMIT 1)) < julianday(?)
+    ''', (cutoff,))
+    
+    archived = 0
+    for chat in chats:
+        while True:
+            moved = await archive_chat(chat['id'], cutoff)
+            archived += moved
+            if moved < ARCHIVE_SEGMENT_MESSAGES:
+                break
+    return archived
+
+async def latest_history(chat_id, limit):
+    """Последняя страница чата: из кеша, при промахе — из БД с заполнением кеша"""
+    cached = message_cache.latest(chat_id, limit)
+    if cached is not None:
+        return cached
+    
+    token = message_cache.begin_fill(chat_id)
+    messages_list = []
+    try:
+        # Читаем сразу весь хвост, который поместится в кеш
+        messages_list, has_more = await query_history(chat_id, limit=max(limit, message_cache.per_chat))
+    finally:
+        message_cache.fill(chat_id, token, messages_list)
+    
+    return messages_list[-limit:], has_more or len(messages_list) > limit
+
 async def get_messages(request):
-    """Получить сообщения чата"""
+    """Получить страницу сообщений чата (before/after/limit)"""
     try:
         chat_id = request.match_info['chat_id']
+        before = request.query.get('before')
+        after = request.query.get('after')
         
-        cursor = await db.execute('''
-            SELECT m.id, m.chat_id, u.username as sender_username, m.type, m.text, m.file_url, m.filename, m.created_at
-            FROM messages m
-            JOIN users u ON m.sender_id = u.id
-            WHERE m.chat_id = ?
-            ORDER BY m.created_at ASC
-        ''', (chat_id,))
-        messages = await cursor.fetchall()
+        if before and after:
+            return web.json_response({'error': 'Укажите только before или after'}, status=400)
         
-        messages_list = [
-            {
-                'id': msg['id'],
-                'chat_id': msg['chat_id'],
-                'sender_username': msg['sender_username'],
-                'type': msg['type'],
-                'text': msg['text'],
-                'file_url': msg['file_url'],
-                'filename': msg['filename'],
-                'timestamp': msg['created_at'] if msg['created_at'] else None
-            }
-            for msg in messages
-        ]
+        try:
+            limit = int(request.query.get('limit', HISTORY_PAGE_SIZE))
+            before_seq = decode_cursor(before) if before else None
+            after_seq = decode_cursor(after) if after else None
+        except (ValueError, TypeError, KeyError):
+            return web.json_response({'error': 'Неверные параметры пагинации'}, status=400)
+        
+        limit = max(1, min(limit, HISTORY_MAX_PAGE_SIZE))
+        
+        if before_seq is None and after_seq is None:
+            messages_list, has_more = await latest_history(chat_id, limit)
+        else:
+            messages_list, has_more = await query_history(chat_id, before_seq, after_seq, limit)
+        
+        first = messages_list[0] if messages_list else None
+        last = messages_list[-1] if messages_list else None
         
-        return web.json_response(messages_list, status=200)
+        return web.json_response({
+            'messages': messages_list,
+            'has_more': has_more,
+            'before': encode_cursor(first['seq']) if first else before,
+            'after': encode_cursor(last['seq']) if last else after
+        }, status=200)
     except Exception as e:
         logger.error(f"Get messages error: {e}")
         return web.json_response({'error': str(e)}, status=500)
@@ -418,79 +1321,478 @@ async def send_message(request):
         
         message_id = generate_id()
         
-        cursor = await db.execute('SELECT id FROM users WHERE username = ? ', (sender_username,))
-        sender = await cursor.fetchone()
+        sender = await storage.fetchone('SELECT id FROM users WHERE username = ? ', (sender_username,))
         
         if not sender:
             return web.json_response({'error': 'Отправитель не найден'}, status=404)
         
-        await db.execute('''
-            INSERT INTO messages (id, chat_id, sender_id, type, text, file_url, filename)
-            VALUES (?, ?, ?, ?, ?, ?, ?)
-        ''', (message_id, chat_id, sender['id'], msg_type, text if text else None, file_url if file_url else None, filename if filename else None))
-        await db.commit()
+        message = await store_message(
+            message_id, chat_id, sender['id'], sender_username, msg_type,
+            text if text else None, file_url if file_url else None, filename if filename else None
+        )
         
-        message = {
-            'id': message_id,
-            'chat_id': chat_id,
-            'sender_username': sender_username,
-            'type': msg_type,
-            'text': text,
-            'file_url': file_url,
-            'filename': filename,
-            'timestamp': datetime.now().isoformat()
-        }
+        if message is None:
+            return web.json_response({'error': 'Чат не найден'}, status=404)
         
         await broadcast_to_chat(chat_id, 'new_message', message)
         
-        logger.info(f"✅ Message sent: {message_id}")
+        log_message_sent(message_id, 'rest')
         return web.json_response(message, status=201)
     except Exception as e:
         logger.error(f"Send message error: {e}")
         return web.json_response({'error': str(e)}, status=500)
 
+async def export_chat(request):
+    """Выгрузить историю чата потоком NDJSON, страница за страницей"""
+    chat_id = request.match_info['chat_id']
+    try:
+        chat = await storage.fetchone('SELECT id FROM chats WHERE id = ?', (chat_id,))
+        if not chat:
+            return web.json_response({'error': 'Чат не найден'}, status=404)
+    except Exception as e:
+        logger.error(f"Export chat error: {e}")
+        return web.json_response({'error': str(e)}, status=500)
+    
+    response = web.StreamResponse(headers={
+        'Content-Type': 'application/x-ndjson; charset=utf-8',
+        'Content-Disposition': f'attachment; filename="chat-{chat_id}.ndjson"'
+    })
+    await response.prepare(request)
+    
+    # Статус уже отправлен: при ошибке выгрузка просто обрывается
+    try:
+        cursor = 0
+        while True:
+            page, has_more = await query_history(chat_id, after_seq=cursor, limit=EXPORT_PAGE_SIZE)
+            if page:
+                await response.write(encode_lines(page))
+                cursor = page[-1]['seq']
+            if not has_more:
+                break
+        await response.write_eof()
+    except Exception as e:
+        logger.error(f"Export chat error: {e}")
+    return response
+
+async def import_chat(request):
+    """Дописать в чат историю из тела NDJSON большими транзакциями, без рассылки"""
+    try:
+        chat_id = request.match_info['chat_id']
+        
+        async def invalidate(chat_id):
+            await bus.publish('invalidate', {'chat_id': chat_id})
+        
+        # Строки режем сами: слишком длинная попадёт в отчёт, а не оборвёт импорт
+        lines = split_lines(request.content.iter_chunked(64 * 1024), IMPORT_MAX_LINE_BYTES)
+        report = await import_messages(storage, chat_id, lines, IMPORT_BATCH, invalidate)
+        
+        if report is None:
+            return web.json_response({'error': 'Чат не найден'}, status=404)
+        
+        logger.info(f"✅ Imported {report.imported} messages into {chat_id}")
+        return web.json_response(report.to_dict(), status=200)
+    except Exception as e:
+        logger.error(f"Import chat error: {e}")
+        return web.json_response({'error': str(e)}, status=500)
+
+def build_fts_query(text):
+    """Превратить пользовательский ввод в безопасный запрос FTS5:
+    каждое слово в кавычках, последнее — как префикс"""
+    terms = ['"' + term + '"' for term in text.replace('"', ' ').split()]
+    if terms:
+        terms[-1] += '*'
+    return ' '.join(terms)
+
+async def search_messages(request):
+    """Полнотекстовый поиск по сообщениям чатов пользователя"""
+    try:
+        username = request.query.get('username', '').strip()
+        query = build_fts_query(request.query.get('q', ''))
+        chat_id = request.query.get('chat_id')
+        
+        if not username or not query:
+            return web.json_response({'error': 'Укажите username и q'}, status=400)
+        
+        try:
+            limit = int(request.query.get('limit', SEARCH_PAGE_SIZE))
+            offset = int(request.query.get('offset', 0))
+        except ValueError:
+            return web.json_response({'error': 'Неверные параметры пагинации'}, status=400)
+        
+        limit = max(1, min(limit, SEARCH_MAX_PAGE_SIZE))
+        offset = max(0, offset)
+        
+        # Кандидаты идут в порядке rowid (от новых к старым) и отсекаются
+        # по SEARCH_CANDIDATES, затем сортируются по bm25
+        chat_filter = ' AND cp.chat_id = ?' if chat_id else ''
+        chat_ids = [row['chat_id'] for row in await storage.fetchall(f'''
+            SELECT cp.chat_id
+            FROM chat_participants cp
+            JOIN users me ON me.id = cp.user_id
+            WHERE me.username = ?{chat_filter}
+        ''', [username, chat_id] if chat_id else [username])]
+        if not chat_ids:
+            return web.json_response({'results': [], 'has_more': False, 'next_offset': offset})
+        
+        # Обе выборки берут первые offset + limit + 1 строк, страница режется после слияния
+        window = offset + limit + 1
+        rows = await storage.fetchall('''
+            WITH candidates AS (
+                SELECT messages_fts.rowid AS message_rowid,
+                       bm25(messages_fts) AS score,
+                       snippet(messages_fts, 0, '<mark>', '</mark>', '…', 12) AS snippet
+                FROM messages_fts
+                JOIN messages m ON m.pk = messages_fts.rowid
+                WHERE messages_fts MATCH ?
+                  AND m.chat_id IN (SELECT value FROM json_each(?))
+                ORDER BY messages_fts.rowid DESC
+                LIMIT ?
+            )
+            SELECT m.id, m.chat_id, u.username AS sender_username, m.type, m.created_at, c.score, c.snippet
+            FROM candidates c
+            JOIN messages m ON m.pk = c.message_rowid
+            JOIN users u ON u.id = m.sender_id
+            ORDER BY c.score
+            LIMIT ?
+        ''', (query, json.dumps(chat_ids), SEARCH_CANDIDATES, window))
+        # Архив ищется по своему индексу, строки сливаются по bm25
+        rows = list(rows) + await archive_index.search(query, chat_ids, SEARCH_CANDIDATES, window)
+        rows.sort(key=lambda row: row['score'])
+        rows = rows[offset:window]
+        
+        results = [
+            {
+                'id': row['id'],
+                'chat_id': row['chat_id'],
+                'sender_username': row['sender_username'],
+                'type': row['type'],
+                'snippet': row['snippet'],
+                'timestamp': row['created_at']
+            }
+            for row in rows[:limit]
+        ]
+        
+        return web.json_response({
+            'results': results,
+            'has_more': len(rows) > limit,
+            'next_offset': offset + len(results)
+        }, status=200)
+    except Exception as e:
+        logger.error(f"Search error: {e}")
+        return web.json_response({'error': str(e)}, status=500)
+
+# === МЕДИА ===
+
+def media_info(digest, size, mime):
+    return {
+        'complete': True,
+        'hash': digest,
+        'size': size,
+        'mime': mime,
+        'file_url': f'/media/{digest}'
+    }
+
+async def create_upload(request):
+    """Начать возобновляемую загрузку файла"""
+    try:
+        data = await request.json()
+        filename = data.get('filename', '')
+        mime = data.get('mime') or 'application/octet-stream'
+        digest = (data.get('sha256') or '').lower()
+        
+        try:
+            size = int(data.get('size', 0))
+        except (TypeError, ValueError):
+            size = 0
+        
+        if size <= 0 or size > MAX_UPLOAD_SIZE:
+            return web.json_response({'error': 'Недопустимый размер файла'}, status=400)
+        
+        if digest and not HASH_RE.match(digest):
+            return web.json_response({'error': 'Неверный sha256'}, status=400)
+        
+        # Такой файл уже есть — загружать его повторно не нужно
+        if digest:
+            existing = await storage.fetchone('SELECT hash, size, mime FROM media WHERE hash = ?', (digest,))
+            if existing and media_store.has_blob(digest):
+                return web.json_response(media_info(existing['hash'], existing['size'], existing['mime']), status=200)
+        
+        user = await storage.fetchone('SELECT id FROM users WHERE username = ?', (data.get('username', ''),))
+        
+        upload_id = generate_token()
+        await storage.execute(
+            'INSERT INTO uploads (id, user_id, filename, mime, size, sha256) VALUES (?, ?, ?, ?, ?, ?)',
+            (upload_id, user['id'] if user else None, filename, mime, size, digest or None)
+        )
+        
+        return web.json_response({
+            'upload_id': upload_id,
+            'offset': 0,
+            'size': size,
+            'chunk_size': UPLOAD_CHUNK_SIZE
+        }, status=201)
+    except Exception as e:
+        logger.error(f"Create upload error: {e}")
+        return web.json_response({'error': str(e)}, status=500)
+
+async def get_upload(request):
+    """Текущее смещение загрузки — клиент продолжает с него"""
+    upload_id = request.match_info['upload_id']
+    upload = await storage.fetchone('SELECT id, size FROM uploads WHERE id = ?', (upload_id,))
+    
+    if not upload:
+        return web.json_response({'error': 'Загрузка не найдена'}, status=404)
+    
+    return web.json_response({
+        'upload_id': upload_id,
+        'offset': media_store.received(upload_id),
+        'size': upload['size']
+    }, status=200)
+
+async def put_upload_chunk(request):
+    """Принять очередной кусок: тело пишется на диск потоком, без буферизации"""
+    try:
+        upload_id = request.match_info['upload_id']
+        upload = await storage.fetchone('SELECT id, mime, size, sha256 FROM uploads WHERE id = ?', (upload_id,))
+        
+        if not upload:
+            return web.json_response({'error': 'Загрузка не найдена'}, status=404)
+        
+        try:
+            offset = int(request.headers.get('Upload-Offset', request.query.get('offset', '')))
+        except ValueError:
+            return web.json_response({'error': 'Не указан Upload-Offset'}, status=400)
+        
+        try:
+            with media_store.writing(upload_id):
+                try:
+                    received = await media_store.append(upload_id, offset, upload['size'], request.content)
+                except UploadConflict as e:
+                    return web.json_response({'error': 'Неверное смещение', 'offset': e.offset}, status=409)
+                
+                if received < upload['size']:
+                    return web.json_response({'upload_id': upload_id, 'offset': received}, status=200)
+                
+                digest = await media_store.finalize(upload_id, upload['sha256'])
+        except UploadBusy:
+            return web.json_response({'error': 'Загрузка уже идёт'}, status=409)
+        except UploadMismatch as e:
+            # Файл повреждён в пути или подменён — загрузку начинают заново
+            await storage.execute('DELETE FROM uploads WHERE id = ?', (upload_id,))
+            logger.warning(f"⚠️ Upload {upload_id} hash mismatch: got {e.digest}")
+            return web.json_response({'error': 'Контрольная сумма не совпала', 'hash': e.digest}, status=422)
+        
+        await storage.executemany([
+            ('INSERT OR IGNORE INTO media (hash, size, mime) VALUES (?, ?, ?)', (digest, upload['size'], upload['mime'])),
+            ('DELETE FROM uploads WHERE id = ?', (upload_id,))
+        ])
+        
+        return web.json_response(media_info(digest, upload['size'], upload['mime']), status=200)
+    except Exception as e:
+        logger.error(f"Upload chunk error: {e}")
+        return web.json_response({'error': str(e)}, status=500)
+
+async def sweep_uploads():
+    """Удалить брошенные загрузки: давно не дописывавшиеся и так и не начатые"""
+    max_age = UPLOAD_TTL_HOURS * 3600
+    stale = media_store.stale_parts(max_age)
+    rows = await storage.fetchall(
+        "SELECT id FROM uploads WHERE created_at <= datetime('now', ?)",
+        (f'-{UPLOAD_TTL_HOURS} hours',)
+    )
+    stale.update(row['id'] for row in rows if media_store.received(row['id']) == 0 and not media_store.busy(row['id']))
+    if not stale:
+        return
+    
+    await storage.executemany([('DELETE FROM uploads WHERE id = ?', (upload_id,)) for upload_id in stale])
+    for upload_id in stale:
+        media_store.discard(upload_id)
+    logger.info(f"✅ Abandoned uploads removed: {len(stale)}")
+
+async def get_media(request):
+    """Отдать блоб: sendfile, Range и условные GET делает FileResponse"""
+    digest = request.match_info['digest']
+    
+    try:
+        path = media_store.blob_path(digest)
+    except ValueError:
+        raise web.HTTPNotFound()
+    
+    row = await storage.fetchone('SELECT mime FROM media WHERE hash = ?', (digest,))
+    if not row or not path.is_file():
+        raise web.HTTPNotFound()
+    
+    # Содержимое по этому адресу никогда не меняется
+    return web.FileResponse(path, headers={
+        'Content-Type': row['mime'] or 'application/octet-stream',
+        'Cache-Control': 'public, max-age=31536000, immutable'
+    })
+
+async def build_frontend():
+    """Собрать фронтенд в пуле потоков: сжатие brotli на максимуме небыстрое"""
+    loop = asyncio.get_running_loop()
+    renamed = await loop.run_in_executor(None, static_site.build)
+    logger.info(f"✅ Frontend built: {', '.join(renamed.values())}")
+
+async def get_index(request):
+    """index.html: ссылается на текущие версии ассетов, поэтому всегда перепроверяется"""
+    return static_site.response(request, 'index.html', REVALIDATE)
+
+async def get_asset(request):
+    """Ассет с хешем содержимого в имени: по этому адресу он не изменится никогда"""
+    name = request.match_info['name']
+    if name == 'index.html' or not static_site.has(name):
+        raise web.HTTPNotFound()
+    return static_site.response(request, name, IMMUTABLE)
+
+async def get_stats(request):
+    """Внутренние метрики сервера"""
+    return web.json_response({
+        'storage': storage.stats(),
+        'bus': bus.stats(),
+        'message_cache': message_cache.stats(),
+        'receipts': receipts.stats(),
+        'response_cache': response_cache.stats(),
+        'static': static_site.stats(),
+        'archive': compactor.stats()
+    }, status=200)
+
+async def get_metrics(request):
+    """Метрики в текстовом формате Prometheus"""
+    return web.Response(
+        body=metrics_registry.render().encode(),
+        headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+    )
+
 # === WEBSOCKET ===
 
 async def websocket_handler(request):
     """WebSocket обработчик"""
     session_id = request.match_info['session_id']
-    ws = web.WebSocketResponse()
+    user_id = await resolve_session(session_id)
+    if user_id is None:
+        # Код закрытия доходит до браузера, HTTP-статус отказа — нет
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        await ws.close(code=WS_SESSION_EXPIRED, message=b'session expired')
+        return ws
+    
+    # Отказываем до апгрейда: клиент получит обычный HTTP-ответ и переподключится позже
+    if WS_MAX_CONNECTIONS and registry.connection_count() >= WS_MAX_CONNECTIONS:
+        WS_REJECTED.labels('server').inc()
+        return too_many_requests(SHED_RETRY_AFTER, 'Слишком много соединений', 503)
+    if WS_MAX_PER_USER and registry.user_connection_count(user_id, session_id) >= WS_MAX_PER_USER:
+        WS_REJECTED.labels('user').inc()
+        return too_many_requests(SHED_RETRY_AFTER, 'Слишком много соединений пользователя')
+    
+    ws = web.WebSocketResponse(protocols=PROTOCOLS, compress=WS_COMPRESS)
     await ws.prepare(request)
     
-    active_connections[session_id] = ws
+    # Старые клиенты не просят подпротокол и получают одиночные кадры
+    batched = ws.ws_protocol in PROTOCOLS
+    conn = OutboundConnection(
+        ws, send_policy,
+        compact=ws.ws_protocol == PROTOCOL_COMPACT,
+        batch_window=WS_BATCH_WINDOW_MS / 1000 if batched else 0
+    )
+    registry.attach(session_id, user_id, conn)
     logger.info(f"✅ WebSocket connected: {session_id}")
+    violations = 0
     
     try:
         async for msg in ws:
             if msg.type == aiohttp.WSMsgType.TEXT:
                 try:
                     data = json.loads(msg.data)
-                    await handle_websocket_message(data, session_id, ws)
                 except json.JSONDecodeError:
                     logger.error("Invalid JSON received")
+                    continue
+                
+                msg_type = data.get('type')
+                retry_after = limit_ws_frame(session_id, msg_type)
+                if retry_after:
+                    RATE_LIMITED.labels('ws').inc()
+                    violations += 1
+                    if violations >= WS_MAX_VIOLATIONS:
+                        logger.warning(f"⚠️ WebSocket {session_id} closed: rate limit")
+                        await ws.close(code=aiohttp.WSCloseCode.POLICY_VIOLATION, message=b'rate limit')
+                        break
+                    conn.send_event('rate_limited', {
+                        'type': msg_type,
+                        'retry_after': round(retry_after, 3)
+                    })
+                    continue
+                violations = 0
+                await handle_websocket_message(data, session_id, conn)
             elif msg.type == aiohttp.WSMsgType.ERROR:
                 logger.error(f"WebSocket error: {ws.exception()}")
     finally:
-        active_connections.pop(session_id, None)
+        registry.detach(session_id, conn)
+        await conn.close()
+        # Последнее соединение на этом воркере закрыто; общий статус учтёт остальные воркеры
+        if not registry.is_online(user_id):
+            set_presence(user_id, 'offline')
         logger.info(f"⚠️ WebSocket disconnected: {session_id}")
     
     return ws
 
-async def handle_websocket_message(data, session_id, ws):
+async def sync_chats(session_id, conn, cursors):
+    """Дослать клиенту после переподключения только пропущенные сообщения.
+    cursors: {chat_id: последний seq, который клиент уже видел}"""
+    user_id = registry.get_user(session_id)
+    if not user_id:
+        return
+    
+    rows = await storage.fetchall('''
+        SELECT c.id, c.last_seq
+        FROM chat_participants cp
+        JOIN chats c ON c.id = cp.chat_id
+        WHERE cp.user_id = ?
+    ''', (user_id,))
+    
+    for row in rows:
+        chat_id = row['id']
+        if chat_id not in cursors:
+            continue
+        try:
+            cursor = int(cursors[chat_id])
+        except (TypeError, ValueError):
+            continue
+        
+        gap = row['last_seq'] - cursor
+        if gap <= 0:
+            continue
+        
+        # Слишком большой разрыв дешевле закрыть полной перезагрузкой чата
+        if gap > SYNC_MAX_GAP:
+            conn.send_event('resync_required', {
+                'chat_id': chat_id,
+                'last_seq': row['last_seq']
+            })
+            continue
+        
+        messages_list = message_cache.since(chat_id, cursor)
+        if messages_list is None:
+            messages_list, _ = await query_history(chat_id, after_seq=cursor, limit=gap)
+        conn.send_event('sync', {
+            'chat_id': chat_id,
+            'messages': messages_list,
+            'last_seq': row['last_seq']
+        })
+    
+    conn.send_event('sync_complete', {})
+
+async def handle_websocket_message(data, session_id, conn):
     """Обработка WebSocket сообщений"""
     msg_type = data.get('type')
     
     if msg_type == 'user_join':
-        user_id = user_sessions.get(session_id)
+        user_id = registry.get_user(session_id)
         chat_id = data.get('chat_id')
         username = data.get('username')
         
         if user_id:
-            try:
-                await db.execute('UPDATE users SET status = ? WHERE id = ?', ('online', user_id))
-                await db.commit()
-            except Exception as e:
-                logger.error(f"Status update error: {e}")
+            set_presence(user_id, 'online')
         
         await broadcast_to_chat(chat_id, 'user_joined', {
             'username': username,
@@ -498,18 +1800,14 @@ async def handle_websocket_message(data, session_id, ws):
             'timestamp': datetime.now().isoformat()
         })
         
-        logger.info(f"✅ User {username} joined chat {chat_id}")
+        logger.debug(f"✅ User {username} joined chat {chat_id}")
     
     elif msg_type == 'user_disconnect':
-        user_id = user_sessions.get(session_id)
+        user_id = registry.get_user(session_id)
         username = data.get('username')
         
         if user_id:
-            try:
-                await db.execute('UPDATE users SET status = ? WHERE id = ?', ('offline', user_id))
-                await db.commit()
-            except Exception as e:
-                logger.error(f"Status update error: {e}")
+            set_presence(user_id, 'offline')
         
         logger.info(f"⚠️ User {username} disconnected")
     
@@ -522,47 +1820,71 @@ async def handle_websocket_message(data, session_id, ws):
         try:
             message_id = generate_id()
             
-            cursor = await db.execute('SELECT id FROM users WHERE username = ?', (sender_username,))
-            sender = await cursor.fetchone()
+            sender = await storage.fetchone('SELECT id FROM users WHERE username = ?', (sender_username,))
             
+            message = None
             if sender:
-                await db.execute('''
-                    INSERT INTO messages (id, chat_id, sender_id, type, text)
-                    VALUES (?, ?, ?, ?, ?)
-                ''', (message_id, chat_id, sender['id'], message_type, text))
-                await db.commit()
+                message = await store_message(message_id, chat_id, sender['id'], sender_username, message_type, text)
             
-            message = {
-                'id': message_id,
-                'chat_id': chat_id,
-                'sender_username': sender_username,
-                'type': message_type,
-                'text': text,
-                'timestamp': datetime.now().isoformat()
-            }
+            if message is None:
+                logger.warning(f"⚠️ Message from {sender_username} to {chat_id} rejected")
+                return
+            
+            if typing_tracker.stop_typing(chat_id, sender_username):
+                await broadcast_to_chat(chat_id, 'user_typing', {
+                    'chat_id': chat_id,
+                    'username': sender_username,
+                    'is_typing': False
+                })
             
             await broadcast_to_chat(chat_id, 'new_message', message)
-            logger.info(f"✅ Message sent: {message_id}")
+            log_message_sent(message_id, 'ws')
         except Exception as e:
             logger.error(f"Send message error: {e}")
     
+    elif msg_type == 'sync':
+        await sync_chats(session_id, conn, data.get('cursors') or {})
+    
+    elif msg_type == 'mark_read':
+        user_id = registry.get_user(session_id)
+        chat_id = data.get('chat_id')
+        seq = data.get('seq')
+        if not user_id or not isinstance(seq, int):
+            return
+        
+        # Имя берём из БД, а не от клиента: его увидят остальные участники
+        participant = await storage.fetchone('''
+            SELECT u.id AS user_id, u.username, c.last_seq
+            FROM chat_participants cp
+            JOIN users u ON u.id = cp.user_id
+            JOIN chats c ON c.id = cp.chat_id
+            WHERE cp.chat_id = ? AND cp.user_id = ?
+        ''', (chat_id, user_id))
+        if participant:
+            mark_read(chat_id, participant, seq)
+    
     elif msg_type == 'typing':
         chat_id = data.get('chat_id')
         username = data.get('username')
         
-        await broadcast_to_chat(chat_id, 'user_typing', {
-            'username': username,
-            'is_typing': True
-        })
+        # Повторные typing в пределах окна троттлинга не рассылаются
+        if typing_tracker.typing(chat_id, username):
+            await broadcast_to_chat(chat_id, 'user_typing', {
+                'chat_id': chat_id,
+                'username': username,
+                'is_typing': True
+            })
     
     elif msg_type == 'stop_typing':
         chat_id = data.get('chat_id')
         username = data.get('username')
         
-        await broadcast_to_chat(chat_id, 'user_typing', {
-            'username': username,
-            'is_typing': False
-        })
+        if typing_tracker.stop_typing(chat_id, username):
+            await broadcast_to_chat(chat_id, 'user_typing', {
+                'chat_id': chat_id,
+                'username': username,
+                'is_typing': False
+            })
 
 # === ИНИЦИАЛИЗАЦИЯ ===
 
@@ -571,6 +1893,27 @@ app = web.Application()
 async def init_app():
     """Инициализация приложения"""
     await init_db()
+    await load_directory()
+    media_store.prepare()
+    if SERVE_FRONTEND:
+        await build_frontend()
+    await bus.start(deliver_from_bus)
+    await start_presence()
+    loop_lag_probe.start()
+    archive_store.prepare()
+    await archive_index.open()
+    background_tasks.append(asyncio.create_task(index_archive()))
+    if ARCHIVE_AFTER_DAYS > 0:
+        compactor.start(compact_archive)
+    start_background(SESSION_SWEEP_SECONDS, sweep_sessions, 'Session sweep')
+    start_background(UPLOAD_SWEEP_SECONDS, sweep_uploads, 'Upload sweep')
+    app.on_cleanup.append(stop_background)
+    app.on_cleanup.append(close_metrics)
+    app.on_cleanup.append(close_archive)
+    app.on_cleanup.append(stop_presence)
+    app.on_cleanup.append(close_bus)
+    app.on_cleanup.append(close_password_hasher)
+    app.on_cleanup.append(close_db)
     
     async def cors_middleware(app, handler):
         async def middleware_handler(request):
@@ -580,7 +1923,7 @@ async def init_app():
                     headers={
                         'Access-Control-Allow-Origin': '*',
                         'Access-Control-Allow-Methods': 'GET, POST, PUT, DELETE, OPTIONS',
-                        'Access-Control-Allow-Headers': 'Content-Type',
+                        'Access-Control-Allow-Headers': 'Content-Type, Upload-Offset, X-Session-Id',
                     }
                 )
             response = await handler(request)
@@ -588,22 +1931,84 @@ async def init_app():
             return response
         return middleware_handler
     
+    async def metrics_middleware(app, handler):
+        async def middleware_handler(request):
+            started = time.perf_counter()
+            response = None
+            status = 500
+            try:
+                response = await handler(request)
+                status = response.status
+                return response
+            except web.HTTPException as e:
+                status = e.status
+                raise
+            finally:
+                # Для WebSocket это время жизни соединения, а не запроса
+                if not isinstance(response, web.WebSocketResponse):
+                    resource = request.match_info.route.resource
+                    route = resource.canonical if resource else 'unmatched'
+                    HTTP_REQUEST_SECONDS.labels(request.method, route, str(status)).observe(
+                        time.perf_counter() - started
+                    )
+        return middleware_handler
+    
+    async def admission_middleware(app, handler):
+        async def middleware_handler(request):
+            resource = request.match_info.route.resource
+            route = resource.canonical if resource else None
+            if route is None or route in SHED_EXEMPT_ROUTES:
+                return await handler(request)
+            
+            reason = admission.overloaded()
+            if reason:
+                LOAD_SHED.labels(reason).inc()
+                return too_many_requests(SHED_RETRY_AFTER, 'Сервер перегружен, повторите позже', 503)
+            
+            rule = RATE_LIMIT_ROUTES.get(route, RATE_LIMIT_REST)
+            if RATE_LIMIT_ENABLED and rule is not None:
+                retry_after = rate_limiter.acquire((await rate_limit_key(request), route), rule)
+                if retry_after:
+                    RATE_LIMITED.labels('rest').inc()
+                    return too_many_requests(retry_after)
+            return await handler(request)
+        return middleware_handler
+    
+    app.middlewares.append(metrics_middleware)
     app.middlewares.append(cors_middleware)
+    app.middlewares.append(admission_middleware)
     
     # Маршруты
     app.router.add_post('/api/users/register', register)
     app.router.add_post('/api/users/login', login)
     app.router.add_get('/api/users', get_all_users)
     app.router.add_get('/api/users/{username}', search_user)
+    app.router.add_get('/api/autocomplete/users', autocomplete_users)
     app.router.add_post('/api/chats/create', create_chat)
     app.router.add_get('/api/chats/{username}', get_user_chats)
+    app.router.add_post('/api/chats/{chat_id}/read', mark_chat_read)
+    app.router.add_get('/api/chats/{chat_id}/export', export_chat)
+    app.router.add_post('/api/chats/{chat_id}/import', import_chat)
     app.router.add_get('/api/messages/{chat_id}', get_messages)
     app.router.add_post('/api/messages/{chat_id}', send_message)
+    app.router.add_get('/api/search', search_messages)
+    app.router.add_post('/api/uploads', create_upload)
+    app.router.add_get('/api/uploads/{upload_id}', get_upload)
+    app.router.add_put('/api/uploads/{upload_id}', put_upload_chunk)
+    app.router.add_get('/media/{digest}', get_media)
+    app.router.add_get('/api/stats', get_stats)
+    app.router.add_get('/metrics', get_metrics)
     app.router.add_get('/ws/{session_id}', websocket_handler)
+    if SERVE_FRONTEND:
+        app.router.add_get('/', get_index)
+        app.router.add_get('/assets/{name}', get_asset)
     
     return app
 
 # === ЗАПУСК ===
+# Один процесс: python app.py
+# Несколько воркеров (EVENT_BUS=sqlite):
+#   gunicorn app:init_app --worker-class aiohttp.GunicornWebWorker -w 4 --bind 0.0.0.0:5000
 
 async def main():
     app = await init_app()
@@ -0,0 +1,322 @@
+import asyncio
+import bisect
+import json
+import logging
+import mmap
+import os
+import sqlite3
+import struct
+import time
+import uuid
+import zlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from metrics import registry as metrics
+
+logger = logging.getLogger(__name__)
+
+# Формат сегмента:
+#   [блок 0][блок 1]...[индекс][трейлер]
+# блок    — zlib(JSON-массив сообщений по возрастанию seq)
+# индекс  — на каждый блок (first_seq, смещение, длина)
+# трейлер — магия, версия, смещение индекса, число блоков
+MAGIC = b'MSEG'
+VERSION = 1
+INDEX_ENTRY = struct.Struct('<qQI')
+TRAILER = struct.Struct('<4sBQI')
+
+ARCHIVE_READ_SECONDS = metrics.histogram(
+    'messenger_archive_read_seconds', 'Reading a message range from an archive segment'
+)
+ARCHIVE_MESSAGES = metrics.counter(
+    'messenger_archive_messages_total', 'Messages moved from SQLite into archive segments'
+)
+
+
+def write_segment(path, messages, block_messages=64):
+    """Записать сегмент атомарно; вернуть размер файла"""
+    tmp = path.with_suffix('.tmp')
+    index = []
+    with open(tmp, 'wb') as f:
+        for start in range(0, len(messages), block_messages):
+            block = messages[start:start + block_messages]
+            payload = zlib.compress(json.dumps(block, separators=(',', ':')).encode(), 6)
+            index.append((block[0]['seq'], f.tell(), len(payload)))
+            f.write(payload)
+        index_offset = f.tell()
+        for entry in index:
+            f.write(INDEX_ENTRY.pack(*entry))
+        f.write(TRAILER.pack(MAGIC, VERSION, index_offset, len(index)))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+    return path.stat().st_size
+
+
+class Segment:
+    """Открытый через mmap сегмент: индекс в памяти, блоки читаются по требованию"""
+
+    def __init__(self, path):
+        self._file = open(path, 'rb')
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, index_offset, count = TRAILER.unpack_from(self._map, len(self._map) - TRAILER.size)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f'Not an archive segment: {path}')
+        self._blocks = [
+            INDEX_ENTRY.unpack_from(self._map, index_offset + i * INDEX_ENTRY.size)
+            for i in range(count)
+        ]
+        self._first_seqs = [entry[0] for entry in self._blocks]
+
+    def _block(self, i):
+        _, offset, length = self._blocks[i]
+        return json.loads(zlib.decompress(self._map[offset:offset + length]))
+
+    def read(self, low, high, limit, descending=False):
+        """До limit сообщений с low <= seq <= high, с нужного конца диапазона"""
+        first = max(0, bisect.bisect_right(self._first_seqs, low) - 1)
+        last = bisect.bisect_right(self._first_seqs, high) - 1
+        order = range(last, first - 1, -1) if descending else range(first, last + 1)
+
+        result = []
+        for i in order:
+            block = [m for m in self._block(i) if low <= m['seq'] <= high]
+            if descending:
+                block.reverse()
+            result.extend(block)
+            if len(result) >= limit:
+                break
+        return result[:limit]
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+
+class ArchiveStore:
+    """Файлы сегментов на диске и LRU открытых отображений.
+    Отображения трогает только один поток, чтобы вытеснение не закрыло
+    сегмент посреди чтения"""
+
+    def __init__(self, root, block_messages=64, open_segments=64):
+        self.root = Path(root)
+        self.block_messages = block_messages
+        self.open_segments = open_segments
+        self._segments = OrderedDict()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='archive')
+
+    def prepare(self):
+        self.root.mkdir(parents=True, exist_ok=True)
+
+    def new_path(self, chat_id, first_seq, last_seq):
+        """Относительный путь нового сегмента; суффикс исключает гонку воркеров.
+        Каталог первого уровня — по последним символам id: у ULID первые
+        символы — время, и все новые чаты попали бы в один каталог"""
+        return f'{chat_id[-2:]}/{chat_id}/{first_seq:012d}-{last_seq:012d}-{uuid.uuid4().hex[:8]}.seg'
+
+    async def write(self, relative, messages):
+        path = self.root / relative
+        loop = asyncio.get_running_loop()
+
+        def write():
+            path.parent.mkdir(parents=True, exist_ok=True)
+            return write_segment(path, messages, self.block_messages)
+
+        return await loop.run_in_executor(None, write)
+
+    async def discard(self, relative):
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self._executor, self._discard, relative)
+
+    def _discard(self, relative):
+        self._close(relative)
+        (self.root / relative).unlink(missing_ok=True)
+
+    async def read(self, relative, low, high, limit, descending=False):
+        loop = asyncio.get_running_loop()
+        started = time.perf_counter()
+        try:
+            return await loop.run_in_executor(self._executor, self._read, relative, low, high, limit, descending)
+        finally:
+            ARCHIVE_READ_SECONDS.observe(time.perf_counter() - started)
+
+    def _read(self, relative, low, high, limit, descending):
+        return self._open(relative).read(low, high, limit, descending)
+
+    def _open(self, relative):
+        segment = self._segments.get(relative)
+        if segment is not None:
+            self._segments.move_to_end(relative)
+            return segment
+        segment = self._segments[relative] = Segment(self.root / relative)
+        while len(self._segments) > self.open_segments:
+            _, old = self._segments.popitem(last=False)
+            old.close()
+        return segment
+
+    def _close(self, relative):
+        segment = self._segments.pop(relative, None)
+        if segment is not None:
+            segment.close()
+
+    async def close(self):
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self._executor, self._close_all)
+        self._executor.shutdown(wait=False)
+
+    def _close_all(self):
+        for segment in self._segments.values():
+            segment.close()
+        self._segments.clear()
+
+
+class ArchiveIndex:
+    """Полнотекстовый индекс архива в собственном файле SQLite рядом с сегментами.
+
+    Текст архивных сообщений не возвращается в живую базу: индекс хранит
+    свою копию, а при потере восстанавливается из сегментов. Сегмент
+    индексируется один раз — повторный add() с тем же путём ничего не делает"""
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self._conn = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='archive-index')
+
+    async def open(self):
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self._executor, self._open)
+
+    def _open(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        conn = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        conn.execute('PRAGMA journal_mode = WAL')
+        conn.execute('PRAGMA busy_timeout = 30000')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS indexed_segments (
+                path TEXT PRIMARY KEY,
+                message_count INTEGER NOT NULL
+            )
+        ''')
+        conn.execute('''
+            CREATE VIRTUAL TABLE IF NOT EXISTS archive_fts USING fts5(
+                text,
+                id UNINDEXED,
+                chat_id UNINDEXED,
+                sender_username UNINDEXED,
+                type UNINDEXED,
+                created_at UNINDEXED,
+                tokenize = 'unicode61 remove_diacritics 2'
+            )
+        ''')
+        self._conn = conn
+
+    async def _run(self, fn, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, fn, *args)
+
+    async def indexed(self):
+        """Пути уже проиндексированных сегментов"""
+        return await self._run(self._indexed)
+
+    def _indexed(self):
+        return {row['path'] for row in self._conn.execute('SELECT path FROM indexed_segments')}
+
+    async def add(self, relative, messages):
+        """Проиндексировать сообщения сегмента; False — он уже в индексе"""
+        return await self._run(self._add, relative, messages)
+
+    def _add(self, relative, messages):
+        conn = self._conn
+        # Несколько воркеров могут индексировать один сегмент одновременно
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            added = conn.execute(
+                'INSERT OR IGNORE INTO indexed_segments (path, message_count) VALUES (?, ?)',
+                (relative, len(messages))
+            ).rowcount
+            if added:
+                conn.executemany('''
+                    INSERT INTO archive_fts (text, id, chat_id, sender_username, type, created_at)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                ''', [
+                    (m['text'], m['id'], m['chat_id'], m['sender_username'], m['type'], m['timestamp'])
+                    for m in messages if m['text'] is not None
+                ])
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        return bool(added)
+
+    async def search(self, query, chat_ids, candidates, limit):
+        """Совпадения в чатах chat_ids: из candidates самых новых — limit лучших по bm25"""
+        return await self._run(self._search, query, list(chat_ids), candidates, limit)
+
+    def _search(self, query, chat_ids, candidates, limit):
+        rows = self._conn.execute('''
+            WITH candidates AS (
+                SELECT id, chat_id, sender_username, type, created_at,
+                       bm25(archive_fts) AS score,
+                       snippet(archive_fts, 0, '<mark>', '</mark>', '…', 12) AS snippet
+                FROM archive_fts
+                WHERE archive_fts MATCH ?
+                  AND chat_id IN (SELECT value FROM json_each(?))
+                ORDER BY rowid DESC
+                LIMIT ?
+            )
+            SELECT * FROM candidates
+            ORDER BY score
+            LIMIT ?
+        ''', (query, json.dumps(chat_ids), candidates, limit))
+        return [dict(row) for row in rows]
+
+    async def close(self):
+        if self._conn is not None:
+            await self._run(self._conn.close)
+            self._conn = None
+        self._executor.shutdown(wait=False)
+
+
+class Compactor:
+    """Фоновый перенос старой истории в архив раз в интервал"""
+
+    def __init__(self, interval=3600.0):
+        self.interval = interval
+        self._compact = None
+        self._task = None
+        self.runs = 0
+        self.archived = 0
+
+    def start(self, compact):
+        """compact() — корутина одного прохода; возвращает число перенесённых сообщений"""
+        self._compact = compact
+        self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                archived = await self._compact()
+            except Exception as e:
+                logger.error(f"Archive compaction error: {e}")
+                continue
+            self.runs += 1
+            self.archived += archived
+            ARCHIVE_MESSAGES.inc(archived)
+            if archived:
+                logger.info(f"✅ Archived {archived} messages")
+
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def stats(self):
+        return {'runs': self.runs, 'archived': self.archived}
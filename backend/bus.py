@@ -0,0 +1,244 @@
+import asyncio
+import json
+import logging
+import sqlite3
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+
+class InProcessBus:
+    """Шина для одного процесса: публикация сразу доставляется локально"""
+
+    def __init__(self):
+        self.worker_id = uuid.uuid4().hex
+        self._handler = None
+        self.published = 0
+
+    async def start(self, handler):
+        """handler(channel, message) — корутина доставки локальным сокетам"""
+        self._handler = handler
+
+    async def publish(self, channel, message):
+        self.published += 1
+        await self._handler(channel, message)
+
+    async def close(self):
+        pass
+
+    def stats(self):
+        return {'backend': 'memory', 'published': self.published}
+
+
+class SQLiteBus:
+    """Шина между воркерами на одной машине через отдельный файл SQLite.
+
+    Публикация доставляется локально сразу и пишется в таблицу;
+    остальные воркеры опрашивают её по возрастающему id. Записи,
+    накопившиеся за время предыдущей вставки, уходят одной транзакцией.
+
+    Каждый воркер отмечается в bus_workers раз в heartbeat_interval.
+    Воркер, молчащий дольше worker_timeout, считается упавшим: заметивший
+    это публикует worker_down. Если отметку самого воркера успели удалить,
+    ему локально приходит worker_rejoined — пора заново заявить о себе."""
+
+    def __init__(self, path, poll_interval=0.02, retention=60.0, heartbeat_interval=2.0, worker_timeout=10.0):
+        self.path = path
+        self.poll_interval = poll_interval
+        self.retention = retention
+        self.heartbeat_interval = heartbeat_interval
+        self.worker_timeout = worker_timeout
+        self.worker_id = uuid.uuid4().hex
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='event-bus')
+        self._conn = None
+        self._handler = None
+        self._task = None
+        self._flusher = None
+        self._pending = []
+        self._wakeup = asyncio.Event()
+        self._last_id = 0
+        self.published = 0
+        self.received = 0
+        self.batches = 0
+
+    async def start(self, handler):
+        self._handler = handler
+        loop = asyncio.get_running_loop()
+        self._last_id = await loop.run_in_executor(self._executor, self._connect)
+        self._task = asyncio.create_task(self._run())
+        self._flusher = asyncio.create_task(self._flush_loop())
+        logger.info(f"✅ SQLite event bus started: {self.path}")
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False, timeout=30)
+        conn.execute('PRAGMA journal_mode = WAL')
+        # События эфемерны: долговечность не нужна
+        conn.execute('PRAGMA synchronous = OFF')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS bus_events (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                origin TEXT NOT NULL,
+                channel TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                created_at REAL NOT NULL
+            )
+        ''')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS bus_workers (
+                worker_id TEXT PRIMARY KEY,
+                seen_at REAL NOT NULL
+            )
+        ''')
+        conn.execute('INSERT INTO bus_workers (worker_id, seen_at) VALUES (?, ?)', (self.worker_id, time.time()))
+        self._conn = conn
+        # Начинаем с текущего конца журнала: старые события не воспроизводим
+        row = conn.execute('SELECT COALESCE(MAX(id), 0) FROM bus_events').fetchone()
+        return row[0]
+
+    async def publish(self, channel, message):
+        """Доставить локально сразу; в таблицу событие попадёт со следующей пачкой"""
+        self.published += 1
+        self._pending.append((channel, json.dumps(message)))
+        self._wakeup.set()
+        await self._handler(channel, message)
+
+    async def _flush_loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            await self._flush(loop)
+
+    async def _flush(self, loop):
+        if not self._pending:
+            return
+        events, self._pending = self._pending, []
+        try:
+            await loop.run_in_executor(self._executor, self._insert, events)
+            self.batches += 1
+        except Exception as e:
+            logger.error(f"Event bus publish error: {e}")
+
+    def _insert(self, events):
+        now = time.time()
+        self._conn.execute('BEGIN')
+        try:
+            self._conn.executemany(
+                'INSERT INTO bus_events (origin, channel, payload, created_at) VALUES (?, ?, ?, ?)',
+                [(self.worker_id, channel, payload, now) for channel, payload in events]
+            )
+            self._conn.execute('COMMIT')
+        except Exception:
+            self._conn.execute('ROLLBACK')
+            raise
+
+    def _heartbeat(self):
+        """Отметиться и забрать отметки молчащих воркеров.
+        Вернуть (нашу отметку удалили, [упавшие воркеры])"""
+        now = time.time()
+        rejoined = not self._conn.execute(
+            'UPDATE bus_workers SET seen_at = ? WHERE worker_id = ?', (now, self.worker_id)
+        ).rowcount
+        if rejoined:
+            self._conn.execute('INSERT INTO bus_workers (worker_id, seen_at) VALUES (?, ?)', (self.worker_id, now))
+        deadline = now - self.worker_timeout
+        stale = [row[0] for row in self._conn.execute(
+            'SELECT worker_id FROM bus_workers WHERE seen_at < ?', (deadline,)
+        )]
+        # Удаление — захват: о падении сообщает только один воркер
+        gone = [
+            worker_id for worker_id in stale
+            if self._conn.execute(
+                'DELETE FROM bus_workers WHERE worker_id = ? AND seen_at < ?', (worker_id, deadline)
+            ).rowcount
+        ]
+        return rejoined, gone
+
+    async def _check_workers(self, loop):
+        rejoined, gone = await loop.run_in_executor(self._executor, self._heartbeat)
+        if rejoined:
+            logger.warning("⚠️ Event bus heartbeat was lost, rejoining")
+            await self._handler('worker_rejoined', {'worker_id': self.worker_id})
+        for worker_id in gone:
+            logger.warning(f"⚠️ Worker {worker_id} stopped sending heartbeats")
+            await self.publish('worker_down', {'worker_id': worker_id, 'reported_by': self.worker_id})
+
+    def _poll(self, last_id):
+        return self._conn.execute(
+            'SELECT id, origin, channel, payload FROM bus_events WHERE id > ? ORDER BY id LIMIT 1000',
+            (last_id,)
+        ).fetchall()
+
+    def _prune(self):
+        self._conn.execute('DELETE FROM bus_events WHERE created_at < ?', (time.time() - self.retention,))
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        last_prune = last_heartbeat = time.monotonic()
+        while True:
+            rows = []
+            try:
+                rows = await loop.run_in_executor(self._executor, self._poll, self._last_id)
+                for event_id, origin, channel, payload in rows:
+                    self._last_id = event_id
+                    if origin == self.worker_id:
+                        continue
+                    self.received += 1
+                    await self._handler(channel, json.loads(payload))
+
+                if time.monotonic() - last_heartbeat > self.heartbeat_interval:
+                    last_heartbeat = time.monotonic()
+                    await self._check_workers(loop)
+
+                if time.monotonic() - last_prune > self.retention:
+                    last_prune = time.monotonic()
+                    await loop.run_in_executor(self._executor, self._prune)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Event bus poll error: {e}")
+
+            if not rows:
+                await asyncio.sleep(self.poll_interval)
+
+    async def close(self):
+        for task in (self._task, self._flusher):
+            if task:
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+        self._task = self._flusher = None
+        if self._conn:
+            loop = asyncio.get_running_loop()
+            await self._flush(loop)
+            # Штатная остановка — не повод объявлять воркер упавшим
+            await loop.run_in_executor(
+                self._executor, self._conn.execute, 'DELETE FROM bus_workers WHERE worker_id = ?', (self.worker_id,)
+            )
+            await loop.run_in_executor(self._executor, self._conn.close)
+            self._conn = None
+        self._executor.shutdown(wait=False)
+
+    def stats(self):
+        return {
+            'backend': 'sqlite',
+            'worker_id': self.worker_id,
+            'published': self.published,
+            'received': self.received,
+            'batches': self.batches,
+            'pending': len(self._pending),
+            'last_id': self._last_id,
+        }
+
+
+def create_bus(backend, path=None, poll_interval=0.02, heartbeat_interval=2.0, worker_timeout=10.0):
+    """Создать шину по имени бэкенда из конфигурации"""
+    if backend == 'memory':
+        return InProcessBus()
+    if backend == 'sqlite':
+        return SQLiteBus(path, poll_interval, heartbeat_interval=heartbeat_interval, worker_timeout=worker_timeout)
+    raise ValueError(f'Unknown event bus backend: {backend}')
@@ -0,0 +1,164 @@
+from collections import OrderedDict, deque
+
+# Грубая оценка накладных расходов на словарь сообщения и его ключи
+MESSAGE_OVERHEAD = 600
+
+
+def message_size(message):
+    """Приблизительный размер сообщения в памяти, байт"""
+    size = MESSAGE_OVERHEAD
+    for value in message.values():
+        if isinstance(value, str):
+            size += len(value)
+    return size
+
+
+class ChatTail:
+    """Непрерывный хвост истории одного чата, упорядоченный по seq"""
+
+    __slots__ = ('messages', 'bytes')
+
+    def __init__(self):
+        self.messages = deque()
+        self.bytes = 0
+
+    @property
+    def first_seq(self):
+        return self.messages[0]['seq'] if self.messages else None
+
+    @property
+    def last_seq(self):
+        return self.messages[-1]['seq'] if self.messages else None
+
+
+class MessageCache:
+    """Последние сообщения активных чатов в памяти.
+
+    На каждый чат — кольцевой буфер из per_chat сообщений; чаты вытесняются
+    по LRU, когда суммарный объём превышает max_bytes. Хвост всегда непрерывен
+    по seq: пропуск номера означает, что кеш отстал, и хвост сбрасывается."""
+
+    def __init__(self, per_chat=100, max_bytes=32 * 1024 ** 2):
+        self.per_chat = per_chat
+        self.max_bytes = max_bytes
+        self._chats = OrderedDict()
+        # chat_id -> [незавершённых чтений из БД, записей за время чтений]
+        self._inflight = {}
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.fills = 0
+        self.invalidations = 0
+        self.evictions = 0
+
+    # === ЧТЕНИЕ ===
+
+    def latest(self, chat_id, limit):
+        """Последние limit сообщений и признак has_more; None — промах"""
+        tail = self._chats.get(chat_id)
+        if tail is None or not self._covers(tail, limit):
+            self.misses += 1
+            return None
+        self._chats.move_to_end(chat_id)
+        self.hits += 1
+        messages = list(tail.messages)[-limit:]
+        return messages, messages[0]['seq'] > 1
+
+    def since(self, chat_id, seq):
+        """Все сообщения новее seq; None — кеш начинается позже"""
+        tail = self._chats.get(chat_id)
+        if tail is None or tail.first_seq > seq + 1:
+            self.misses += 1
+            return None
+        self._chats.move_to_end(chat_id)
+        self.hits += 1
+        return [m for m in tail.messages if m['seq'] > seq]
+
+    def _covers(self, tail, limit):
+        # Либо хватает сообщений, либо в хвосте вся история с первого
+        return len(tail.messages) >= limit or tail.first_seq == 1
+
+    # === ЗАПОЛНЕНИЕ ===
+
+    def begin_fill(self, chat_id):
+        """Отметить начало чтения из БД; вернуть токен для fill"""
+        state = self._inflight.setdefault(chat_id, [0, 0])
+        state[0] += 1
+        return state[1]
+
+    def fill(self, chat_id, token, messages):
+        """Положить прочитанную из БД последнюю страницу чата.
+        Если за время чтения в чат писали, страница могла устареть — отбрасываем"""
+        state = self._inflight[chat_id]
+        state[0] -= 1
+        if state[0] == 0:
+            del self._inflight[chat_id]
+        if state[1] != token or not messages or chat_id in self._chats:
+            return
+
+        tail = ChatTail()
+        for message in messages[-self.per_chat:]:
+            self._push(tail, message)
+        self._chats[chat_id] = tail
+        self.fills += 1
+        self._evict()
+
+    def append(self, message):
+        """Write-through: новое сообщение после коммита"""
+        chat_id = message['chat_id']
+        state = self._inflight.get(chat_id)
+        if state is not None:
+            state[1] += 1
+
+        tail = self._chats.get(chat_id)
+        if tail is None:
+            return
+        if message['seq'] <= tail.last_seq:
+            return
+        if message['seq'] != tail.last_seq + 1:
+            # Пропустили сообщение (например, с другого воркера) — хвост ненадёжен
+            self.invalidate(chat_id)
+            return
+
+        self._push(tail, message)
+        while len(tail.messages) > self.per_chat:
+            old = tail.messages.popleft()
+            size = message_size(old)
+            tail.bytes -= size
+            self.bytes -= size
+        self._chats.move_to_end(chat_id)
+        self._evict()
+
+    def invalidate(self, chat_id):
+        tail = self._chats.pop(chat_id, None)
+        if tail is not None:
+            self.bytes -= tail.bytes
+            self.invalidations += 1
+
+    def _push(self, tail, message):
+        size = message_size(message)
+        tail.messages.append(message)
+        tail.bytes += size
+        self.bytes += size
+
+    def _evict(self):
+        while self.bytes > self.max_bytes and self._chats:
+            _, tail = self._chats.popitem(last=False)
+            self.bytes -= tail.bytes
+            self.evictions += 1
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'chats': len(self._chats),
+            'messages': sum(len(tail.messages) for tail in self._chats.values()),
+            'bytes': self.bytes,
+            'max_bytes': self.max_bytes,
+            'per_chat': self.per_chat,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / lookups, 4) if lookups else None,
+            'fills': self.fills,
+            'invalidations': self.invalidations,
+            'evictions': self.evictions,
+        }
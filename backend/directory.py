@@ -0,0 +1,43 @@
+import bisect
+
+
+class UserDirectory:
+    """Отсортированный по username список пользователей для автодополнения.
+
+    Поиск по префиксу — bisect и линейный проход не дальше limit записей,
+    без обращения к SQLite. Регистр не учитывается."""
+
+    def __init__(self):
+        # Параллельные массивы: ключи для bisect и записи (username, id, avatar)
+        self._keys = []
+        self._users = []
+
+    def load(self, rows):
+        """Построить индекс из строк (id, username, avatar) целиком"""
+        users = sorted(((row[1].lower(), row[1], row[0], row[2]) for row in rows))
+        self._keys = [user[0] for user in users]
+        self._users = [user[1:] for user in users]
+
+    def add(self, user_id, username, avatar):
+        key = username.lower()
+        index = bisect.bisect_left(self._keys, key)
+        # Повтор события (например, с шины) не должен дублировать запись
+        while index < len(self._keys) and self._keys[index] == key:
+            if self._users[index][1] == user_id:
+                return
+            index += 1
+        self._keys.insert(index, key)
+        self._users.insert(index, (username, user_id, avatar))
+
+    def prefix(self, query, limit):
+        """До limit пользователей, чьё имя начинается с query"""
+        key = query.lower()
+        index = bisect.bisect_left(self._keys, key)
+        result = []
+        while index < len(self._keys) and len(result) < limit and self._keys[index].startswith(key):
+            result.append(self._users[index])
+            index += 1
+        return result
+
+    def __len__(self):
+        return len(self._keys)
@@ -0,0 +1,207 @@
+import asyncio
+import json
+import logging
+
+from aiohttp import WSCloseCode
+
+from metrics import registry as metrics
+
+logger = logging.getLogger(__name__)
+
+# События, которые можно выбросить без потери данных
+EPHEMERAL_EVENTS = frozenset({'user_typing'})
+
+# Подпротоколы (Sec-WebSocket-Protocol): события пачками в одном кадре,
+# для compact — ещё и короткие ключи. Клиент без подпротокола получает
+# прежние одиночные кадры
+PROTOCOL_BATCH = 'messenger.v2'
+PROTOCOL_COMPACT = 'messenger.v2.compact'
+PROTOCOLS = (PROTOCOL_COMPACT, PROTOCOL_BATCH)
+
+# Короткие ключи компактной кодировки; null-поля в ней опускаются
+COMPACT_KEYS = {
+    'type': 't',
+    'data': 'd',
+    'id': 'i',
+    'chat_id': 'c',
+    'seq': 's',
+    'sender_username': 'su',
+    'text': 'x',
+    'file_url': 'f',
+    'filename': 'fn',
+    'timestamp': 'ts',
+    'username': 'un',
+    'status': 'st',
+    'is_typing': 'it',
+    'messages': 'm',
+    'last_seq': 'ls',
+}
+EXPANDED_KEYS = {short: key for key, short in COMPACT_KEYS.items()}
+
+FANOUT_RECIPIENTS = metrics.histogram(
+    'messenger_fanout_recipients', 'Local sockets an event was fanned out to', ('event',),
+    buckets=(0, 1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+)
+WS_FRAMES_DROPPED = metrics.counter(
+    'messenger_ws_frames_dropped_total', 'Outbound frames not queued for a socket', ('reason',)
+)
+WS_SEND_FAILURES = metrics.counter(
+    'messenger_ws_send_failures_total', 'WebSocket writes that raised'
+)
+WS_BATCH_EVENTS = metrics.histogram(
+    'messenger_ws_batch_events', 'Events coalesced into one WebSocket frame',
+    buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256)
+)
+
+
+def compact_value(value):
+    if isinstance(value, dict):
+        return {COMPACT_KEYS.get(k, k): compact_value(v) for k, v in value.items() if v is not None}
+    if isinstance(value, list):
+        return [compact_value(v) for v in value]
+    return value
+
+
+def expand_value(value):
+    """Обратное преобразование компактной кодировки (для клиентов на Python)"""
+    if isinstance(value, dict):
+        return {EXPANDED_KEYS.get(k, k): expand_value(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [expand_value(v) for v in value]
+    return value
+
+
+def encode_event(event_type, data, compact=False):
+    """Сериализовать событие один раз для всех получателей"""
+    if compact:
+        return json.dumps(
+            compact_value({'type': event_type, 'data': data}),
+            separators=(',', ':'), ensure_ascii=False
+        )
+    return json.dumps({'type': event_type, 'data': data})
+
+
+def encode_batch(frames, compact=False):
+    """Склеить уже сериализованные события в один кадр без повторного json.dumps"""
+    if compact:
+        return '{"t":"batch","d":[' + ','.join(frames) + ']}'
+    return '{"type": "batch", "data": [' + ', '.join(frames) + ']}'
+
+
+class SlowConsumerPolicy:
+    """Политика для клиентов, которые не успевают читать"""
+
+    def __init__(self, max_queue=256, ephemeral_watermark=64):
+        # При заполнении очереди до ephemeral_watermark эфемерные события
+        # (typing) выбрасываются, при полной очереди клиент отключается
+        self.max_queue = max_queue
+        self.ephemeral_watermark = min(ephemeral_watermark, max_queue)
+
+
+class OutboundConnection:
+    """Ограниченная исходящая очередь и отдельная задача-писатель для WebSocket.
+    При batch_window > 0 события, накопившиеся за окно, уходят одним кадром"""
+
+    def __init__(self, ws, policy, compact=False, batch_window=0.0):
+        self.ws = ws
+        self.policy = policy
+        self.compact = compact
+        self.batch_window = batch_window
+        self.dropped = 0
+        self._queue = asyncio.Queue(maxsize=policy.max_queue)
+        # Клиент отключён за отставание или запись в сокет упала — кадры больше не принимаются
+        self._stopped = False
+        self._closing = None
+        self._task = asyncio.create_task(self._writer())
+
+    @property
+    def closed(self):
+        return self._stopped or self.ws.closed
+
+    def enqueue(self, frame, ephemeral=False):
+        """Поставить готовый кадр в очередь; False — кадр не принят"""
+        if self.closed:
+            return False
+
+        size = self._queue.qsize()
+        if ephemeral and size >= self.policy.ephemeral_watermark:
+            self.dropped += 1
+            WS_FRAMES_DROPPED.labels('ephemeral').inc()
+            return False
+
+        if size >= self.policy.max_queue:
+            WS_FRAMES_DROPPED.labels('slow_consumer').inc()
+            self._evict()
+            return False
+
+        self._queue.put_nowait(frame)
+        return True
+
+    def send_event(self, event_type, data, ephemeral=False):
+        """Поставить в очередь событие в кодировке этого соединения"""
+        return self.enqueue(encode_event(event_type, data, self.compact), ephemeral)
+
+    def _evict(self):
+        """Отключить клиента, который безнадёжно отстал"""
+        self._stopped = True
+        logger.warning(f"⚠️ Slow consumer disconnected, queue size {self._queue.qsize()}")
+        # Ссылка держит задачу от сборщика мусора, колбэк не теряет её ошибку
+        self._closing = asyncio.create_task(self.ws.close(
+            code=WSCloseCode.TRY_AGAIN_LATER,
+            message=b'slow consumer'
+        ))
+        self._closing.add_done_callback(log_close_error)
+
+    async def _writer(self):
+        while True:
+            frame = await self._queue.get()
+            if self.batch_window:
+                # Даём набежать остальным событиям окна и отправляем их разом
+                await asyncio.sleep(self.batch_window)
+                frames = [frame]
+                while not self._queue.empty():
+                    frames.append(self._queue.get_nowait())
+                WS_BATCH_EVENTS.observe(len(frames))
+                if len(frames) > 1:
+                    frame = encode_batch(frames, self.compact)
+            if self.ws.closed:
+                return
+            try:
+                await self.ws.send_str(frame)
+            except Exception as e:
+                WS_SEND_FAILURES.inc()
+                logger.error(f"Error sending message: {e}")
+                self._stopped = True
+                return
+
+    async def close(self):
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        if self._closing is not None:
+            await asyncio.gather(self._closing, return_exceptions=True)
+
+
+def log_close_error(task):
+    if not task.cancelled() and task.exception() is not None:
+        logger.error(f"Error closing slow consumer: {task.exception()}")
+
+
+def fan_out(connections, event_type, data):
+    """Разослать событие: одна сериализация, без ожидания медленных клиентов"""
+    # Не больше одной сериализации на кодировку
+    frames = {}
+    ephemeral = event_type in EPHEMERAL_EVENTS
+    delivered = 0
+    for conn in connections:
+        if conn.closed:
+            continue
+        frame = frames.get(conn.compact)
+        if frame is None:
+            frame = frames[conn.compact] = encode_event(event_type, data, conn.compact)
+        if conn.enqueue(frame, ephemeral):
+            delivered += 1
+    FANOUT_RECIPIENTS.labels(event_type).observe(delivered)
+    return delivered
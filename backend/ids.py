@@ -0,0 +1,51 @@
+import os
+import threading
+import time
+import uuid
+
+# Crockford base32: без I, L, O, U, чтобы id не путались при чтении
+ALPHABET = '0123456789ABCDEFGHJKMNPQRSTVWXYZ'
+RANDOM_BITS = 80
+RANDOM_MAX = (1 << RANDOM_BITS) - 1
+
+_lock = threading.Lock()
+_last_ms = 0
+_last_random = 0
+
+
+def encode(value):
+    """128-битное число в 26 символов base32, старшие разряды первыми"""
+    chars = []
+    for _ in range(26):
+        chars.append(ALPHABET[value & 31])
+        value >>= 5
+    return ''.join(reversed(chars))
+
+
+def generate_id():
+    """ULID: 48 бит миллисекунд и 80 бит случайности.
+
+    Строки сортируются по времени создания, поэтому новые строки ложатся
+    в правый край B-дерева индекса. Внутри одной миллисекунды случайная
+    часть увеличивается на единицу — порядок процесса строго монотонен,
+    даже если часы отступили назад."""
+    global _last_ms, _last_random
+    with _lock:
+        ms = time.time_ns() // 1_000_000
+        if ms <= _last_ms:
+            ms = _last_ms
+            _last_random += 1
+            if _last_random > RANDOM_MAX:
+                ms += 1
+                _last_random = int.from_bytes(os.urandom(10), 'big')
+        else:
+            _last_random = int.from_bytes(os.urandom(10), 'big')
+        _last_ms = ms
+        value = (ms << RANDOM_BITS) | _last_random
+    return encode(value)
+
+
+def generate_token():
+    """Случайный неугадываемый идентификатор (сессии, загрузки).
+    ULID для этого не годится: соседние id предсказуемы"""
+    return str(uuid.uuid4())
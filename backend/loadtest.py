@@ -0,0 +1,620 @@
+"""Нагрузочный стенд мессенджера.
+
+Поднимает сервер из init_app() в отдельном процессе на временной БД и
+гоняет против него тысячи WebSocket-клиентов aiohttp. Результат — JSON,
+который удобно сравнивать между прогонами.
+
+    python loadtest.py one_to_one --clients 2000 --duration 30
+    python loadtest.py large_group --clients 1000 --group-size 500 --output run.json
+    python loadtest.py typing_storm --clients 1000
+    python loadtest.py reconnect_storm --clients 2000
+    python loadtest.py rest_readers --clients 1000 --rest-rate 2 --history 2000
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import socket
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+import aiohttp
+from aiohttp import web
+
+from fanout import PROTOCOL_BATCH, PROTOCOL_COMPACT, expand_value
+
+logger = logging.getLogger('loadtest')
+
+SCENARIOS = ('one_to_one', 'large_group', 'typing_storm', 'reconnect_storm', 'rest_readers')
+
+# Что делают REST-клиенты сценария rest_readers
+REST_OPERATIONS = ('chat_list', 'history', 'search')
+HISTORY_PAGE = 50
+# Слова сидированной истории, по которым ищет сценарий
+SEARCH_WORDS = 100
+
+# Какой подпротокол запрашивают клиенты стенда
+PROTOCOL_MODES = {
+    'legacy': (),
+    'batch': (PROTOCOL_BATCH,),
+    'compact': (PROTOCOL_COMPACT,),
+}
+
+# Метка в тексте сообщения: время отправки по монотонным часам стенда
+STAMP_PREFIX = 'lt '
+
+
+def percentiles(samples, scale=1.0):
+    """p50/p90/p99/max по списку значений"""
+    if not samples:
+        return {'count': 0}
+    ordered = sorted(samples)
+
+    def pick(q):
+        return round(ordered[min(len(ordered) - 1, int(q * len(ordered)))] * scale, 3)
+
+    return {
+        'count': len(ordered),
+        'p50': pick(0.50),
+        'p90': pick(0.90),
+        'p99': pick(0.99),
+        'max': round(ordered[-1] * scale, 3),
+    }
+
+
+def read_rss(pid):
+    """Резидентная память процесса в байтах (Linux /proc)"""
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+class LagProbe:
+    """Задержка event loop: насколько позже срабатывает короткий sleep"""
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.samples = []
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(self.interval)
+            self.samples.append(max(0.0, loop.time() - started - self.interval))
+
+    def snapshot(self, reset=False):
+        result = percentiles(self.samples, 1000)
+        if reset:
+            self.samples = []
+        return result
+
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+
+# === СЕРВЕР ===
+
+async def serve(port):
+    """Дочерний процесс: сервер из init_app() плюс служебный маршрут пробы"""
+    import app as server
+
+    logging.getLogger().setLevel(logging.WARNING)
+    application = await server.init_app()
+    probe = LagProbe()
+
+    async def get_probe(request):
+        reset = request.query.get('reset') == '1'
+        return web.json_response({'loop_lag_ms': probe.snapshot(reset)})
+
+    application.router.add_get('/loadtest/probe', get_probe)
+
+    runner = web.AppRunner(application, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, '127.0.0.1', port).start()
+    probe.start()
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await probe.close()
+        await runner.cleanup()
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+async def start_server(workdir, port):
+    env = dict(os.environ)
+    # Всё, что сервер пишет на диск, — во временном каталоге прогона,
+    # даже если в окружении уже указаны пути рабочей базы
+    env['DB_PATH'] = os.path.join(workdir, 'loadtest.db')
+    env['MEDIA_DIR'] = os.path.join(workdir, 'media')
+    env['ARCHIVE_DIR'] = os.path.join(workdir, 'archive')
+    env['STATIC_BUILD_DIR'] = os.path.join(workdir, 'static_build')
+    env.setdefault('SERVE_FRONTEND', '0')
+    # Регистрация тысяч пользователей не должна упираться в стоимость KDF
+    env.setdefault('PASSWORD_SCRYPT_N', '1024')
+    # Все клиенты идут с одного IP, а перегрузку нужно измерить, а не сбросить
+    env.setdefault('RATE_LIMIT_ENABLED', '0')
+    env.setdefault('SHED_LOOP_LAG_MS', '0')
+    env.setdefault('SHED_WRITE_QUEUE', '0')
+    process = await asyncio.create_subprocess_exec(
+        sys.executable, os.path.abspath(__file__), 'serve', '--port', str(port), env=env
+    )
+    return process
+
+
+async def wait_ready(http, base_url, process, timeout=30.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.returncode is not None:
+            raise RuntimeError(f'Server exited with code {process.returncode}')
+        try:
+            async with http.get(f'{base_url}/loadtest/probe') as response:
+                if response.status == 200:
+                    return
+        except aiohttp.ClientError:
+            pass
+        await asyncio.sleep(0.1)
+    raise RuntimeError('Server did not start in time')
+
+
+# === КЛИЕНТЫ ===
+
+class Recorder:
+    """Общие счётчики прогона"""
+
+    def __init__(self):
+        self.sent = 0
+        self.delivered = 0
+        self.latencies = []
+        self.typing_events = 0
+        self.reconnects = []
+        self.errors = 0
+        # operation -> задержки REST-запросов
+        self.rest_latencies = {operation: [] for operation in REST_OPERATIONS}
+        self.rest_errors = 0
+        self.measuring = False
+
+    def on_message(self, client, message):
+        text = message.get('text') or ''
+        if message.get('sender_username') == client.username or not text.startswith(STAMP_PREFIX):
+            return
+        self.delivered += 1
+        if self.measuring:
+            self.latencies.append(time.monotonic() - float(text[len(STAMP_PREFIX):]))
+
+    def on_rest(self, operation, seconds):
+        if self.measuring:
+            self.rest_latencies[operation].append(seconds)
+
+
+class Client:
+    """Один пользователь: сессия, WebSocket и курсоры чатов для синхронизации"""
+
+    def __init__(self, index, recorder, protocols=()):
+        self.index = index
+        self.protocols = protocols
+        self.username = f'lt{index:06d}'
+        self.recorder = recorder
+        self.session_id = None
+        self.chats = []
+        self.cursors = {}
+        self.ws = None
+        self.synced = None
+        self._reader = None
+
+    async def register(self, http, base_url):
+        payload = {'username': self.username, 'email': f'{self.username}@loadtest', 'password': 'loadtest'}
+        async with http.post(f'{base_url}/api/users/register', json=payload) as response:
+            # 409 — пользователь остался от прошлого прогона на той же БД
+            if response.status not in (201, 409):
+                raise RuntimeError(f'register {self.username}: {response.status}')
+        async with http.post(f'{base_url}/api/users/login', json=payload) as response:
+            self.session_id = (await response.json())['session_id']
+
+    async def connect(self, http, base_url, sync=False):
+        self.ws = await http.ws_connect(
+            f'{base_url}/ws/{self.session_id}', heartbeat=None, protocols=self.protocols
+        )
+        self.synced = asyncio.Event()
+        self._reader = asyncio.create_task(self._read(self.ws))
+        if sync:
+            await self.send('sync', cursors=self.cursors)
+
+    async def disconnect(self):
+        if self.ws is not None:
+            await self.ws.close()
+        if self._reader is not None:
+            await self._reader
+        self.ws = None
+        self._reader = None
+
+    async def send(self, event_type, **payload):
+        if self.ws is None or self.ws.closed:
+            return False
+        try:
+            await self.ws.send_str(json.dumps({'type': event_type, **payload}))
+            return True
+        except (aiohttp.ClientError, ConnectionResetError):
+            self.recorder.errors += 1
+            return False
+
+    async def send_message(self, chat_id):
+        text = f'{STAMP_PREFIX}{time.monotonic()}'
+        if await self.send('send_message', chat_id=chat_id, sender_username=self.username,
+                           message_type='text', text=text):
+            self.recorder.sent += 1
+
+    async def rest_call(self, http, base_url, operation, pages):
+        """Один REST-запрос сценария rest_readers; history листает до pages страниц"""
+        chat_id = random.choice(self.chats)
+        started = time.monotonic()
+        try:
+            if operation == 'chat_list':
+                await get_json(http, f'{base_url}/api/chats/{self.username}')
+            elif operation == 'history':
+                url = f'{base_url}/api/messages/{chat_id}?limit={HISTORY_PAGE}'
+                for _ in range(pages):
+                    page = await get_json(http, url)
+                    if not page['has_more']:
+                        break
+                    url = f"{base_url}/api/messages/{chat_id}?limit={HISTORY_PAGE}&before={page['before']}"
+            else:
+                query = f'word{random.randrange(SEARCH_WORDS)}'
+                await get_json(http, f'{base_url}/api/search?username={self.username}&q={query}')
+        except (aiohttp.ClientError, RuntimeError):
+            self.recorder.rest_errors += 1
+            return
+        self.recorder.on_rest(operation, time.monotonic() - started)
+
+    def _receive(self, message):
+        seq = message.get('seq')
+        if seq is not None:
+            if seq <= self.cursors.get(message['chat_id'], 0):
+                return
+            self.cursors[message['chat_id']] = seq
+        self.recorder.on_message(self, message)
+
+    async def _read(self, ws):
+        async for frame in ws:
+            if frame.type != aiohttp.WSMsgType.TEXT:
+                continue
+            event = json.loads(frame.data)
+            if ws.protocol == PROTOCOL_COMPACT:
+                event = expand_value(event)
+            events = event['data'] if event.get('type') == 'batch' else [event]
+            for event in events:
+                self._handle(event)
+
+    def _handle(self, event):
+        event_type, data = event.get('type'), event.get('data') or {}
+        if event_type == 'new_message':
+            self._receive(data)
+        elif event_type == 'sync':
+            for message in data['messages']:
+                self._receive(message)
+        elif event_type == 'sync_complete':
+            self.synced.set()
+        elif event_type == 'user_typing':
+            self.recorder.typing_events += 1
+
+
+async def get_json(http, url):
+    async with http.get(url) as response:
+        if response.status != 200:
+            raise RuntimeError(f'GET {url}: {response.status}')
+        return await response.json()
+
+
+async def gather_limited(coros, limit):
+    """Выполнить корутины, держа не больше limit одновременно"""
+    semaphore = asyncio.Semaphore(limit)
+
+    async def run(coro):
+        async with semaphore:
+            return await coro
+
+    return await asyncio.gather(*(run(c) for c in coros))
+
+
+async def create_chat(http, base_url, members, name=''):
+    payload = {
+        'type': 'group' if name else 'private',
+        'participants': [c.username for c in members],
+        'name': name,
+    }
+    async with http.post(f'{base_url}/api/chats/create', json=payload) as response:
+        chat_id = (await response.json())['chat']['id']
+    for client in members:
+        client.chats.append(chat_id)
+        client.cursors[chat_id] = 0
+    return chat_id
+
+
+async def seed_history(http, base_url, members, count):
+    """Дописать в чат участников count сообщений импортом — чтобы было что листать и искать"""
+    chat_id = members[0].chats[-1]
+    lines = ''.join(
+        json.dumps({
+            'sender_username': members[i % len(members)].username,
+            'text': f'seed {i} word{i % SEARCH_WORDS}'
+        }) + '\n'
+        for i in range(count)
+    )
+    async with http.post(f'{base_url}/api/chats/{chat_id}/import', data=lines.encode()) as response:
+        if response.status != 200:
+            raise RuntimeError(f'import {chat_id}: {response.status}')
+
+
+# === СЦЕНАРИИ ===
+
+def pair_chats(clients):
+    """1:1 — клиенты разбиты на пары, у каждой пары свой чат"""
+    return [(clients[i:i + 2], '') for i in range(0, len(clients) - 1, 2)]
+
+
+def group_chats(clients, group_size):
+    """Большие группы по group_size участников"""
+    return [(clients[i:i + group_size], f'group {i // group_size}') for i in range(0, len(clients), group_size)]
+
+
+def pick_senders(args, clients, chats):
+    """(клиент, чат) для каждого отправителя сценария"""
+    if args.scenario in ('one_to_one', 'reconnect_storm', 'rest_readers'):
+        return [(client, client.chats[0]) for client in clients if client.chats]
+    senders = []
+    for members, _ in chats:
+        chat_id = members[0].chats[-1]
+        senders.extend((client, chat_id) for client in members[:args.senders])
+    return senders
+
+
+async def send_loop(client, chat_id, rate, stop):
+    interval = 1.0 / rate
+    # Разносим старт, чтобы клиенты не били в сервер синхронно
+    await asyncio.sleep(random.uniform(0, interval))
+    while not stop.is_set():
+        await client.send_message(chat_id)
+        await asyncio.sleep(random.expovariate(rate))
+
+
+async def typing_loop(client, chat_id, interval, stop):
+    await asyncio.sleep(random.uniform(0, interval))
+    while not stop.is_set():
+        await client.send('typing', chat_id=chat_id, username=client.username)
+        await asyncio.sleep(interval)
+
+
+async def rest_loop(http, base_url, client, args, stop):
+    """Читатель: случайные запросы списка чатов, истории и поиска с частотой rest_rate"""
+    await asyncio.sleep(random.uniform(0, 1.0 / args.rest_rate))
+    while not stop.is_set():
+        operation = random.choice(REST_OPERATIONS)
+        await client.rest_call(http, base_url, operation, args.history_pages)
+        await asyncio.sleep(random.expovariate(args.rest_rate))
+
+
+async def reconnect_all(http, base_url, clients, recorder, concurrency):
+    """Разом оборвать все соединения и переподключиться с синхронизацией"""
+    await asyncio.gather(*(client.disconnect() for client in clients))
+
+    async def reconnect(client):
+        started = time.monotonic()
+        try:
+            await client.connect(http, base_url, sync=True)
+            await asyncio.wait_for(client.synced.wait(), 30)
+            recorder.reconnects.append(time.monotonic() - started)
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            recorder.errors += 1
+
+    await gather_limited([reconnect(client) for client in clients], concurrency)
+
+
+async def run(args):
+    recorder = Recorder()
+    driver_probe = LagProbe()
+    port = free_port()
+    base_url = f'http://127.0.0.1:{port}'
+
+    with tempfile.TemporaryDirectory(prefix='messenger-loadtest-') as workdir:
+        process = await start_server(workdir, port)
+        connector = aiohttp.TCPConnector(limit=0)
+        http = aiohttp.ClientSession(connector=connector)
+        try:
+            await wait_ready(http, base_url, process)
+
+            protocols = PROTOCOL_MODES[args.protocol]
+            clients = [Client(i, recorder, protocols) for i in range(args.clients)]
+            logger.info(f"Registering {len(clients)} users")
+            await gather_limited([c.register(http, base_url) for c in clients], args.concurrency)
+
+            if args.scenario in ('one_to_one', 'reconnect_storm', 'rest_readers'):
+                chats = pair_chats(clients)
+            else:
+                chats = group_chats(clients, args.group_size)
+            await gather_limited([create_chat(http, base_url, m, name) for m, name in chats], args.concurrency)
+            if args.scenario == 'rest_readers' and args.history:
+                logger.info(f"Seeding {args.history} messages into {len(chats)} chats")
+                await gather_limited([seed_history(http, base_url, m, args.history) for m, _ in chats], args.concurrency)
+
+            rss_idle = read_rss(process.pid)
+            logger.info(f"Connecting {len(clients)} WebSocket clients")
+            await gather_limited([c.connect(http, base_url) for c in clients], args.concurrency)
+            await asyncio.sleep(1)
+            rss_connected = read_rss(process.pid)
+
+            stop = asyncio.Event()
+            tasks = [
+                asyncio.create_task(send_loop(client, chat_id, args.rate, stop))
+                for client, chat_id in pick_senders(args, clients, chats)
+            ]
+            if args.scenario == 'typing_storm':
+                tasks += [
+                    asyncio.create_task(typing_loop(client, client.chats[0], args.typing_interval, stop))
+                    for client in clients if client.chats
+                ]
+            if args.scenario == 'rest_readers':
+                tasks += [
+                    asyncio.create_task(rest_loop(http, base_url, client, args, stop))
+                    for client in clients if client.chats
+                ]
+
+            # Прогрев: соединения установлены, очереди заполнились
+            await asyncio.sleep(args.warmup)
+            async with http.get(f'{base_url}/loadtest/probe?reset=1'):
+                pass
+            driver_probe.start()
+            recorder.measuring = True
+            sent_before, delivered_before = recorder.sent, recorder.delivered
+            started = time.monotonic()
+
+            if args.scenario == 'reconnect_storm':
+                await asyncio.sleep(args.duration / 2)
+                logger.info("Dropping and reconnecting all clients")
+                await reconnect_all(http, base_url, clients, recorder, args.concurrency)
+                await asyncio.sleep(max(0.0, args.duration - (time.monotonic() - started)))
+            else:
+                await asyncio.sleep(args.duration)
+
+            stop.set()
+            await asyncio.gather(*tasks)
+            # Даём доставиться сообщениям, отправленным в последний момент
+            await asyncio.sleep(1)
+            elapsed = time.monotonic() - started
+            recorder.measuring = False
+
+            async with http.get(f'{base_url}/loadtest/probe') as response:
+                server_lag = (await response.json())['loop_lag_ms']
+            async with http.get(f'{base_url}/api/stats') as response:
+                server_stats = await response.json()
+            rss_end = read_rss(process.pid)
+
+            await asyncio.gather(*(client.disconnect() for client in clients))
+        finally:
+            await driver_probe.close()
+            await http.close()
+            if process.returncode is None:
+                process.terminate()
+                await process.wait()
+
+    sent = recorder.sent - sent_before
+    delivered = recorder.delivered - delivered_before
+    per_connection = None
+    if rss_idle and rss_connected and args.clients:
+        per_connection = (rss_connected - rss_idle) // args.clients
+
+    result = {
+        'scenario': args.scenario,
+        'started_at': datetime.now(timezone.utc).isoformat(),
+        'config': {
+            'clients': args.clients,
+            'duration': args.duration,
+            'rate': args.rate,
+            'group_size': args.group_size,
+            'senders': args.senders,
+            'typing_interval': args.typing_interval,
+            'protocol': args.protocol,
+            'rest_rate': args.rest_rate,
+            'history': args.history,
+            'history_pages': args.history_pages,
+        },
+        'messages': {
+            'sent': sent,
+            'delivered': delivered,
+            'sent_per_sec': round(sent / elapsed, 1),
+            'delivered_per_sec': round(delivered / elapsed, 1),
+        },
+        'latency_ms': percentiles(recorder.latencies, 1000),
+        'server': {
+            'loop_lag_ms': server_lag,
+            'rss_idle_bytes': rss_idle,
+            'rss_connected_bytes': rss_connected,
+            'rss_end_bytes': rss_end,
+            'bytes_per_connection': per_connection,
+            'stats': server_stats,
+        },
+        'driver': {'loop_lag_ms': driver_probe.snapshot()},
+        'typing_events': recorder.typing_events,
+        'errors': recorder.errors,
+    }
+    if args.scenario == 'reconnect_storm':
+        result['reconnect_ms'] = percentiles(recorder.reconnects, 1000)
+    if args.scenario == 'rest_readers':
+        result['rest'] = {
+            'requests_per_sec': round(sum(map(len, recorder.rest_latencies.values())) / elapsed, 1),
+            'latency_ms': {
+                operation: percentiles(samples, 1000)
+                for operation, samples in recorder.rest_latencies.items()
+            },
+            'errors': recorder.rest_errors,
+        }
+    return result
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Messenger load test')
+    parser.add_argument('scenario', choices=SCENARIOS + ('serve',))
+    parser.add_argument('--clients', type=int, default=1000)
+    parser.add_argument('--duration', type=float, default=20.0, help='seconds of measurement')
+    parser.add_argument('--warmup', type=float, default=2.0)
+    parser.add_argument('--rate', type=float, default=0.5, help='messages per second per sender')
+    parser.add_argument('--group-size', type=int, default=500)
+    parser.add_argument('--senders', type=int, default=10, help='senders per group')
+    parser.add_argument('--typing-interval', type=float, default=0.3)
+    parser.add_argument('--rest-rate', type=float, default=1.0, help='REST requests per second per reader')
+    parser.add_argument('--history', type=int, default=1000, help='messages seeded into each chat for rest_readers')
+    parser.add_argument('--history-pages', type=int, default=3, help='history pages fetched per request')
+    parser.add_argument('--protocol', choices=tuple(PROTOCOL_MODES), default='legacy',
+                        help='WebSocket subprotocol the clients request')
+    parser.add_argument('--concurrency', type=int, default=100, help='parallel setup requests')
+    parser.add_argument('--output', help='write JSON result to this file instead of stdout')
+    parser.add_argument('--port', type=int, help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.scenario == 'serve':
+        asyncio.run(serve(args.port))
+        return
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s', stream=sys.stderr)
+    result = asyncio.run(run(args))
+    output = json.dumps(result, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+    latency = result['latency_ms']
+    logger.info(
+        f"✅ {args.scenario}: {result['messages']['delivered_per_sec']} msg/s delivered, "
+        f"p99 {latency.get('p99')} ms, server lag p99 {result['server']['loop_lag_ms'].get('p99')} ms"
+    )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,174 @@
+import asyncio
+import fcntl
+import hashlib
+import os
+import re
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+import aiofiles
+
+# Размер блока при потоковой записи и хешировании
+CHUNK_SIZE = 256 * 1024
+
+HASH_RE = re.compile(r'^[0-9a-f]{64}$')
+
+
+class UploadConflict(Exception):
+    """Клиент прислал кусок не с того смещения или сверх объявленного размера"""
+
+    def __init__(self, offset):
+        super().__init__(f'Expected offset {offset}')
+        self.offset = offset
+
+
+class UploadBusy(Exception):
+    """Кусок этой загрузки уже пишет другой запрос, возможно в другом воркере"""
+
+
+class UploadMismatch(Exception):
+    """Содержимое не совпало с sha256, который клиент объявил при создании загрузки"""
+
+    def __init__(self, digest):
+        super().__init__(f'Content hash is {digest}')
+        self.digest = digest
+
+
+class MediaStore:
+    """Файлы на диске: незавершённые загрузки и блобы по sha256 содержимого"""
+
+    def __init__(self, root):
+        self.root = Path(root)
+        self.parts = self.root / 'parts'
+        self.blobs = self.root / 'blobs'
+
+    def prepare(self):
+        self.parts.mkdir(parents=True, exist_ok=True)
+        self.blobs.mkdir(parents=True, exist_ok=True)
+
+    # === ПУТИ ===
+
+    def part_path(self, upload_id):
+        return self.parts / f'{upload_id}.part'
+
+    def blob_path(self, digest):
+        """Блоб хранится как blobs/ab/cd/<sha256>"""
+        if not HASH_RE.match(digest):
+            raise ValueError('bad digest')
+        return self.blobs / digest[:2] / digest[2:4] / digest
+
+    def has_blob(self, digest):
+        return self.blob_path(digest).is_file()
+
+    def received(self, upload_id):
+        """Сколько байт загрузки уже на диске — отсюда клиент продолжает"""
+        try:
+            return self.part_path(upload_id).stat().st_size
+        except FileNotFoundError:
+            return 0
+
+    # === БЛОКИРОВКИ ===
+    # flock на самом .part: воркеры — отдельные процессы, и блокировка
+    # должна быть видна всем. Ядро снимает её, даже если процесс упал
+
+    def _lock(self, upload_id, create=False):
+        """Дескриптор .part под эксклюзивной блокировкой; None — файла нет.
+        UploadBusy — файл держит другой запрос"""
+        flags = os.O_WRONLY | (os.O_CREAT if create else 0)
+        try:
+            fd = os.open(self.part_path(upload_id), flags, 0o644)
+        except FileNotFoundError:
+            return None
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            raise UploadBusy(upload_id)
+        return fd
+
+    @contextmanager
+    def writing(self, upload_id):
+        """Одну загрузку пишет не более чем один запрос; блокировка снимается при любом исходе"""
+        fd = self._lock(upload_id, create=True)
+        try:
+            yield
+        finally:
+            os.close(fd)
+
+    def busy(self, upload_id):
+        try:
+            fd = self._lock(upload_id)
+        except UploadBusy:
+            return True
+        if fd is not None:
+            os.close(fd)
+        return False
+
+    def stale_parts(self, max_age):
+        """Незавершённые загрузки, которые не дописывались дольше max_age секунд"""
+        cutoff = time.time() - max_age
+        stale = set()
+        for part in self.parts.glob('*.part'):
+            upload_id = part.stem
+            try:
+                if part.stat().st_mtime < cutoff and not self.busy(upload_id):
+                    stale.add(upload_id)
+            except FileNotFoundError:
+                pass
+        return stale
+
+    # === ЗАПИСЬ ===
+
+    async def append(self, upload_id, offset, size, stream):
+        """Дописать поток к загрузке, начиная с offset; вернуть новое смещение"""
+        received = self.received(upload_id)
+        if offset != received:
+            raise UploadConflict(received)
+
+        async with aiofiles.open(self.part_path(upload_id), 'ab') as f:
+            async for chunk in stream.iter_chunked(CHUNK_SIZE):
+                if received + len(chunk) > size:
+                    raise UploadConflict(received)
+                await f.write(chunk)
+                received += len(chunk)
+        return received
+
+    async def finalize(self, upload_id, expected=None):
+        """Посчитать sha256 и переложить файл в блобы; дубликат просто удаляется.
+        Если хеш не совпал с expected, файл удаляется и поднимается UploadMismatch"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self._finalize, upload_id, expected)
+
+    def _finalize(self, upload_id, expected):
+        part = self.part_path(upload_id)
+        digest = hashlib.sha256()
+        with open(part, 'rb') as f:
+            for block in iter(lambda: f.read(CHUNK_SIZE), b''):
+                digest.update(block)
+        digest = digest.hexdigest()
+
+        if expected and digest != expected:
+            part.unlink()
+            raise UploadMismatch(digest)
+
+        blob = self.blob_path(digest)
+        if blob.exists():
+            part.unlink()
+        else:
+            blob.parent.mkdir(parents=True, exist_ok=True)
+            os.replace(part, blob)
+        return digest
+
+    def discard(self, upload_id):
+        """Удалить недописанный файл, если его сейчас никто не пишет"""
+        try:
+            fd = self._lock(upload_id)
+        except UploadBusy:
+            return
+        if fd is None:
+            return
+        try:
+            self.part_path(upload_id).unlink(missing_ok=True)
+        finally:
+            os.close(fd)
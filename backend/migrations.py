@@ -0,0 +1,351 @@
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Список (версия, функция); версия схемы хранится в PRAGMA user_version
+MIGRATIONS = []
+
+
+def migration(version):
+    """Зарегистрировать миграцию схемы"""
+    def decorator(fn):
+        MIGRATIONS.append((version, fn))
+        return fn
+    return decorator
+
+
+async def get_schema_version(db):
+    cursor = await db.execute('PRAGMA user_version')
+    row = await cursor.fetchone()
+    return row[0]
+
+
+async def apply_migrations(db):
+    """Применить все миграции новее текущей версии схемы"""
+    version = await get_schema_version(db)
+
+    for target, fn in sorted(MIGRATIONS, key=lambda m: m[0]):
+        if target <= version:
+            continue
+        try:
+            # DDL в SQLite транзакционен: миграция применяется целиком или никак.
+            # IMMEDIATE не даст двум воркерам применить одну миграцию дважды
+            await db.execute('BEGIN IMMEDIATE')
+            version = await get_schema_version(db)
+            if target <= version:
+                await db.rollback()
+                continue
+            await fn(db)
+            # PRAGMA не поддерживает параметры, версия — всегда int
+            await db.execute(f'PRAGMA user_version = {int(target)}')
+            await db.commit()
+        except Exception:
+            await db.rollback()
+            raise
+        logger.info(f"✅ Migration {target} applied: {fn.__name__}")
+        version = target
+
+    return version
+
+
+# === МИГРАЦИИ ===
+
+@migration(1)
+async def add_history_indexes(db):
+    """Индексы для постраничной истории и списка чатов пользователя"""
+    await db.execute('''
+        CREATE INDEX IF NOT EXISTS idx_messages_chat_created
+        ON messages (chat_id, created_at, id)
+    ''')
+    await db.execute('''
+        CREATE INDEX IF NOT EXISTS idx_chat_participants_user
+        ON chat_participants (user_id, chat_id)
+    ''')
+
+
+@migration(2)
+async def add_chat_summaries(db):
+    """Денормализованная сводка чата и счётчики непрочитанного"""
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS chat_summaries (
+            chat_id TEXT PRIMARY KEY REFERENCES chats(id) ON DELETE CASCADE,
+            last_message_id TEXT,
+            last_sender_username TEXT,
+            last_message_type TEXT,
+            last_message_text TEXT,
+            last_activity TIMESTAMP
+        )
+    ''')
+    await db.execute('''
+        ALTER TABLE chat_participants ADD COLUMN unread_count INTEGER NOT NULL DEFAULT 0
+    ''')
+    # Заполняем сводки по последнему сообщению каждого чата
+    await db.execute('''
+        INSERT OR REPLACE INTO chat_summaries
+            (chat_id, last_message_id, last_sender_username, last_message_type, last_message_text, last_activity)
+        SELECT c.id, m.id, u.username, m.type, substr(m.text, 1, 200), COALESCE(m.created_at, c.created_at)
+        FROM chats c
+        LEFT JOIN messages m ON m.id = (
+            SELECT id FROM messages
+            WHERE chat_id = c.id
+            ORDER BY created_at DESC, id DESC
+            LIMIT 1
+        )
+        LEFT JOIN users u ON u.id = m.sender_id
+    ''')
+
+
+@migration(3)
+async def add_sessions(db):
+    """Общее хранилище сессий для нескольких воркеров"""
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS sessions (
+            id TEXT PRIMARY KEY,
+            user_id TEXT NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+
+async def create_fts_triggers(db):
+    """Триггеры поддерживают индекс в той же транзакции, что и запись сообщения"""
+    await db.execute('''
+        CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages
+        WHEN new.text IS NOT NULL
+        BEGIN
+            INSERT INTO messages_fts (rowid, text) VALUES (new.rowid, new.text);
+        END
+    ''')
+    await db.execute('''
+        CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages
+        WHEN old.text IS NOT NULL
+        BEGIN
+            INSERT INTO messages_fts (messages_fts, rowid, text) VALUES ('delete', old.rowid, old.text);
+        END
+    ''')
+    await db.execute('''
+        CREATE TRIGGER IF NOT EXISTS messages_fts_update AFTER UPDATE OF text ON messages
+        BEGIN
+            INSERT INTO messages_fts (messages_fts, rowid, text)
+            SELECT 'delete', old.rowid, old.text WHERE old.text IS NOT NULL;
+            INSERT INTO messages_fts (rowid, text)
+            SELECT new.rowid, new.text WHERE new.text IS NOT NULL;
+        END
+    ''')
+
+
+@migration(4)
+async def add_message_search(db):
+    """Полнотекстовый индекс FTS5 по тексту сообщений"""
+    # External content: текст хранится только в messages, индекс — по rowid
+    await db.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+            text,
+            content = 'messages',
+            content_rowid = 'rowid',
+            tokenize = 'unicode61 remove_diacritics 2'
+        )
+    ''')
+    await create_fts_triggers(db)
+    # Разовая индексация уже существующей истории
+    await db.execute("INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')")
+
+
+@migration(5)
+async def add_media(db):
+    """Незавершённые загрузки и блобы, адресуемые хешем содержимого"""
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS uploads (
+            id TEXT PRIMARY KEY,
+            user_id TEXT REFERENCES users(id) ON DELETE CASCADE,
+            filename TEXT,
+            mime TEXT,
+            size INTEGER NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS media (
+            hash TEXT PRIMARY KEY,
+            size INTEGER NOT NULL,
+            mime TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+
+@migration(6)
+async def add_chat_sequences(db):
+    """Монотонные номера сообщений внутри чата для синхронизации и курсоров"""
+    await db.execute('ALTER TABLE chats ADD COLUMN last_seq INTEGER NOT NULL DEFAULT 0')
+    await db.execute('ALTER TABLE messages ADD COLUMN seq INTEGER')
+    # Нумеруем существующую историю в её нынешнем порядке
+    await db.execute('''
+        WITH numbered AS (
+            SELECT rowid AS message_rowid,
+                   ROW_NUMBER() OVER (PARTITION BY chat_id ORDER BY created_at, id) AS seq
+            FROM messages
+        )
+        UPDATE messages SET seq = numbered.seq
+        FROM numbered
+        WHERE numbered.message_rowid = messages.rowid
+    ''')
+    await db.execute('''
+        UPDATE chats SET last_seq = (
+            SELECT COALESCE(MAX(seq), 0) FROM messages WHERE messages.chat_id = chats.id
+        )
+    ''')
+    await db.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_messages_chat_seq ON messages (chat_id, seq)')
+    # История теперь упорядочена по seq; старый индекс только замедляет вставки
+    await db.execute('DROP INDEX IF EXISTS idx_messages_chat_created')
+
+
+@migration(7)
+async def add_archive_segments(db):
+    """Каталог сегментов архива: диапазоны seq, перенесённые из messages"""
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS archive_segments (
+            id INTEGER PRIMARY KEY,
+            chat_id TEXT NOT NULL REFERENCES chats(id) ON DELETE CASCADE,
+            first_seq INTEGER NOT NULL,
+            last_seq INTEGER NOT NULL,
+            path TEXT NOT NULL,
+            message_count INTEGER NOT NULL,
+            bytes INTEGER NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    await db.execute('''
+        CREATE INDEX IF NOT EXISTS idx_archive_segments_chat
+        ON archive_segments (chat_id, first_seq)
+    ''')
+
+
+@migration(8)
+async def add_read_pointers(db):
+    """Непрочитанное = chats.last_seq - last_read_seq вместо счётчика на каждое сообщение"""
+    await db.execute('ALTER TABLE chat_participants ADD COLUMN last_read_seq INTEGER NOT NULL DEFAULT 0')
+    await db.execute('''
+        UPDATE chat_participants SET last_read_seq = MAX(0, (
+            SELECT last_seq FROM chats WHERE chats.id = chat_participants.chat_id
+        ) - unread_count)
+    ''')
+    await db.execute('ALTER TABLE chat_participants DROP COLUMN unread_count')
+
+
+@migration(9)
+async def rebuild_messages_with_integer_key(db):
+    """Явный INTEGER PRIMARY KEY у messages и created_at с миллисекундами.
+
+    Неявный rowid может перенумероваться при VACUUM, а на нём держится
+    внешний FTS-индекс. rowid переносятся как есть, поэтому индекс
+    перестраивать не нужно; старые id сообщений остаются в колонке id."""
+    for trigger in ('messages_fts_insert', 'messages_fts_delete', 'messages_fts_update'):
+        await db.execute(f'DROP TRIGGER IF EXISTS {trigger}')
+    await db.execute('''
+        CREATE TABLE messages_new (
+            pk INTEGER PRIMARY KEY,
+            id TEXT NOT NULL UNIQUE,
+            chat_id TEXT REFERENCES chats(id) ON DELETE CASCADE,
+            sender_id TEXT REFERENCES users(id) ON DELETE CASCADE,
+            type TEXT DEFAULT 'text',
+            text TEXT,
+            file_url TEXT,
+            filename TEXT,
+            created_at TIMESTAMP DEFAULT (strftime('%Y-%m-%d %H:%M:%f', 'now')),
+            seq INTEGER
+        )
+    ''')
+    await db.execute('''
+        INSERT INTO messages_new (pk, id, chat_id, sender_id, type, text, file_url, filename, created_at, seq)
+        SELECT rowid, id, chat_id, sender_id, type, text, file_url, filename, created_at, seq
+        FROM messages
+        ORDER BY rowid
+    ''')
+    await db.execute('DROP TABLE messages')
+    await db.execute('ALTER TABLE messages_new RENAME TO messages')
+    await db.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_messages_chat_seq ON messages (chat_id, seq)')
+    await create_fts_triggers(db)
+
+
+@migration(10)
+async def keep_archived_messages_searchable(db):
+    """Поиск по сообщениям, уехавшим в архив.
+
+    Компактор копирует текстовые сообщения в archived_messages перед
+    удалением из messages; триггер удаления такие строки из индекса не
+    убирает. Содержимое индекса — представление над обеими таблицами,
+    чтобы snippet() находил текст архивных сообщений."""
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS archived_messages (
+            pk INTEGER PRIMARY KEY,
+            id TEXT NOT NULL,
+            chat_id TEXT NOT NULL,
+            sender_id TEXT,
+            type TEXT,
+            text TEXT NOT NULL,
+            created_at TIMESTAMP
+        )
+    ''')
+    await db.execute('''
+        CREATE VIEW IF NOT EXISTS searchable_messages AS
+        SELECT pk, text FROM messages
+        UNION ALL
+        SELECT pk, text FROM archived_messages
+    ''')
+    # Источник содержимого FTS5 задаётся только при создании таблицы
+    await db.execute('DROP TABLE IF EXISTS messages_fts')
+    await db.execute('''
+        CREATE VIRTUAL TABLE messages_fts USING fts5(
+            text,
+            content = 'searchable_messages',
+            content_rowid = 'pk',
+            tokenize = 'unicode61 remove_diacritics 2'
+        )
+    ''')
+    await db.execute("INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')")
+    await db.execute('DROP TRIGGER IF EXISTS messages_fts_delete')
+    await db.execute('''
+        CREATE TRIGGER messages_fts_delete AFTER DELETE ON messages
+        WHEN old.text IS NOT NULL AND NOT EXISTS (SELECT 1 FROM archived_messages WHERE pk = old.pk)
+        BEGIN
+            INSERT INTO messages_fts (messages_fts, rowid, text) VALUES ('delete', old.rowid, old.text);
+        END
+    ''')
+
+
+@migration(11)
+async def add_session_expiry(db):
+    """Время последнего подключения сессии: по нему сессии истекают"""
+    await db.execute('ALTER TABLE sessions ADD COLUMN last_seen TIMESTAMP')
+    await db.execute('UPDATE sessions SET last_seen = COALESCE(created_at, CURRENT_TIMESTAMP)')
+    await db.execute('CREATE INDEX IF NOT EXISTS idx_sessions_last_seen ON sessions (last_seen)')
+
+
+@migration(12)
+async def add_upload_checksum(db):
+    """sha256, объявленный клиентом: с ним сверяется собранный файл"""
+    await db.execute('ALTER TABLE uploads ADD COLUMN sha256 TEXT')
+
+
+@migration(13)
+async def move_archive_search_out_of_live_db(db):
+    """Архив ищется по собственному индексу рядом с сегментами.
+
+    Текст архивных сообщений больше не копируется в живую базу: он есть
+    в сегментах, и при запуске индекс архива дополняется по ним. Внешний
+    FTS-индекс снова строится только по messages."""
+    await db.execute('DROP TRIGGER IF EXISTS messages_fts_delete')
+    await db.execute('DROP TABLE IF EXISTS messages_fts')
+    await db.execute('DROP VIEW IF EXISTS searchable_messages')
+    await db.execute('DROP TABLE IF EXISTS archived_messages')
+    await db.execute('''
+        CREATE VIRTUAL TABLE messages_fts USING fts5(
+            text,
+            content = 'messages',
+            content_rowid = 'pk',
+            tokenize = 'unicode61 remove_diacritics 2'
+        )
+    ''')
+    await db.execute("INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')")
+    await create_fts_triggers(db)
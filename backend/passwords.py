@@ -0,0 +1,82 @@
+import asyncio
+import base64
+import hashlib
+import hmac
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+SALT_SIZE = 16
+KEY_SIZE = 32
+# Соль холостого расчёта для несуществующих пользователей
+DUMMY_SALT = bytes(SALT_SIZE)
+
+
+def _b64encode(raw):
+    return base64.b64encode(raw).decode().rstrip('=')
+
+
+def _b64decode(text):
+    return base64.b64decode(text + '=' * (-len(text) % 4))
+
+
+class PasswordHasher:
+    """Солёный scrypt в ограниченном пуле потоков.
+
+    hashlib.scrypt отпускает GIL, поэтому расчёт не блокирует event loop,
+    а размер пула ограничивает нагрузку при шторме логинов.
+    Формат: scrypt$n$r$p$salt$hash; старые sha256-хеши распознаются
+    и помечаются для перехеширования."""
+
+    def __init__(self, n=2 ** 14, r=8, p=1, workers=2):
+        self.n = n
+        self.r = r
+        self.p = p
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='password-kdf')
+
+    @staticmethod
+    def _derive(password, salt, n, r, p):
+        return hashlib.scrypt(
+            password.encode(), salt=salt, n=n, r=r, p=p,
+            maxmem=256 * n * r, dklen=KEY_SIZE
+        )
+
+    async def _run(self, password, salt, n, r, p):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, self._derive, password, salt, n, r, p)
+
+    async def hash(self, password):
+        salt = os.urandom(SALT_SIZE)
+        key = await self._run(password, salt, self.n, self.r, self.p)
+        return f'scrypt${self.n}${self.r}${self.p}${_b64encode(salt)}${_b64encode(key)}'
+
+    async def _reject(self, password):
+        """Холостой расчёт с текущими параметрами: отказ занимает столько же,
+        сколько проверка настоящего хеша, и не выдаёт, есть ли пользователь"""
+        await self._run(password, DUMMY_SALT, self.n, self.r, self.p)
+        return False, False
+
+    async def verify(self, password, stored):
+        """Вернуть (совпал ли пароль, нужно ли перехешировать)"""
+        if not stored:
+            return await self._reject(password)
+
+        if not stored.startswith('scrypt$'):
+            # Наследие: несолёный sha256 в hex; успешный вход сразу перехеширует
+            legacy = hashlib.sha256(password.encode()).hexdigest()
+            if hmac.compare_digest(legacy, stored):
+                return True, True
+            return await self._reject(password)
+
+        try:
+            _, n, r, p, salt, key = stored.split('$')
+            n, r, p = int(n), int(r), int(p)
+            salt, key = _b64decode(salt), _b64decode(key)
+        except ValueError:
+            return await self._reject(password)
+
+        candidate = await self._run(password, salt, n, r, p)
+        ok = hmac.compare_digest(candidate, key)
+        return ok, ok and (n, r, p) != (self.n, self.r, self.p)
+
+    def close(self):
+        self._executor.shutdown(wait=False)
@@ -0,0 +1,173 @@
+import asyncio
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class PresenceTracker:
+    """Онлайн-статусы в памяти; в таблицу users попадают пачкой раз в интервал.
+
+    Каждый воркер знает статусы своих соединений и статусы, которые
+    остальные воркеры публикуют в шину. Пользователь online, если он
+    online хотя бы на одном воркере."""
+
+    def __init__(self, flush_interval=5.0):
+        self.flush_interval = flush_interval
+        # user_id -> status на этом воркере
+        self._status = {}
+        # user_id -> set(worker_id), на которых пользователь online
+        self._remote = {}
+        # user_id -> status этого воркера, ещё не записанный и не опубликованный
+        self._dirty = {}
+        self._flush = None
+        self._task = None
+
+    def set_status(self, user_id, status):
+        """Запомнить статус этого воркера; True, если изменился общий статус"""
+        if self._status.get(user_id) == status:
+            return False
+        before = self.get_status(user_id)
+        self._status[user_id] = status
+        self._dirty[user_id] = status
+        return self.get_status(user_id) != before
+
+    def apply_remote(self, worker_id, updates):
+        """Статусы другого воркера из шины"""
+        for user_id, status in updates.items():
+            workers = self._remote.setdefault(user_id, set())
+            if status == 'online':
+                workers.add(worker_id)
+            else:
+                workers.discard(worker_id)
+                # Тот воркер записал в БД offline, но здесь пользователь ещё
+                # подключён — повторяем online при следующем сбросе
+                if self._status.get(user_id) == 'online':
+                    self._dirty[user_id] = 'online'
+
+    def forget_worker(self, worker_id):
+        """Воркер упал: его соединений больше нет.
+        Вернуть пользователей, которые из-за этого стали offline"""
+        gone = []
+        for user_id, workers in self._remote.items():
+            if worker_id in workers:
+                workers.discard(worker_id)
+                if self.get_status(user_id) != 'online':
+                    gone.append(user_id)
+        return gone
+
+    def republish(self, user_ids=None):
+        """Записать и разослать статусы этого воркера заново при следующем сбросе;
+        без user_ids — всех, кто подключён здесь"""
+        if user_ids is None:
+            user_ids = [user_id for user_id, status in self._status.items() if status == 'online']
+        for user_id in user_ids:
+            self._dirty[user_id] = self._status.get(user_id, 'offline')
+
+    def get_status(self, user_id):
+        """Общий статус; None — остальные воркеры о пользователе не сообщали
+        и он не online здесь, тогда верить нужно БД"""
+        workers = self._remote.get(user_id)
+        if workers or self._status.get(user_id) == 'online':
+            return 'online'
+        if workers is not None:
+            return 'offline'
+        return None
+
+    def pending(self):
+        return len(self._dirty)
+
+    def start(self, flush):
+        """flush(updates) — корутина, записывающая {user_id: status этого воркера}"""
+        self._flush = flush
+        self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        # Воркер останавливается — его соединений больше нет
+        for user_id, status in self._status.items():
+            if status == 'online':
+                self._status[user_id] = self._dirty[user_id] = 'offline'
+        await self.flush()
+
+    async def flush(self):
+        if not self._dirty or not self._flush:
+            return
+        updates, self._dirty = self._dirty, {}
+        try:
+            await self._flush(updates)
+        except Exception as e:
+            logger.error(f"Presence flush error: {e}")
+            # Не теряем изменения: более свежие статусы важнее старых
+            for user_id, status in updates.items():
+                self._dirty.setdefault(user_id, status)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+
+class TypingTracker:
+    """Индикаторы набора текста: троттлинг рассылки и истечение на сервере"""
+
+    def __init__(self, throttle=2.0, ttl=6.0, sweep_interval=1.0):
+        self.throttle = throttle
+        self.ttl = ttl
+        self.sweep_interval = sweep_interval
+        # (chat_id, username) -> [время последней рассылки, время истечения]
+        self._active = {}
+        self._on_expire = None
+        self._task = None
+
+    def typing(self, chat_id, username):
+        """Пользователь печатает; True, если об этом нужно разослать событие"""
+        now = time.monotonic()
+        state = self._active.get((chat_id, username))
+        if state is None:
+            self._active[(chat_id, username)] = [now, now + self.ttl]
+            return True
+        state[1] = now + self.ttl
+        if now - state[0] >= self.throttle:
+            state[0] = now
+            return True
+        return False
+
+    def stop_typing(self, chat_id, username):
+        """Пользователь перестал печатать; True, если индикатор был показан"""
+        return self._active.pop((chat_id, username), None) is not None
+
+    def start(self, on_expire):
+        """on_expire(chat_id, username) — корутина, гасящая индикатор"""
+        self._on_expire = on_expire
+        self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.sweep_interval)
+            now = time.monotonic()
+            expired = [key for key, (_, expires) in self._active.items() if expires <= now]
+            for key in expired:
+                state = self._active.get(key)
+                if state is None or state[1] > time.monotonic():
+                    continue
+                del self._active[key]
+                try:
+                    await self._on_expire(*key)
+                except Exception as e:
+                    logger.error(f"Typing expiry error: {e}")
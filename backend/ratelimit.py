@@ -0,0 +1,79 @@
+import time
+from collections import OrderedDict
+
+
+def parse_rule(spec):
+    """'токенов_в_секунду:всплеск' -> (rate, burst); '0' — без ограничения (None)"""
+    rate, _, burst = spec.strip().partition(':')
+    rate = float(rate)
+    if rate <= 0:
+        return None
+    return rate, float(burst) if burst else max(1.0, rate)
+
+
+def parse_rules(spec):
+    """'/api/a=1:5,/api/b=0' -> {маршрут: правило}"""
+    rules = {}
+    for item in spec.split(','):
+        if item.strip():
+            route, _, rule = item.partition('=')
+            rules[route.strip()] = parse_rule(rule)
+    return rules
+
+
+class RateLimiter:
+    """Token bucket на ключ.
+
+    Ключей не больше max_keys: вытесняется давно не тронутый —
+    его ведро за это время всё равно бы наполнилось."""
+
+    def __init__(self, max_keys=100000):
+        self.max_keys = max_keys
+        # key -> [токены, время последнего пополнения]
+        self._buckets = OrderedDict()
+
+    def acquire(self, key, rule, cost=1.0):
+        """0 — разрешено; иначе через сколько секунд появится токен"""
+        if rule is None:
+            return 0.0
+        rate, burst = rule
+        now = time.monotonic()
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = [burst, now]
+            if len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(key)
+            bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+            bucket[1] = now
+        if bucket[0] >= cost:
+            bucket[0] -= cost
+            return 0.0
+        return (cost - bucket[0]) / rate
+
+    def forget(self, key):
+        self._buckets.pop(key, None)
+
+    def __len__(self):
+        return len(self._buckets)
+
+
+class AdmissionControl:
+    """Сброс нагрузки: пока event loop опаздывает или очередь писателя
+    переполнена, новая работа отклоняется сразу, а не ждёт в очереди"""
+
+    def __init__(self, loop_lag, queue_depth, max_loop_lag=0.5, max_write_queue=5000):
+        """loop_lag() и queue_depth() — текущие значения; порог 0 отключает проверку"""
+        self._loop_lag = loop_lag
+        self._queue_depth = queue_depth
+        self.max_loop_lag = max_loop_lag
+        self.max_write_queue = max_write_queue
+
+    def overloaded(self):
+        """Причина перегрузки или None"""
+        if self.max_loop_lag and self._loop_lag() > self.max_loop_lag:
+            return 'loop_lag'
+        if self.max_write_queue and self._queue_depth() > self.max_write_queue:
+            return 'write_queue'
+        return None
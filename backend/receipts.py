@@ -0,0 +1,86 @@
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class ReceiptTracker:
+    """Указатели прочтения: копятся в памяти, в БД и подписчикам уходят пачкой.
+
+    Из нескольких mark_read одного пользователя за интервал остаётся
+    только самый дальний; рассылка — одно событие на чат за интервал."""
+
+    def __init__(self, flush_interval=1.0):
+        self.flush_interval = flush_interval
+        # (chat_id, user_id) -> seq, ещё не записанный в БД
+        self._dirty = {}
+        # chat_id -> {username: seq} для следующей рассылки
+        self._announce = {}
+        self._flush = None
+        self._publish = None
+        self._task = None
+        self.marks = 0
+        self.flushes = 0
+
+    def mark(self, chat_id, user_id, username, seq):
+        """Пользователь прочитал чат до seq; True, если указатель сдвинулся"""
+        key = (chat_id, user_id)
+        if seq <= self._dirty.get(key, 0):
+            return False
+        self._dirty[key] = seq
+        self._announce.setdefault(chat_id, {})[username] = seq
+        self.marks += 1
+        return True
+
+    def pointer(self, chat_id, user_id):
+        """Ещё не записанный указатель или 0"""
+        return self._dirty.get((chat_id, user_id), 0)
+
+    def pending(self):
+        return len(self._dirty)
+
+    def start(self, flush, publish):
+        """flush(updates) записывает {(chat_id, user_id): seq};
+        publish(chat_id, readers) рассылает {username: seq}"""
+        self._flush = flush
+        self._publish = publish
+        self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+    async def flush(self):
+        if not self._flush:
+            return
+        updates, self._dirty = self._dirty, {}
+        announce, self._announce = self._announce, {}
+        if updates:
+            try:
+                await self._flush(updates)
+                self.flushes += 1
+            except Exception as e:
+                logger.error(f"Receipt flush error: {e}")
+                # Указатели только растут: при слиянии побеждает больший
+                for key, seq in updates.items():
+                    if seq > self._dirty.get(key, 0):
+                        self._dirty[key] = seq
+        for chat_id, readers in announce.items():
+            try:
+                await self._publish(chat_id, readers)
+            except Exception as e:
+                logger.error(f"Receipt broadcast error: {e}")
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    def stats(self):
+        return {'pending': len(self._dirty), 'marks': self.marks, 'flushes': self.flushes}
@@ -0,0 +1,85 @@
+from collections import OrderedDict
+
+
+class ConnectionRegistry:
+    """Реестр сессий, живых WebSocket-соединений и участников чатов"""
+
+    def __init__(self, max_chats=10000):
+        # session_id -> user_id
+        self._sessions = {}
+        # user_id -> {session_id: conn}
+        self._sockets = {}
+        # chat_id -> set(user_id); LRU не больше max_chats чатов,
+        # вытесненный чат при следующей рассылке читается из БД заново
+        self._members = OrderedDict()
+        self.max_chats = max_chats
+        self._connections = 0
+
+    # === СЕССИИ ===
+    # Здесь только сессии с открытым сокетом на этом воркере; остальные — в БД
+
+    def get_user(self, session_id):
+        return self._sessions.get(session_id)
+
+    def session_count(self):
+        return len(self._sessions)
+
+    # === СОЕДИНЕНИЯ ===
+
+    def attach(self, session_id, user_id, conn):
+        """Привязать сокет к сессии; прежний сокет той же сессии заменяется"""
+        self._sessions[session_id] = user_id
+        sockets = self._sockets.setdefault(user_id, {})
+        if session_id not in sockets:
+            self._connections += 1
+        sockets[session_id] = conn
+
+    def detach(self, session_id, conn):
+        """Отвязать сокет и забыть сессию; более новое соединение той же сессии не трогаем"""
+        user_id = self._sessions.get(session_id)
+        sockets = self._sockets.get(user_id)
+        if not sockets or sockets.get(session_id) is not conn:
+            return
+        del sockets[session_id]
+        del self._sessions[session_id]
+        self._connections -= 1
+        if not sockets:
+            del self._sockets[user_id]
+
+    def is_online(self, user_id):
+        return user_id in self._sockets
+
+    def connection_count(self):
+        return self._connections
+
+    def user_connection_count(self, user_id, session_id=None):
+        """Сокеты пользователя, кроме сокета session_id — его заменит новый"""
+        sockets = self._sockets.get(user_id, {})
+        return len(sockets) - (session_id in sockets)
+
+    # === УЧАСТНИКИ ЧАТОВ ===
+
+    def members(self, chat_id):
+        """Участники чата из кеша; None, если чат ещё не загружен или вытеснен"""
+        members = self._members.get(chat_id)
+        if members is not None:
+            self._members.move_to_end(chat_id)
+        return members
+
+    def set_members(self, chat_id, user_ids):
+        self._members[chat_id] = set(user_ids)
+        self._members.move_to_end(chat_id)
+        while len(self._members) > self.max_chats:
+            self._members.popitem(last=False)
+
+    def chat_count(self):
+        return len(self._members)
+
+    def sockets_for_chat(self, chat_id):
+        """Все живые сокеты участников чата — один проход по словарям"""
+        result = []
+        for user_id in self._members.get(chat_id, ()):
+            sockets = self._sockets.get(user_id)
+            if sockets:
+                result.extend(sockets.values())
+        return result
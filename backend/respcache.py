@@ -0,0 +1,111 @@
+import hashlib
+from collections import OrderedDict
+
+from aiohttp import web
+
+# Грубая оценка накладных расходов на запись кеша
+ENTRY_OVERHEAD = 300
+
+
+class CachedResponse:
+    __slots__ = ('body', 'etag', 'deps')
+
+    def __init__(self, body, deps):
+        self.body = body
+        self.etag = '"' + hashlib.blake2b(body, digest_size=12).hexdigest() + '"'
+        # ((область, версия), ...) на момент построения ответа
+        self.deps = deps
+
+    @property
+    def size(self):
+        return len(self.body) + ENTRY_OVERHEAD
+
+
+class ResponseCache:
+    """Готовые JSON-ответы с версиями зависимостей.
+
+    Инвалидация — увеличение версии области (O(1)), записи не ищутся:
+    устаревшая запись просто не совпадёт по версии при следующем чтении.
+    Версия области — номер изменения, на котором её меняли последний раз.
+    Объём ограничен max_bytes, вытеснение по LRU."""
+
+    def __init__(self, max_bytes=16 * 1024 ** 2):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        # область -> номер её последнего изменения
+        self._versions = {}
+        # Сквозной счётчик изменений всех областей
+        self._epoch = 0
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.not_modified = 0
+
+    def bump(self, scope):
+        self._epoch += 1
+        self._versions[scope] = self._epoch
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is not None and all(self._versions.get(scope, 0) == version for scope, version in entry.deps):
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+        if entry is not None:
+            self._drop(key)
+        self.misses += 1
+        return None
+
+    def begin(self):
+        """Отметить начало построения ответа; вернуть токен для put.
+        Области ответа могут стать известны только после запроса к БД,
+        поэтому токен — номер изменения, а не снимок версий"""
+        return self._epoch
+
+    def put(self, key, scopes, body, token):
+        """Запомнить ответ, если за время построения не менялась ни одна из его областей.
+        Изменения других областей не мешают. Запись возвращается в любом случае — ею можно ответить"""
+        entry = CachedResponse(body, tuple((scope, self._versions.get(scope, 0)) for scope in scopes))
+        if any(version > token for _, version in entry.deps) or entry.size > self.max_bytes:
+            return entry
+        if key in self._entries:
+            self._drop(key)
+        self._entries[key] = entry
+        self.bytes += entry.size
+        while self.bytes > self.max_bytes:
+            self._drop(next(iter(self._entries)))
+        return entry
+
+    def _drop(self, key):
+        self.bytes -= self._entries.pop(key).size
+
+    def respond(self, request, entry):
+        """200 с телом или 304, если у клиента та же версия"""
+        headers = {'ETag': entry.etag, 'Cache-Control': 'no-cache'}
+        if etag_matches(request.headers.get('If-None-Match'), entry.etag):
+            self.not_modified += 1
+            return web.Response(status=304, headers=headers)
+        return web.Response(body=entry.body, content_type='application/json', headers=headers)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'entries': len(self._entries),
+            'bytes': self.bytes,
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / lookups, 4) if lookups else None,
+            'not_modified': self.not_modified,
+        }
+
+
+def etag_matches(header, etag):
+    """If-None-Match: список тегов или *; слабое сравнение, как велит RFC 9110"""
+    if not header:
+        return False
+    for candidate in header.split(','):
+        candidate = candidate.strip()
+        if candidate == '*' or candidate.removeprefix('W/') == etag:
+            return True
+    return False
@@ -0,0 +1,127 @@
+import gzip
+import hashlib
+import mimetypes
+import os
+import re
+import uuid
+from pathlib import Path
+
+from aiohttp import web
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Ссылки на локальные файлы в index.html: src="app.js", href="styles.css"
+ASSET_REFERENCE = re.compile(r'(src|href)="([^"/:#?]+\.(?:js|css))"')
+# Меньше этого сжимать бессмысленно: выигрыш съедят заголовки
+MIN_COMPRESS_SIZE = 512
+TEXT_TYPES = ('text/', 'application/javascript', 'application/json')
+
+IMMUTABLE = 'public, max-age=31536000, immutable'
+REVALIDATE = 'no-cache'
+
+
+def accepted_encodings(header):
+    """Кодировки из Accept-Encoding, кроме явно запрещённых q=0"""
+    result = set()
+    for item in (header or '').lower().split(','):
+        name, _, params = item.partition(';')
+        key, _, value = params.partition('=')
+        try:
+            if key.strip() == 'q' and float(value) == 0:
+                continue
+        except ValueError:
+            continue
+        if name.strip():
+            result.add(name.strip())
+    return result
+
+
+def write_if_changed(path, data):
+    """Атомарно записать файл, если содержимое отличается.
+    Неизменный файл сохраняет mtime, а с ним и ETag"""
+    try:
+        if path.read_bytes() == data:
+            return
+    except FileNotFoundError:
+        pass
+    # Воркеры собирают одно и то же одновременно — у каждого свой временный файл
+    tmp = path.with_name(f'.{path.name}.{uuid.uuid4().hex[:8]}.tmp')
+    tmp.write_bytes(data)
+    os.replace(tmp, path)
+
+
+class StaticSite:
+    """Фронтенд из одного процесса с API.
+
+    Ассеты получают хеш содержимого в имени и отдаются как immutable;
+    index.html ссылается на них и всегда перепроверяется. gzip и brotli
+    готовятся один раз при сборке, запрос только выбирает файл."""
+
+    def __init__(self, source, build_dir):
+        self.source = Path(source)
+        self.build_dir = Path(build_dir)
+        # имя в build_dir -> {кодировка или None: путь}
+        self._files = {}
+
+    def build(self):
+        """Собрать build_dir из source; вернуть карту исходное имя -> хешированное"""
+        self.build_dir.mkdir(parents=True, exist_ok=True)
+        html = (self.source / 'index.html').read_text(encoding='utf-8')
+
+        renamed = {}
+        for name in sorted(set(match.group(2) for match in ASSET_REFERENCE.finditer(html))):
+            data = (self.source / name).read_bytes()
+            stem, suffix = os.path.splitext(name)
+            hashed = f'{stem}.{hashlib.sha256(data).hexdigest()[:12]}{suffix}'
+            self._add(hashed, data)
+            renamed[name] = hashed
+
+        html = ASSET_REFERENCE.sub(
+            lambda match: f'{match.group(1)}="/assets/{renamed[match.group(2)]}"', html
+        )
+        self._add('index.html', html.encode('utf-8'))
+        return renamed
+
+    def _add(self, name, data):
+        # Сжатые варианты лежат в подкаталогах, а не рядом с файлом как name.gz:
+        # иначе FileResponse сам подменит файл, не разбирая q=0 в Accept-Encoding
+        variants = {None: self.build_dir / name}
+        write_if_changed(variants[None], data)
+        if len(data) >= MIN_COMPRESS_SIZE:
+            compressed = {'gzip': gzip.compress(data, 9, mtime=0)}
+            if brotli is not None:
+                compressed['br'] = brotli.compress(data, quality=11)
+            for encoding, payload in compressed.items():
+                if len(payload) < len(data):
+                    variants[encoding] = self.build_dir / encoding / name
+                    variants[encoding].parent.mkdir(exist_ok=True)
+                    write_if_changed(variants[encoding], payload)
+        self._files[name] = variants
+
+    def has(self, name):
+        return name in self._files
+
+    def response(self, request, name, cache_control):
+        """FileResponse с лучшим из заранее сжатых вариантов (sendfile, ETag, 304)"""
+        variants = self._files[name]
+        accepted = accepted_encodings(request.headers.get('Accept-Encoding'))
+        encoding = next((e for e in ('br', 'gzip') if e in accepted and e in variants), None)
+
+        content_type = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+        if content_type.startswith(TEXT_TYPES):
+            content_type += '; charset=utf-8'
+        headers = {'Content-Type': content_type, 'Cache-Control': cache_control}
+        if len(variants) > 1:
+            headers['Vary'] = 'Accept-Encoding'
+        if encoding:
+            headers['Content-Encoding'] = encoding
+        return web.FileResponse(variants[encoding], headers=headers)
+
+    def stats(self):
+        return {
+            'files': len(self._files),
+            'brotli': brotli is not None,
+        }
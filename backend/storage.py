@@ -0,0 +1,123 @@
+import asyncio
+import logging
+import time
+from contextlib import asynccontextmanager
+from pathlib import Path
+
+import aiosqlite
+
+from metrics import registry as metrics
+from writer import GroupCommitWriter
+
+logger = logging.getLogger(__name__)
+
+DB_READ_SECONDS = metrics.histogram(
+    'messenger_db_read_seconds', 'SQLite read query duration', ('op',)
+)
+DB_READ_WAIT_SECONDS = metrics.histogram(
+    'messenger_db_read_wait_seconds', 'Time spent waiting for a pooled read connection'
+)
+
+
+def connection_pragmas(synchronous='FULL', cache_size_mb=64, mmap_size_mb=256):
+    """PRAGMA, которые выставляются на каждом соединении"""
+    return [
+        'PRAGMA busy_timeout = 30000',
+        f'PRAGMA synchronous = {synchronous}',
+        # Отрицательное значение — размер в KiB, а не в страницах
+        f'PRAGMA cache_size = {-int(cache_size_mb * 1024)}',
+        f'PRAGMA mmap_size = {int(mmap_size_mb * 1024 * 1024)}',
+        'PRAGMA temp_store = MEMORY',
+    ]
+
+
+class Storage:
+    """SQLite в режиме WAL: один писатель с групповой фиксацией
+    и пул соединений только для чтения"""
+
+    def __init__(self, path, readers=4, pragmas=None, max_batch=256, window=0.002):
+        self.path = path
+        self.reader_count = max(1, readers)
+        self.pragmas = pragmas if pragmas is not None else connection_pragmas()
+        self.writer = GroupCommitWriter(path, max_batch, window, self.pragmas)
+        self._readers = []
+        self._pool = None
+        self._reads = 0
+        self._read_waits = 0
+
+    async def open(self):
+        await self.writer.start()
+
+        uri = Path(self.path).resolve().as_uri() + '?mode=ro'
+        self._pool = asyncio.Queue()
+        for _ in range(self.reader_count):
+            conn = await aiosqlite.connect(uri, uri=True)
+            conn.row_factory = aiosqlite.Row
+            for pragma in self.pragmas:
+                await conn.execute(pragma)
+            self._readers.append(conn)
+            self._pool.put_nowait(conn)
+
+        logger.info(f"✅ Storage opened: 1 writer, {self.reader_count} readers")
+
+    async def close(self):
+        await self.writer.close()
+        for conn in self._readers:
+            await conn.close()
+        self._readers = []
+
+    # === ЧТЕНИЕ ===
+
+    @asynccontextmanager
+    async def reader(self):
+        """Взять соединение для чтения из пула"""
+        if self._pool.empty():
+            self._read_waits += 1
+            started = time.perf_counter()
+            conn = await self._pool.get()
+            DB_READ_WAIT_SECONDS.observe(time.perf_counter() - started)
+        else:
+            conn = self._pool.get_nowait()
+        self._reads += 1
+        try:
+            yield conn
+        finally:
+            self._pool.put_nowait(conn)
+
+    async def fetchone(self, sql, params=()):
+        async with self.reader() as conn:
+            started = time.perf_counter()
+            cursor = await conn.execute(sql, params)
+            row = await cursor.fetchone()
+            DB_READ_SECONDS.labels('fetchone').observe(time.perf_counter() - started)
+            return row
+
+    async def fetchall(self, sql, params=()):
+        async with self.reader() as conn:
+            started = time.perf_counter()
+            cursor = await conn.execute(sql, params)
+            rows = await cursor.fetchall()
+            DB_READ_SECONDS.labels('fetchall').observe(time.perf_counter() - started)
+            return rows
+
+    # === ЗАПИСЬ ===
+
+    async def execute(self, sql, params=()):
+        return await self.writer.execute(sql, params)
+
+    async def executemany(self, statements):
+        return await self.writer.executemany(statements)
+
+    async def submit(self, operation):
+        return await self.writer.submit(operation)
+
+    def stats(self):
+        return {
+            'writer': self.writer.stats(),
+            'readers': {
+                'size': self.reader_count,
+                'idle': self._pool.qsize() if self._pool else 0,
+                'reads': self._reads,
+                'waits': self._read_waits,
+            }
+        }
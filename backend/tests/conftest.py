@@ -0,0 +1,15 @@
+import os
+import sys
+
+import pytest
+
+# Модули бэкенда плоские и импортируются по имени, как в app.py
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def legacy_db(tmp_path):
+    from legacy import create_legacy_db
+    path = str(tmp_path / 'legacy.db')
+    create_legacy_db(path)
+    return path
@@ -0,0 +1,83 @@
+"""Исходная схема базы — отправная точка для миграций в тестах"""
+import sqlite3
+
+import aiosqlite
+
+from migrations import apply_migrations
+
+# Схема до первой миграции — как её создавала исходная init_db
+LEGACY_SCHEMA = '''
+    CREATE TABLE users (
+        id TEXT PRIMARY KEY,
+        username TEXT UNIQUE NOT NULL,
+        email TEXT UNIQUE NOT NULL,
+        password_hash TEXT NOT NULL,
+        avatar TEXT,
+        status TEXT DEFAULT 'offline',
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+    CREATE TABLE chats (
+        id TEXT PRIMARY KEY,
+        type TEXT NOT NULL,
+        name TEXT,
+        avatar TEXT,
+        creator_id TEXT REFERENCES users(id),
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+    CREATE TABLE chat_participants (
+        chat_id TEXT REFERENCES chats(id) ON DELETE CASCADE,
+        user_id TEXT REFERENCES users(id) ON DELETE CASCADE,
+        PRIMARY KEY (chat_id, user_id)
+    );
+    CREATE TABLE messages (
+        id TEXT PRIMARY KEY,
+        chat_id TEXT REFERENCES chats(id) ON DELETE CASCADE,
+        sender_id TEXT REFERENCES users(id) ON DELETE CASCADE,
+        type TEXT DEFAULT 'text',
+        text TEXT,
+        file_url TEXT,
+        filename TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+'''
+
+LEGACY_MESSAGES = [
+    ('m-1', 'c-1', 'u-alice', 'text', 'hello bob', '2023-01-01 10:00:00'),
+    ('m-2', 'c-1', 'u-bob', 'text', 'hello alice', '2023-01-01 10:01:00'),
+    ('m-3', 'c-1', 'u-alice', 'image', None, '2023-01-01 10:02:00'),
+    ('m-4', 'c-2', 'u-bob', 'text', 'quarterly report', '2023-01-02 09:00:00'),
+]
+
+
+def create_legacy_db(path):
+    """База со схемой и данными до первой миграции"""
+    conn = sqlite3.connect(path)
+    conn.executescript(LEGACY_SCHEMA)
+    conn.executemany('INSERT INTO users (id, username, email, password_hash) VALUES (?, ?, ?, ?)', [
+        ('u-alice', 'alice', 'alice@example.com', 'legacy-hash'),
+        ('u-bob', 'bob', 'bob@example.com', 'legacy-hash'),
+    ])
+    conn.executemany("INSERT INTO chats (id, type, creator_id) VALUES (?, 'private', 'u-alice')", [('c-1',), ('c-2',)])
+    conn.executemany('INSERT INTO chat_participants (chat_id, user_id) VALUES (?, ?)', [
+        ('c-1', 'u-alice'), ('c-1', 'u-bob'), ('c-2', 'u-bob'),
+    ])
+    conn.executemany(
+        'INSERT INTO messages (id, chat_id, sender_id, type, text, created_at) VALUES (?, ?, ?, ?, ?, ?)',
+        LEGACY_MESSAGES
+    )
+    conn.commit()
+    conn.close()
+
+
+async def migrate(path):
+    db = await aiosqlite.connect(path)
+    try:
+        return await apply_migrations(db)
+    finally:
+        await db.close()
+
+
+def connect(path):
+    conn = sqlite3.connect(path)
+    conn.row_factory = sqlite3.Row
+    return conn
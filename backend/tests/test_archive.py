@@ -0,0 +1,93 @@
+import asyncio
+
+import pytest
+
+from archive import ArchiveIndex, ArchiveStore, Segment, write_segment
+
+
+def make_messages(first, last, chat_id='c-1'):
+    return [
+        {
+            'id': f'm-{seq}', 'chat_id': chat_id, 'seq': seq, 'sender_username': 'alice',
+            'type': 'text', 'text': f'message number {seq}', 'file_url': None, 'filename': None,
+            'timestamp': f'2024-01-01 00:00:{seq % 60:02d}'
+        }
+        for seq in range(first, last + 1)
+    ]
+
+
+@pytest.fixture
+def segment(tmp_path):
+    path = tmp_path / 'c-1.seg'
+    write_segment(path, make_messages(1, 100), block_messages=8)
+    segment = Segment(path)
+    yield segment
+    segment.close()
+
+
+def seqs(messages):
+    return [m['seq'] for m in messages]
+
+
+def test_segment_reads_ranges_across_blocks(segment):
+    assert seqs(segment.read(1, 100, 1000)) == list(range(1, 101))
+    assert seqs(segment.read(7, 18, 1000)) == list(range(7, 19))
+    assert seqs(segment.read(30, 100, 5)) == [30, 31, 32, 33, 34]
+    assert segment.read(101, 200, 10) == []
+
+
+def test_segment_reads_descending(segment):
+    assert seqs(segment.read(1, 100, 3, descending=True)) == [100, 99, 98]
+    assert seqs(segment.read(5, 17, 4, descending=True)) == [17, 16, 15, 14]
+
+
+def test_store_discards_and_reopens_segments(tmp_path):
+    async def scenario():
+        store = ArchiveStore(tmp_path / 'archive', block_messages=4, open_segments=1)
+        store.prepare()
+        first = store.new_path('chat-ab', 1, 10)
+        second = store.new_path('chat-ab', 11, 20)
+        await store.write(first, make_messages(1, 10))
+        await store.write(second, make_messages(11, 20))
+
+        # Одно открытое отображение: чтения по очереди вытесняют друг друга
+        assert seqs(await store.read(first, 3, 5, 10)) == [3, 4, 5]
+        assert seqs(await store.read(second, 19, 20, 10)) == [19, 20]
+        assert seqs(await store.read(first, 10, 10, 10)) == [10]
+
+        await store.discard(first)
+        assert not (store.root / first).exists()
+        await store.close()
+
+    asyncio.run(scenario())
+
+
+def test_index_finds_archived_text_only_in_given_chats(tmp_path):
+    async def scenario():
+        index = ArchiveIndex(tmp_path / 'search.db')
+        await index.open()
+        messages = make_messages(1, 5) + make_messages(6, 7, chat_id='c-2')
+        messages[2]['text'] = 'Ёлка на площади'
+        messages[5]['text'] = 'ёлка во дворе'
+        messages[6]['text'] = None
+
+        assert await index.add('seg-1', messages)
+        # Повторная индексация того же сегмента ничего не добавляет
+        assert not await index.add('seg-1', messages)
+        assert await index.indexed() == {'seg-1'}
+
+        rows = await index.search('"ёлка"', ['c-1', 'c-2'], 100, 10)
+        assert sorted(row['id'] for row in rows) == ['m-3', 'm-6']
+        rows = await index.search('"ёлка"', ['c-2'], 100, 10)
+        assert [(row['id'], row['sender_username']) for row in rows] == [('m-6', 'alice')]
+        assert '<mark>ёлка</mark>' in rows[0]['snippet']
+        assert await index.search('"ёлка"', ['c-3'], 100, 10) == []
+        await index.close()
+
+        # Индекс переживает перезапуск
+        index = ArchiveIndex(tmp_path / 'search.db')
+        await index.open()
+        assert len(await index.search('"number"', ['c-1'], 100, 10)) == 4
+        await index.close()
+
+    asyncio.run(scenario())
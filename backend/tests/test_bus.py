@@ -0,0 +1,130 @@
+import asyncio
+import sqlite3
+
+import pytest
+
+from bus import SQLiteBus
+
+
+class Inbox:
+    def __init__(self):
+        self.events = []
+
+    async def __call__(self, channel, message):
+        self.events.append((channel, message))
+
+    def channel(self, name):
+        return [message for channel, message in self.events if channel == name]
+
+
+async def wait_for(condition, timeout=2.0):
+    deadline = asyncio.get_running_loop().time() + timeout
+    while not condition():
+        if asyncio.get_running_loop().time() > deadline:
+            raise AssertionError('condition not met')
+        await asyncio.sleep(0.01)
+
+
+async def crash(bus):
+    """Остановить воркер без штатного закрытия: отметка в bus_workers остаётся"""
+    for task in (bus._task, bus._flusher):
+        task.cancel()
+    await asyncio.gather(bus._task, bus._flusher, return_exceptions=True)
+    bus._conn.close()
+    bus._executor.shutdown(wait=False)
+
+
+@pytest.fixture
+def bus_path(tmp_path):
+    return str(tmp_path / 'bus.db')
+
+
+def make_bus(path, **kwargs):
+    kwargs.setdefault('poll_interval', 0.01)
+    return SQLiteBus(path, **kwargs)
+
+
+def test_events_reach_local_and_remote_workers(bus_path):
+    async def scenario():
+        a, b = make_bus(bus_path), make_bus(bus_path)
+        inbox_a, inbox_b = Inbox(), Inbox()
+        await a.start(inbox_a)
+        await b.start(inbox_b)
+        await a.publish('event', {'n': 1})
+        await wait_for(lambda: inbox_b.channel('event'))
+        await a.close()
+        await b.close()
+        return inbox_a.channel('event'), inbox_b.channel('event')
+
+    local, remote = asyncio.run(scenario())
+    assert local == remote == [{'n': 1}]
+
+
+def test_concurrent_publishes_share_transactions(bus_path):
+    async def scenario():
+        a, b = make_bus(bus_path), make_bus(bus_path)
+        inbox_b = Inbox()
+        await a.start(Inbox())
+        await b.start(inbox_b)
+        await asyncio.gather(*(a.publish('typing', {'n': i}) for i in range(200)))
+        await wait_for(lambda: len(inbox_b.events) == 200)
+        stats = a.stats()
+        await a.close()
+        await b.close()
+        return stats, [message['n'] for message in inbox_b.channel('typing')]
+
+    stats, received = asyncio.run(scenario())
+    assert received == list(range(200))
+    assert stats['batches'] < 10
+
+
+def test_crashed_worker_is_reported_once(bus_path):
+    async def scenario():
+        timing = {'heartbeat_interval': 0.05, 'worker_timeout': 0.3}
+        dead, b, c = make_bus(bus_path, **timing), make_bus(bus_path, **timing), make_bus(bus_path, **timing)
+        inbox_b, inbox_c = Inbox(), Inbox()
+        await dead.start(Inbox())
+        await b.start(inbox_b)
+        await c.start(inbox_c)
+        await crash(dead)
+        await wait_for(lambda: inbox_b.channel('worker_down') and inbox_c.channel('worker_down'))
+        await asyncio.sleep(0.2)
+        await b.close()
+        await c.close()
+        return dead.worker_id, inbox_b.channel('worker_down'), inbox_c.channel('worker_down')
+
+    dead_id, seen_b, seen_c = asyncio.run(scenario())
+    assert [m['worker_id'] for m in seen_b] == [dead_id]
+    assert seen_b == seen_c
+    assert seen_b[0]['reported_by'] in {m['reported_by'] for m in seen_c}
+
+
+def test_closed_worker_is_not_reported(bus_path):
+    async def scenario():
+        timing = {'heartbeat_interval': 0.05, 'worker_timeout': 0.2}
+        a, b = make_bus(bus_path, **timing), make_bus(bus_path, **timing)
+        inbox_b = Inbox()
+        await a.start(Inbox())
+        await b.start(inbox_b)
+        await a.close()
+        await asyncio.sleep(0.5)
+        await b.close()
+        return inbox_b.channel('worker_down')
+
+    assert asyncio.run(scenario()) == []
+
+
+def test_worker_rejoins_after_its_heartbeat_was_removed(bus_path):
+    async def scenario():
+        a = make_bus(bus_path, heartbeat_interval=0.05)
+        inbox = Inbox()
+        await a.start(inbox)
+        conn = sqlite3.connect(bus_path)
+        conn.execute('DELETE FROM bus_workers WHERE worker_id = ?', (a.worker_id,))
+        conn.commit()
+        conn.close()
+        await wait_for(lambda: inbox.channel('worker_rejoined'))
+        await a.close()
+        return inbox.channel('worker_rejoined')
+
+    assert len(asyncio.run(scenario())) == 1
@@ -0,0 +1,77 @@
+from cache import MESSAGE_OVERHEAD, MessageCache
+
+
+def message(seq, chat_id='c-1'):
+    return {'id': f'{chat_id}-{seq}', 'chat_id': chat_id, 'seq': seq, 'text': 'x'}
+
+
+def page(first, last, chat_id='c-1'):
+    return [message(seq, chat_id) for seq in range(first, last + 1)]
+
+
+def filled(cache, chat_id, messages):
+    cache.fill(chat_id, cache.begin_fill(chat_id), messages)
+
+
+def seqs(messages):
+    return [m['seq'] for m in messages]
+
+
+def test_latest_hits_after_fill_and_keeps_per_chat_tail():
+    cache = MessageCache(per_chat=5)
+    assert cache.latest('c-1', 3) is None
+
+    filled(cache, 'c-1', page(1, 8))
+    messages, has_more = cache.latest('c-1', 3)
+    assert seqs(messages) == [6, 7, 8] and has_more
+    # В хвосте только 5 сообщений и не с первого — за большей страницей в БД
+    assert cache.latest('c-1', 6) is None
+    assert cache.stats()['hits'] == 1 and cache.stats()['misses'] == 2
+
+
+def test_short_history_is_complete():
+    cache = MessageCache(per_chat=5)
+    filled(cache, 'c-1', page(1, 2))
+    messages, has_more = cache.latest('c-1', 50)
+    assert seqs(messages) == [1, 2] and not has_more
+
+
+def test_append_extends_tail_and_gap_invalidates():
+    cache = MessageCache(per_chat=3)
+    filled(cache, 'c-1', page(1, 3))
+
+    cache.append(message(4))
+    cache.append(message(4))
+    assert seqs(cache.latest('c-1', 3)[0]) == [2, 3, 4]
+    assert seqs(cache.since('c-1', 2)) == [3, 4]
+    assert cache.since('c-1', 0) is None
+
+    cache.append(message(6))
+    assert cache.latest('c-1', 1) is None
+    assert cache.stats()['invalidations'] == 1 and cache.bytes == 0
+
+
+def test_fill_is_dropped_when_chat_was_written_during_read():
+    cache = MessageCache()
+    token = cache.begin_fill('c-1')
+    cache.append(message(3))
+    cache.fill('c-1', token, page(1, 2))
+    assert cache.latest('c-1', 1) is None
+
+    # Следующее чтение уже видит новое сообщение и кешируется
+    filled(cache, 'c-1', page(1, 3))
+    assert seqs(cache.latest('c-1', 1)[0]) == [3]
+
+
+def test_chats_are_evicted_by_bytes_in_lru_order():
+    size = MESSAGE_OVERHEAD + len('c-1-1') + len('x') + len('c-1')
+    cache = MessageCache(per_chat=10, max_bytes=size * 4)
+    filled(cache, 'a', page(1, 2, 'a'))
+    filled(cache, 'b', page(1, 2, 'b'))
+    cache.latest('a', 1)
+    filled(cache, 'c', page(1, 2, 'c'))
+
+    assert cache.latest('b', 1) is None
+    assert cache.latest('a', 1) is not None and cache.latest('c', 1) is not None
+    assert cache.stats()['evictions'] == 1
+    assert cache.bytes <= cache.max_bytes
@@ -0,0 +1,27 @@
+from directory import UserDirectory
+
+
+def names(users):
+    return [user[0] for user in users]
+
+
+def test_prefix_is_case_insensitive_and_sorted():
+    directory = UserDirectory()
+    directory.load([('u1', 'bob', 'a1'), ('u2', 'Alice', 'a2'), ('u3', 'alex', 'a3'), ('u4', 'carol', 'a4')])
+
+    assert names(directory.prefix('AL', 10)) == ['alex', 'Alice']
+    assert directory.prefix('bo', 10) == [('bob', 'u1', 'a1')]
+    assert directory.prefix('z', 10) == []
+    assert names(directory.prefix('', 2)) == ['alex', 'Alice']
+
+
+def test_add_keeps_order_and_ignores_repeats():
+    directory = UserDirectory()
+    directory.load([('u1', 'bob', None)])
+    directory.add('u2', 'Anna', None)
+    directory.add('u2', 'Anna', None)
+    directory.add('u3', 'anna', None)
+
+    assert len(directory) == 3
+    assert [user[1] for user in directory.prefix('ann', 10)] == ['u2', 'u3']
+    assert names(directory.prefix('', 10)) == ['Anna', 'anna', 'bob']
@@ -0,0 +1,127 @@
+import asyncio
+import json
+
+from fanout import (
+    OutboundConnection, SlowConsumerPolicy, encode_batch, encode_event, expand_value, fan_out
+)
+
+
+class FakeSocket:
+    """WebSocket, который запоминает отправленные кадры"""
+
+    def __init__(self, fail=False):
+        self.sent = []
+        self.closed = False
+        self.close_code = None
+        self.fail = fail
+
+    async def send_str(self, frame):
+        if self.fail:
+            raise ConnectionResetError('gone')
+        self.sent.append(frame)
+
+    async def close(self, code=None, message=b''):
+        self.closed = True
+        self.close_code = code
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def test_frames_are_delivered_in_order():
+    async def scenario():
+        ws = FakeSocket()
+        conn = OutboundConnection(ws, SlowConsumerPolicy())
+        for i in range(3):
+            assert conn.send_event('new_message', {'i': i})
+        await asyncio.sleep(0.01)
+        await conn.close()
+        return ws.sent
+
+    sent = run(scenario())
+    assert [json.loads(frame)['data']['i'] for frame in sent] == [0, 1, 2]
+
+
+def test_ephemeral_events_dropped_above_watermark():
+    async def scenario():
+        conn = OutboundConnection(FakeSocket(), SlowConsumerPolicy(max_queue=8, ephemeral_watermark=2))
+        results = [conn.enqueue('x', ephemeral=True) for _ in range(4)]
+        results.append(conn.enqueue('message'))
+        await conn.close()
+        return results, conn.dropped
+
+    results, dropped = run(scenario())
+    assert results == [True, True, False, False, True]
+    assert dropped == 2
+
+
+def test_full_queue_evicts_and_closes_socket():
+    async def scenario():
+        ws = FakeSocket()
+        conn = OutboundConnection(ws, SlowConsumerPolicy(max_queue=2))
+        assert conn.enqueue('a') and conn.enqueue('b')
+        assert not conn.enqueue('c')
+        assert conn.closed
+        assert not conn.enqueue('d')
+        await conn.close()
+        return ws
+
+    ws = run(scenario())
+    assert ws.closed and ws.close_code is not None
+
+
+def test_send_failure_stops_accepting_frames():
+    async def scenario():
+        conn = OutboundConnection(FakeSocket(fail=True), SlowConsumerPolicy())
+        assert conn.enqueue('a')
+        await asyncio.sleep(0.01)
+        accepted = conn.enqueue('b')
+        delivered = fan_out([conn], 'new_message', {})
+        await conn.close()
+        return conn.closed, accepted, delivered
+
+    assert run(scenario()) == (True, False, 0)
+
+
+def test_fan_out_encodes_once_per_encoding():
+    async def scenario():
+        sockets = [FakeSocket() for _ in range(3)]
+        conns = [
+            OutboundConnection(sockets[0], SlowConsumerPolicy()),
+            OutboundConnection(sockets[1], SlowConsumerPolicy(), compact=True),
+            OutboundConnection(sockets[2], SlowConsumerPolicy()),
+        ]
+        sockets[2].closed = True
+        delivered = fan_out(conns, 'new_message', {'chat_id': 'c1', 'text': 'hi', 'file_url': None})
+        await asyncio.sleep(0.01)
+        for conn in conns:
+            await conn.close()
+        return delivered, [ws.sent for ws in sockets]
+
+    delivered, sent = run(scenario())
+    assert delivered == 2
+    assert json.loads(sent[0][0]) == {'type': 'new_message', 'data': {'chat_id': 'c1', 'text': 'hi', 'file_url': None}}
+    assert json.loads(sent[1][0]) == {'t': 'new_message', 'd': {'c': 'c1', 'x': 'hi'}}
+    assert sent[2] == []
+
+
+def test_batch_window_coalesces_frames():
+    async def scenario():
+        ws = FakeSocket()
+        conn = OutboundConnection(ws, SlowConsumerPolicy(), batch_window=0.01)
+        conn.send_event('a', 1)
+        conn.send_event('b', 2)
+        await asyncio.sleep(0.05)
+        await conn.close()
+        return ws.sent
+
+    sent = run(scenario())
+    assert len(sent) == 1
+    assert [event['type'] for event in json.loads(sent[0])['data']] == ['a', 'b']
+
+
+def test_compact_batch_round_trip():
+    frames = [encode_event('user_status', {'username': 'bob', 'status': 'online'}, compact=True)]
+    decoded = expand_value(json.loads(encode_batch(frames, compact=True)))
+    assert decoded == {'type': 'batch', 'data': [{'type': 'user_status', 'data': {'username': 'bob', 'status': 'online'}}]}
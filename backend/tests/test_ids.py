@@ -0,0 +1,55 @@
+import pytest
+
+import ids
+from ids import ALPHABET, encode, generate_id, generate_token
+
+
+def decode(text):
+    value = 0
+    for char in text:
+        value = value * 32 + ALPHABET.index(char)
+    return value
+
+
+@pytest.fixture(autouse=True)
+def clock_state(monkeypatch):
+    # Сдвинутые тестом часы не должны остаться в состоянии генератора
+    monkeypatch.setattr(ids, '_last_ms', 0)
+    monkeypatch.setattr(ids, '_last_random', 0)
+
+
+def test_encode_is_fixed_width_and_ordered():
+    assert encode(0) == '0' * 26
+    assert decode(encode(12345678901234567890)) == 12345678901234567890
+    assert encode(31) < encode(32) < encode(1 << 100)
+
+
+def test_ids_are_monotonic_within_one_millisecond(monkeypatch):
+    monkeypatch.setattr(ids.time, 'time_ns', lambda: 1_700_000_000_000 * 1_000_000)
+    generated = [generate_id() for _ in range(100)]
+
+    assert generated == sorted(generated) and len(set(generated)) == 100
+    assert all(set(value) <= set(ALPHABET) and len(value) == 26 for value in generated)
+    assert decode(generated[0]) >> ids.RANDOM_BITS == 1_700_000_000_000
+
+
+def test_clock_going_back_does_not_break_order(monkeypatch):
+    monkeypatch.setattr(ids.time, 'time_ns', lambda: 1_800_000_000_000 * 1_000_000)
+    before = generate_id()
+    monkeypatch.setattr(ids.time, 'time_ns', lambda: 1_799_999_999_000 * 1_000_000)
+    after = generate_id()
+
+    assert after > before
+    assert decode(after) >> ids.RANDOM_BITS == 1_800_000_000_000
+
+
+def test_random_overflow_moves_to_next_millisecond(monkeypatch):
+    monkeypatch.setattr(ids.time, 'time_ns', lambda: 1_900_000_000_000 * 1_000_000)
+    generate_id()
+    monkeypatch.setattr(ids, '_last_random', ids.RANDOM_MAX)
+    value = generate_id()
+    assert decode(value) >> ids.RANDOM_BITS == 1_900_000_000_001
+
+
+def test_tokens_are_random():
+    assert generate_token() != generate_token()
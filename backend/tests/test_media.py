@@ -0,0 +1,101 @@
+import asyncio
+import hashlib
+import os
+import time
+
+import pytest
+
+from media import MediaStore, UploadBusy, UploadConflict, UploadMismatch
+
+
+class Stream:
+    """Минимальная замена request.content"""
+
+    def __init__(self, data):
+        self.data = data
+
+    async def iter_chunked(self, size):
+        for start in range(0, len(self.data), size):
+            yield self.data[start:start + size]
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = MediaStore(tmp_path / 'media')
+    store.prepare()
+    return store
+
+
+def test_writing_lock_is_released_on_any_exit(store):
+    with store.writing('u1'):
+        assert store.busy('u1')
+        with pytest.raises(UploadBusy):
+            with store.writing('u1'):
+                pass
+    assert not store.busy('u1')
+
+    with pytest.raises(UploadConflict):
+        with store.writing('u1'):
+            asyncio.run(store.append('u1', 5, 10, Stream(b'abc')))
+    assert not store.busy('u1')
+
+
+def test_append_and_finalize_deduplicate(store):
+    async def upload(upload_id):
+        with store.writing(upload_id):
+            assert await store.append(upload_id, 0, 6, Stream(b'abc')) == 3
+            assert await store.append(upload_id, 3, 6, Stream(b'def')) == 6
+            return await store.finalize(upload_id)
+
+    first = asyncio.run(upload('u1'))
+    second = asyncio.run(upload('u2'))
+
+    assert first == second
+    assert store.blob_path(first).read_bytes() == b'abcdef'
+    assert not store.part_path('u1').exists() and not store.part_path('u2').exists()
+
+
+def test_lock_is_shared_between_processes(store, tmp_path):
+    # Отдельный MediaStore открывает файл заново — как другой воркер
+    other = MediaStore(tmp_path / 'media')
+    with store.writing('u1'):
+        assert other.busy('u1')
+        try:
+            with other.writing('u1'):
+                raise AssertionError('second writer got the lock')
+        except UploadBusy:
+            pass
+    with other.writing('u1'):
+        assert store.busy('u1')
+
+
+def test_finalize_rejects_wrong_declared_hash(store):
+    async def upload(upload_id, expected):
+        with store.writing(upload_id):
+            await store.append(upload_id, 0, 3, Stream(b'abc'))
+            return await store.finalize(upload_id, expected)
+
+    with pytest.raises(UploadMismatch) as error:
+        asyncio.run(upload('u1', '0' * 64))
+    assert error.value.digest == hashlib.sha256(b'abc').hexdigest()
+    assert not store.part_path('u1').exists()
+    assert not store.has_blob(error.value.digest)
+
+    digest = asyncio.run(upload('u2', hashlib.sha256(b'abc').hexdigest()))
+    assert store.has_blob(digest)
+
+
+def test_stale_parts_skip_fresh_and_busy_uploads(store):
+    old = time.time() - 7200
+    for upload_id in ('idle', 'busy', 'fresh'):
+        store.part_path(upload_id).write_bytes(b'x')
+    for upload_id in ('idle', 'busy'):
+        os.utime(store.part_path(upload_id), (old, old))
+
+    with store.writing('busy'):
+        assert store.stale_parts(3600) == {'idle'}
+        store.discard('busy')
+        assert store.part_path('busy').exists()
+
+    store.discard('idle')
+    assert not store.part_path('idle').exists()
@@ -0,0 +1,259 @@
+import asyncio
+import sqlite3
+
+import pytest
+
+import migrations
+from legacy import LEGACY_MESSAGES, connect, migrate
+from migrations import MIGRATIONS
+
+LATEST = max(version for version, _ in MIGRATIONS)
+
+
+def migrate_up_to(path, version, monkeypatch):
+    """Применить цепочку только до version — как база, обновлённая старой версией кода"""
+    with monkeypatch.context() as patch:
+        patch.setattr(migrations, 'MIGRATIONS', [m for m in MIGRATIONS if m[0] <= version])
+        assert asyncio.run(migrate(path)) == version
+
+
+def table_exists(conn, name):
+    return conn.execute('SELECT 1 FROM sqlite_master WHERE name = ?', (name,)).fetchone() is not None
+
+
+def columns(conn, table):
+    return {row[1] for row in conn.execute(f'PRAGMA table_info({table})')}
+
+
+def test_chain_upgrades_legacy_database(legacy_db):
+    assert asyncio.run(migrate(legacy_db)) == LATEST
+
+    conn = connect(legacy_db)
+    try:
+        assert conn.execute('PRAGMA user_version').fetchone()[0] == LATEST
+        assert conn.execute('PRAGMA integrity_check').fetchone()[0] == 'ok'
+        assert table_exists(conn, 'idx_chat_participants_user')
+
+        rows = conn.execute('SELECT id, chat_id, text, created_at FROM messages ORDER BY rowid').fetchall()
+        assert [tuple(r) for r in rows] == [(m[0], m[1], m[4], m[5]) for m in LEGACY_MESSAGES]
+        assert conn.execute('SELECT COUNT(*) FROM chat_participants').fetchone()[0] == 3
+    finally:
+        conn.close()
+
+
+def test_chain_is_idempotent(legacy_db):
+    assert asyncio.run(migrate(legacy_db)) == LATEST
+    conn = connect(legacy_db)
+    schema = conn.execute('SELECT sql FROM sqlite_master ORDER BY name').fetchall()
+    conn.close()
+
+    assert asyncio.run(migrate(legacy_db)) == LATEST
+
+    conn = connect(legacy_db)
+    try:
+        assert conn.execute('SELECT sql FROM sqlite_master ORDER BY name').fetchall() == schema
+        assert conn.execute('SELECT COUNT(*) FROM messages').fetchone()[0] == len(LEGACY_MESSAGES)
+    finally:
+        conn.close()
+
+
+def test_chain_resumes_from_intermediate_version(legacy_db, monkeypatch):
+    migrate_up_to(legacy_db, 1, monkeypatch)
+
+    assert asyncio.run(migrate(legacy_db)) == LATEST
+
+    conn = connect(legacy_db)
+    try:
+        assert conn.execute('SELECT COUNT(*) FROM messages').fetchone()[0] == len(LEGACY_MESSAGES)
+    finally:
+        conn.close()
+
+
+def test_failed_migration_is_rolled_back(legacy_db, monkeypatch):
+    async def broken(db):
+        await db.execute('CREATE TABLE half_done (id INTEGER)')
+        raise RuntimeError('boom')
+
+    monkeypatch.setattr(migrations, 'MIGRATIONS', MIGRATIONS + [(LATEST + 1, broken)])
+    with pytest.raises(RuntimeError):
+        asyncio.run(migrate(legacy_db))
+
+    conn = connect(legacy_db)
+    try:
+        assert conn.execute('PRAGMA user_version').fetchone()[0] == LATEST
+        assert not table_exists(conn, 'half_done')
+    finally:
+        conn.close()
+
+
+def test_sessions_get_expiry_timestamp(legacy_db, monkeypatch):
+    migrate_up_to(legacy_db, 3, monkeypatch)
+    conn = connect(legacy_db)
+    conn.execute("INSERT INTO sessions (id, user_id, created_at) VALUES ('s-1', 'u-bob', '2024-05-01 12:00:00')")
+    conn.commit()
+    conn.close()
+
+    asyncio.run(migrate(legacy_db))
+
+    conn = connect(legacy_db)
+    try:
+        session = conn.execute("SELECT user_id, last_seen FROM sessions WHERE id = 's-1'").fetchone()
+        assert tuple(session) == ('u-bob', '2024-05-01 12:00:00')
+        assert table_exists(conn, 'idx_sessions_last_seen')
+    finally:
+        conn.close()
+
+
+def test_uploads_and_media_tables(legacy_db):
+    asyncio.run(migrate(legacy_db))
+
+    conn = connect(legacy_db)
+    try:
+        assert {'id', 'user_id', 'filename', 'mime', 'size', 'created_at', 'sha256'} <= columns(conn, 'uploads')
+        assert {'hash', 'size', 'mime'} <= columns(conn, 'media')
+    finally:
+        conn.close()
+
+
+def test_archive_text_leaves_live_database(legacy_db, monkeypatch):
+    migrate_up_to(legacy_db, 10, monkeypatch)
+    conn = connect(legacy_db)
+    conn.execute('''
+        INSERT INTO archived_messages (pk, id, chat_id, sender_id, type, text, created_at)
+        VALUES (1000, 'm-old', 'c-1', 'u-alice', 'text', 'archived secret', '2020-01-01 00:00:00')
+    ''')
+    conn.execute("INSERT INTO messages_fts (rowid, text) VALUES (1000, 'archived secret')")
+    conn.commit()
+    conn.close()
+
+    asyncio.run(migrate(legacy_db))
+
+    conn = connect(legacy_db)
+    try:
+        assert not table_exists(conn, 'archived_messages')
+        assert not table_exists(conn, 'searchable_messages')
+        assert conn.execute("SELECT COUNT(*) FROM messages_fts WHERE messages_fts MATCH 'secret'").fetchone()[0] == 0
+        found = conn.execute("SELECT rowid FROM messages_fts WHERE messages_fts MATCH 'hello' ORDER BY rowid").fetchall()
+        assert len(found) == 2
+
+        # Удалённое сообщение уходит из индекса
+        conn.execute('DELETE FROM messages WHERE pk = ?', (found[0][0],))
+        conn.commit()
+        assert conn.execute("SELECT COUNT(*) FROM messages_fts WHERE messages_fts MATCH 'hello'").fetchone()[0] == 1
+    finally:
+        conn.close()
+
+
+def test_unread_counters_become_read_pointers(legacy_db, monkeypatch):
+    migrate_up_to(legacy_db, 7, monkeypatch)
+    conn = connect(legacy_db)
+    conn.execute("UPDATE chat_participants SET unread_count = 2 WHERE chat_id = 'c-1' AND user_id = 'u-bob'")
+    conn.execute("UPDATE chat_participants SET unread_count = 5 WHERE chat_id = 'c-1' AND user_id = 'u-alice'")
+    conn.commit()
+    conn.close()
+
+    asyncio.run(migrate(legacy_db))
+
+    conn = connect(legacy_db)
+    try:
+        pointers = conn.execute('SELECT chat_id, user_id, last_read_seq FROM chat_participants ORDER BY chat_id, user_id')
+        assert [tuple(row) for row in pointers] == [('c-1', 'u-alice', 0), ('c-1', 'u-bob', 1), ('c-2', 'u-bob', 1)]
+        assert 'unread_count' not in columns(conn, 'chat_participants')
+    finally:
+        conn.close()
+
+
+def test_messages_get_integer_key_and_millisecond_timestamps(legacy_db):
+    conn = connect(legacy_db)
+    rowids = [row[0] for row in conn.execute('SELECT rowid FROM messages ORDER BY rowid')]
+    conn.close()
+
+    asyncio.run(migrate(legacy_db))
+
+    conn = connect(legacy_db)
+    try:
+        assert [row[0] for row in conn.execute('SELECT pk FROM messages ORDER BY pk')] == rowids
+        assert conn.execute("SELECT id, created_at FROM messages WHERE pk = ?", (rowids[0],)).fetchone()[:] == (
+            'm-1', '2023-01-01 10:00:00'
+        )
+        conn.execute("INSERT INTO messages (id, chat_id, sender_id, text, seq) VALUES ('m-5', 'c-2', 'u-bob', 'new', 2)")
+        created_at = conn.execute("SELECT created_at FROM messages WHERE id = 'm-5'").fetchone()[0]
+        assert len(created_at) == len('2024-01-01 00:00:00.000')
+        with pytest.raises(sqlite3.IntegrityError):
+            conn.execute("INSERT INTO messages (id, chat_id, sender_id, text, seq) VALUES ('m-5', 'c-2', 'u-bob', 'x', 3)")
+    finally:
+        conn.close()
+
+
+def test_summaries_are_backfilled_from_last_message(legacy_db):
+    conn = connect(legacy_db)
+    conn.execute("INSERT INTO chats (id, type, created_at) VALUES ('c-3', 'group', '2023-02-01 00:00:00')")
+    conn.commit()
+    conn.close()
+
+    asyncio.run(migrate(legacy_db))
+
+    conn = connect(legacy_db)
+    try:
+        summaries = conn.execute('''
+            SELECT chat_id, last_message_id, last_sender_username, last_message_type, last_message_text, last_activity
+            FROM chat_summaries ORDER BY chat_id
+        ''')
+        assert [tuple(row) for row in summaries] == [
+            ('c-1', 'm-3', 'alice', 'image', None, '2023-01-01 10:02:00'),
+            ('c-2', 'm-4', 'bob', 'text', 'quarterly report', '2023-01-02 09:00:00'),
+            ('c-3', None, None, None, None, '2023-02-01 00:00:00'),
+        ]
+    finally:
+        conn.close()
+
+
+def test_search_index_covers_legacy_history_and_follows_changes(legacy_db):
+    asyncio.run(migrate(legacy_db))
+
+    conn = connect(legacy_db)
+
+    def search(query):
+        return [row[0] for row in conn.execute(
+            'SELECT m.id FROM messages_fts JOIN messages m ON m.pk = messages_fts.rowid '
+            'WHERE messages_fts MATCH ? ORDER BY m.id', (query,)
+        )]
+
+    try:
+        assert search('hello') == ['m-1', 'm-2']
+        assert search('report*') == ['m-4']
+
+        conn.execute("INSERT INTO messages (id, chat_id, sender_id, text, seq) VALUES ('m-5', 'c-2', 'u-bob', 'Café report', 2)")
+        conn.execute("UPDATE messages SET text = 'goodbye bob' WHERE id = 'm-1'")
+        conn.execute("DELETE FROM messages WHERE id = 'm-4'")
+        conn.commit()
+
+        assert search('hello') == ['m-2']
+        assert search('goodbye') == ['m-1']
+        assert search('cafe report') == ['m-5']
+        assert conn.execute("INSERT INTO messages_fts (messages_fts) VALUES ('integrity-check')").fetchall() == []
+    finally:
+        conn.close()
+
+
+def test_history_is_numbered_per_chat(legacy_db, monkeypatch):
+    migrate_up_to(legacy_db, 5, monkeypatch)
+    conn = connect(legacy_db)
+    # Одинаковое время: порядок решает id
+    conn.execute("INSERT INTO messages (id, chat_id, sender_id, text, created_at) VALUES ('m-0', 'c-1', 'u-bob', 'tie', '2023-01-01 10:01:00')")
+    conn.commit()
+    conn.close()
+
+    asyncio.run(migrate(legacy_db))
+
+    conn = connect(legacy_db)
+    try:
+        numbered = conn.execute('SELECT chat_id, seq, id FROM messages ORDER BY chat_id, seq')
+        assert [tuple(row) for row in numbered] == [
+            ('c-1', 1, 'm-1'), ('c-1', 2, 'm-0'), ('c-1', 3, 'm-2'), ('c-1', 4, 'm-3'), ('c-2', 1, 'm-4'),
+        ]
+        assert dict(conn.execute('SELECT id, last_seq FROM chats').fetchall()) == {'c-1': 4, 'c-2': 1}
+        with pytest.raises(sqlite3.IntegrityError):
+            conn.execute("INSERT INTO messages (id, chat_id, sender_id, text, seq) VALUES ('m-9', 'c-2', 'u-bob', 'dup', 1)")
+    finally:
+        conn.close()
@@ -0,0 +1,48 @@
+import asyncio
+import hashlib
+
+import pytest
+
+from passwords import PasswordHasher
+
+
+@pytest.fixture
+def hasher():
+    # Маленький n: тесту важна логика формата, а не стоимость расчёта
+    hasher = PasswordHasher(n=2 ** 4, r=8, p=1, workers=1)
+    yield hasher
+    hasher.close()
+
+
+def test_hash_is_salted_and_verifies(hasher):
+    async def scenario():
+        first = await hasher.hash('secret')
+        second = await hasher.hash('secret')
+        assert first.startswith('scrypt$16$8$1$') and first != second
+
+        assert await hasher.verify('secret', first) == (True, False)
+        assert await hasher.verify('wrong', first) == (False, False)
+
+    asyncio.run(scenario())
+
+
+def test_legacy_sha256_is_accepted_once_and_marked_for_rehash(hasher):
+    legacy = hashlib.sha256(b'secret').hexdigest()
+    assert asyncio.run(hasher.verify('secret', legacy)) == (True, True)
+    assert asyncio.run(hasher.verify('wrong', legacy)) == (False, False)
+
+
+def test_changed_parameters_request_rehash(hasher):
+    async def scenario():
+        old = PasswordHasher(n=2 ** 3, r=8, p=1, workers=1)
+        stored = await old.hash('secret')
+        old.close()
+        assert await hasher.verify('secret', stored) == (True, True)
+        assert await hasher.verify('wrong', stored) == (False, False)
+
+    asyncio.run(scenario())
+
+
+def test_missing_or_broken_hash_is_rejected(hasher):
+    for stored in (None, '', 'scrypt$broken', 'scrypt$x$8$1$c2FsdA$a2V5'):
+        assert asyncio.run(hasher.verify('secret', stored)) == (False, False)
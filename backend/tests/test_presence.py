@@ -0,0 +1,99 @@
+import asyncio
+
+from presence import PresenceTracker, TypingTracker
+
+
+def test_local_status_changes_are_coalesced():
+    tracker = PresenceTracker()
+    assert tracker.set_status('u1', 'online')
+    assert not tracker.set_status('u1', 'online')
+    assert tracker.set_status('u2', 'online')
+    assert tracker.set_status('u2', 'offline')
+
+    assert tracker.pending() == 2
+    assert tracker.get_status('u1') == 'online'
+    assert tracker.get_status('unknown') is None
+
+
+def test_flush_writes_pending_once_and_keeps_them_on_error():
+    flushed = []
+
+    async def failing(updates):
+        raise RuntimeError('db down')
+
+    async def scenario():
+        tracker = PresenceTracker()
+        tracker.start(failing)
+        tracker.set_status('u1', 'online')
+        await tracker.flush()
+        assert tracker.pending() == 1
+
+        async def record(updates):
+            flushed.append(dict(updates))
+
+        tracker._flush = record
+        tracker.set_status('u2', 'online')
+        await tracker.flush()
+        await tracker.flush()
+        await tracker.close()
+
+    asyncio.run(scenario())
+    # Второй сброс пуст; при остановке воркер пишет offline своим пользователям
+    assert flushed == [{'u1': 'online', 'u2': 'online'}, {'u1': 'offline', 'u2': 'offline'}]
+
+
+def test_typing_is_throttled_and_expires():
+    expired = []
+
+    async def on_expire(chat_id, username):
+        expired.append((chat_id, username))
+
+    async def scenario():
+        tracker = TypingTracker(throttle=10, ttl=0.02, sweep_interval=0.01)
+        tracker.start(on_expire)
+        assert tracker.typing('c1', 'alice')
+        assert not tracker.typing('c1', 'alice')
+        assert tracker.typing('c1', 'bob')
+        assert tracker.stop_typing('c1', 'bob')
+        assert not tracker.stop_typing('c1', 'bob')
+        await asyncio.sleep(0.1)
+        await tracker.close()
+
+    asyncio.run(scenario())
+    assert expired == [('c1', 'alice')]
+
+
+def test_remote_workers_keep_user_online():
+    tracker = PresenceTracker()
+    tracker.apply_remote('w1', {'u1': 'online'})
+    tracker.apply_remote('w2', {'u1': 'online'})
+    tracker.apply_remote('w1', {'u1': 'offline'})
+    assert tracker.get_status('u1') == 'online'
+
+    tracker.apply_remote('w2', {'u1': 'offline'})
+    assert tracker.get_status('u1') == 'offline'
+
+
+def test_remote_offline_does_not_override_local_connection():
+    tracker = PresenceTracker()
+    tracker.set_status('u1', 'online')
+    tracker._dirty.clear()
+    tracker.apply_remote('w1', {'u1': 'offline'})
+
+    assert tracker.get_status('u1') == 'online'
+    assert tracker._dirty == {'u1': 'online'}
+
+
+def test_forget_worker_reports_users_left_offline():
+    tracker = PresenceTracker()
+    tracker.apply_remote('dead', {'u1': 'online', 'u2': 'online', 'u3': 'online'})
+    tracker.apply_remote('alive', {'u2': 'online'})
+    tracker.set_status('u3', 'online')
+
+    assert tracker.forget_worker('dead') == ['u1']
+    assert [tracker.get_status(u) for u in ('u1', 'u2', 'u3')] == ['offline', 'online', 'online']
+
+    tracker._dirty.clear()
+    tracker.republish(['u1'])
+    tracker.republish()
+    assert tracker._dirty == {'u1': 'offline', 'u3': 'online'}
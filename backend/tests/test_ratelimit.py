@@ -0,0 +1,72 @@
+import pytest
+
+import ratelimit
+from ratelimit import AdmissionControl, RateLimiter, parse_rule, parse_rules
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(ratelimit.time, 'monotonic', clock)
+    return clock
+
+
+def test_parse_rules():
+    assert parse_rule('2:10') == (2.0, 10.0)
+    assert parse_rule('0.5') == (0.5, 1.0)
+    assert parse_rule('5') == (5.0, 5.0)
+    assert parse_rule('0') is None
+    assert parse_rules('/api/a=1:5, /api/b=0,') == {'/api/a': (1.0, 5.0), '/api/b': None}
+
+
+def test_bucket_allows_burst_then_refills(clock):
+    limiter = RateLimiter()
+    rule = (2.0, 3.0)
+    assert [limiter.acquire('k', rule) for _ in range(3)] == [0.0, 0.0, 0.0]
+    assert limiter.acquire('k', rule) == pytest.approx(0.5)
+
+    clock.now += 0.5
+    assert limiter.acquire('k', rule) == 0.0
+    # Пополнение не превышает всплеск
+    clock.now += 100
+    assert [limiter.acquire('k', rule) for _ in range(4)][-1] == pytest.approx(0.5)
+    assert limiter.acquire('other', rule) == 0.0
+    assert limiter.acquire('k', None) == 0.0
+
+
+def test_least_recently_used_key_is_evicted(clock):
+    limiter = RateLimiter(max_keys=2)
+    rule = (1.0, 1.0)
+    limiter.acquire('a', rule)
+    limiter.acquire('b', rule)
+    limiter.acquire('a', rule)
+    limiter.acquire('c', rule)
+
+    assert len(limiter) == 2
+    # a тронут недавно и остался пустым; ведро b вытеснено и начинается заново полным
+    assert limiter.acquire('a', rule) > 0
+    assert limiter.acquire('b', rule) == 0.0
+    limiter.forget('b')
+    assert limiter.acquire('b', rule) == 0.0
+
+
+def test_admission_control_reports_reason():
+    state = {'lag': 0.0, 'queue': 0}
+    admission = AdmissionControl(lambda: state['lag'], lambda: state['queue'], max_loop_lag=0.5, max_write_queue=10)
+    assert admission.overloaded() is None
+
+    state['queue'] = 11
+    assert admission.overloaded() == 'write_queue'
+    state['lag'] = 1.0
+    assert admission.overloaded() == 'loop_lag'
+
+    admission.max_loop_lag = admission.max_write_queue = 0
+    assert admission.overloaded() is None
@@ -0,0 +1,67 @@
+import asyncio
+
+from receipts import ReceiptTracker
+
+
+def test_mark_keeps_only_the_furthest_pointer():
+    tracker = ReceiptTracker()
+    assert tracker.mark('c-1', 'u1', 'alice', 5)
+    assert not tracker.mark('c-1', 'u1', 'alice', 3)
+    assert not tracker.mark('c-1', 'u1', 'alice', 5)
+    assert tracker.mark('c-1', 'u1', 'alice', 7)
+
+    assert tracker.pointer('c-1', 'u1') == 7
+    assert tracker.pointer('c-1', 'u2') == 0
+    assert tracker.pending() == 1
+
+
+def test_flush_writes_once_and_announces_per_chat():
+    async def scenario():
+        written, announced = [], []
+
+        async def flush(updates):
+            written.append(updates)
+
+        async def publish(chat_id, readers):
+            announced.append((chat_id, readers))
+
+        tracker = ReceiptTracker(flush_interval=3600)
+        tracker.start(flush, publish)
+        tracker.mark('c-1', 'u1', 'alice', 2)
+        tracker.mark('c-1', 'u2', 'bob', 4)
+        tracker.mark('c-2', 'u1', 'alice', 1)
+        await tracker.close()
+
+        assert written == [{('c-1', 'u1'): 2, ('c-1', 'u2'): 4, ('c-2', 'u1'): 1}]
+        assert sorted(announced) == [('c-1', {'alice': 2, 'bob': 4}), ('c-2', {'alice': 1})]
+        assert tracker.pending() == 0
+
+    asyncio.run(scenario())
+
+
+def test_failed_flush_keeps_the_larger_pointer():
+    async def scenario():
+        attempts = []
+
+        async def flush(updates):
+            attempts.append(dict(updates))
+            if len(attempts) == 1:
+                # Пока шла неудачная запись, пользователь прочитал дальше
+                tracker.mark('c-1', 'u1', 'alice', 9)
+                raise RuntimeError('database is locked')
+
+        async def publish(chat_id, readers):
+            pass
+
+        tracker = ReceiptTracker(flush_interval=3600)
+        tracker.start(flush, publish)
+        tracker.mark('c-1', 'u1', 'alice', 5)
+        tracker.mark('c-1', 'u2', 'bob', 3)
+        await tracker.flush()
+        assert tracker.pointer('c-1', 'u1') == 9
+        assert tracker.pointer('c-1', 'u2') == 3
+
+        await tracker.close()
+        assert attempts[-1] == {('c-1', 'u1'): 9, ('c-1', 'u2'): 3}
+
+    asyncio.run(scenario())
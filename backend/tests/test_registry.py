@@ -0,0 +1,60 @@
+from registry import ConnectionRegistry
+
+
+def test_attach_and_detach_track_sessions_and_sockets():
+    registry = ConnectionRegistry()
+    registry.attach('s1', 'u1', 'conn1')
+    registry.attach('s2', 'u1', 'conn2')
+
+    assert registry.get_user('s1') == 'u1'
+    assert registry.is_online('u1')
+    assert registry.connection_count() == 2
+    assert registry.user_connection_count('u1') == 2
+    assert registry.user_connection_count('u1', 's1') == 1
+
+    registry.detach('s1', 'conn1')
+    assert registry.get_user('s1') is None
+    assert registry.is_online('u1')
+
+    registry.detach('s2', 'conn2')
+    assert not registry.is_online('u1')
+    assert registry.session_count() == 0
+    assert registry.connection_count() == 0
+
+
+def test_reconnect_replaces_socket_and_stale_detach_is_ignored():
+    registry = ConnectionRegistry()
+    registry.attach('s1', 'u1', 'old')
+    registry.attach('s1', 'u1', 'new')
+    assert registry.connection_count() == 1
+
+    registry.detach('s1', 'old')
+    assert registry.get_user('s1') == 'u1'
+    assert registry.connection_count() == 1
+
+    registry.detach('s1', 'new')
+    assert registry.connection_count() == 0
+
+
+def test_sockets_for_chat_returns_online_members_only():
+    registry = ConnectionRegistry()
+    registry.attach('s1', 'u1', 'conn1')
+    registry.attach('s2', 'u2', 'conn2')
+    registry.set_members('c1', ['u1', 'u3'])
+
+    assert registry.sockets_for_chat('c1') == ['conn1']
+    assert registry.sockets_for_chat('unknown') == []
+    assert registry.members('unknown') is None
+
+
+def test_members_cache_is_bounded_lru():
+    registry = ConnectionRegistry(max_chats=2)
+    registry.set_members('c1', ['u1'])
+    registry.set_members('c2', ['u2'])
+    registry.members('c1')
+    registry.set_members('c3', ['u3'])
+
+    assert registry.chat_count() == 2
+    assert registry.members('c2') is None
+    assert registry.members('c1') == {'u1'}
+    assert registry.members('c3') == {'u3'}
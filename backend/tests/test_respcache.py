@@ -0,0 +1,77 @@
+from aiohttp.test_utils import make_mocked_request
+
+from respcache import ResponseCache, etag_matches
+
+
+def test_bump_invalidates_dependent_entries():
+    cache = ResponseCache()
+    token = cache.begin()
+    cache.put('users', ['users'], b'[1]', token)
+    token = cache.begin()
+    cache.put('alice', [('user', 'a')], b'{}', token)
+
+    cache.bump(('user', 'a'))
+
+    assert cache.get('users') is not None
+    assert cache.get('alice') is None
+    assert cache.stats()['entries'] == 1
+
+
+def test_unrelated_change_during_fill_does_not_block_put():
+    cache = ResponseCache()
+    token = cache.begin()
+    cache.bump(('chat', 'other'))
+    cache.bump('users')
+    cache.put('chats', [('chats', 'a'), ('chat', 'c1')], b'[]', token)
+
+    assert cache.get('chats') is not None
+
+
+def test_change_of_own_scope_during_fill_is_not_cached():
+    cache = ResponseCache()
+    token = cache.begin()
+    cache.bump(('chat', 'c1'))
+    entry = cache.put('chats', [('chats', 'a'), ('chat', 'c1')], b'[]', token)
+
+    assert entry.body == b'[]'
+    assert cache.get('chats') is None
+
+    # Следующее построение, начатое после изменения, кешируется
+    token = cache.begin()
+    cache.put('chats', [('chats', 'a'), ('chat', 'c1')], b'[1]', token)
+    assert cache.get('chats').body == b'[1]'
+
+
+def test_size_bound_evicts_least_recently_used():
+    cache = ResponseCache(max_bytes=1300)
+    for key in ('a', 'b', 'c'):
+        cache.put(key, [], b'x' * 100, cache.begin())
+    cache.get('a')
+    cache.put('d', [], b'x' * 100, cache.begin())
+
+    assert cache.get('b') is None
+    assert cache.get('a') is not None
+    assert cache.bytes <= 1300
+
+    # Ответ больше всего кеша отдаётся, но не хранится
+    entry = cache.put('huge', [], b'x' * 2000, cache.begin())
+    assert entry.body and cache.get('huge') is None
+
+
+def test_respond_returns_304_for_matching_etag():
+    cache = ResponseCache()
+    entry = cache.put('k', [], b'{"a": 1}', cache.begin())
+
+    fresh = cache.respond(make_mocked_request('GET', '/'), entry)
+    assert fresh.status == 200 and fresh.headers['ETag'] == entry.etag
+
+    request = make_mocked_request('GET', '/', headers={'If-None-Match': f'"other", W/{entry.etag}'})
+    assert cache.respond(request, entry).status == 304
+    assert cache.stats()['not_modified'] == 1
+
+
+def test_etag_matches():
+    assert etag_matches('*', '"x"')
+    assert etag_matches('"a", "x"', '"x"')
+    assert not etag_matches('"a"', '"x"')
+    assert not etag_matches(None, '"x"')
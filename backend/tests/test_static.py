@@ -0,0 +1,73 @@
+import gzip
+from types import SimpleNamespace
+
+import pytest
+
+from static import MIN_COMPRESS_SIZE, REVALIDATE, StaticSite, accepted_encodings, brotli, write_if_changed
+
+
+def request(accept_encoding):
+    return SimpleNamespace(headers={'Accept-Encoding': accept_encoding})
+
+
+@pytest.fixture
+def site(tmp_path):
+    source = tmp_path / 'frontend'
+    source.mkdir()
+    (source / 'index.html').write_text(
+        '<link href="styles.css"><script src="app.js"></script><a href="https://example.com/x.js">', encoding='utf-8'
+    )
+    (source / 'app.js').write_text('console.log("app");\n' * 100)
+    (source / 'styles.css').write_text('a{}')
+    return StaticSite(source, tmp_path / 'build')
+
+
+def test_accepted_encodings_skips_q_zero():
+    assert accepted_encodings('gzip, br;q=0, deflate;q=0.5') == {'gzip', 'deflate'}
+    assert accepted_encodings('GZIP;q=bad, br') == {'br'}
+    assert accepted_encodings(None) == set()
+
+
+def test_build_hashes_assets_and_rewrites_index(site):
+    renamed = site.build()
+
+    assert set(renamed) == {'app.js', 'styles.css'}
+    assert renamed['app.js'].startswith('app.') and renamed['app.js'].endswith('.js')
+    html = (site.build_dir / 'index.html').read_text(encoding='utf-8')
+    assert f'src="/assets/{renamed["app.js"]}"' in html
+    assert f'href="/assets/{renamed["styles.css"]}"' in html
+    assert 'https://example.com/x.js' in html
+
+    # Маленький файл не сжимается, большой — есть gzip-вариант
+    assert not (site.build_dir / 'gzip' / renamed['styles.css']).exists()
+    compressed = (site.build_dir / 'gzip' / renamed['app.js']).read_bytes()
+    assert gzip.decompress(compressed) == (site.source / 'app.js').read_bytes()
+    assert len((site.source / 'app.js').read_bytes()) >= MIN_COMPRESS_SIZE
+
+
+def test_response_picks_best_accepted_variant(site):
+    name = site.build()['app.js']
+
+    response = site.response(request('gzip, br'), name, REVALIDATE)
+    assert response.headers['Content-Encoding'] == ('br' if brotli else 'gzip')
+    assert response.headers['Vary'] == 'Accept-Encoding'
+    assert response.headers['Content-Type'].endswith('javascript; charset=utf-8')
+
+    response = site.response(request('br;q=0, gzip'), name, REVALIDATE)
+    assert response.headers['Content-Encoding'] == 'gzip'
+
+    response = site.response(request('identity'), name, REVALIDATE)
+    assert 'Content-Encoding' not in response.headers
+    assert response.headers['Cache-Control'] == REVALIDATE
+
+
+def test_rebuild_keeps_unchanged_files(tmp_path):
+    path = tmp_path / 'file.txt'
+    write_if_changed(path, b'one')
+    mtime = path.stat().st_mtime_ns
+    write_if_changed(path, b'one')
+    assert path.stat().st_mtime_ns == mtime
+
+    write_if_changed(path, b'two')
+    assert path.read_bytes() == b'two'
+    assert [p.name for p in tmp_path.iterdir()] == ['file.txt']
@@ -0,0 +1,161 @@
+import asyncio
+import json
+
+import pytest
+
+from legacy import connect, migrate
+from storage import Storage
+from transfer import import_messages, normalize_record, normalize_timestamp, read_lines, split_lines
+
+
+@pytest.mark.parametrize('value, expected', [
+    ('2024-03-01T12:30:00', '2024-03-01 12:30:00.000'),
+    ('2024-03-01T15:30:00.250+03:00', '2024-03-01 12:30:00.250'),
+    (1709296200, '2024-03-01 12:30:00.000'),
+    (1709296200.5, '2024-03-01 12:30:00.500'),
+])
+def test_normalize_timestamp(value, expected):
+    assert normalize_timestamp(value) == expected
+
+
+@pytest.mark.parametrize('record, reason', [
+    ([], 'invalid record'),
+    ({'text': 'hi'}, 'invalid sender_username'),
+    ({'sender_username': 'alice', 'timestamp': True}, 'invalid timestamp'),
+    ({'sender_username': 'alice', 'timestamp': 'yesterday'}, 'invalid timestamp'),
+    ({'sender_username': 'alice', 'timestamp': 1e20}, 'invalid timestamp'),
+    ({'sender_username': 'alice', 'id': 'x' * 65}, 'invalid id'),
+    ({'sender_username': 'alice', 'text': 42}, 'invalid text'),
+    ({'sender_username': 'alice', 'type': {'kind': 'text'}}, 'invalid type'),
+    ({'sender_username': 'alice', 'file_url': ['a']}, 'invalid file_url'),
+])
+def test_normalize_record_rejects(record, reason):
+    with pytest.raises(ValueError, match=reason):
+        normalize_record(record)
+
+
+def test_normalize_record_defaults():
+    assert normalize_record({'sender_username': 'alice', 'id': '', 'text': 'hi'}) == {
+        'id': None,
+        'sender_username': 'alice',
+        'type': 'text',
+        'text': 'hi',
+        'file_url': None,
+        'filename': None,
+        'timestamp': None,
+    }
+
+
+def collect(chunks, max_length):
+    async def source():
+        for chunk in chunks:
+            yield chunk
+
+    async def run():
+        return [line async for line in split_lines(source(), max_length)]
+
+    return asyncio.run(run())
+
+
+def test_split_lines_across_chunks():
+    assert collect([b'ab', b'c\nd', b'e\n', b'f'], 8) == [b'abc', b'de', b'f']
+
+
+def test_split_lines_replaces_long_lines_once():
+    chunks = [b'ok\n', b'x' * 6, b'x' * 6, b'x' * 6 + b'\nok2\n', b'yyyyyyyyy\n']
+    assert collect(chunks, 8) == [b'ok', None, b'ok2', None]
+
+
+def test_read_lines_applies_the_same_length_limit(tmp_path):
+    path = tmp_path / 'history.ndjson'
+    path.write_bytes(b'short\n' + b'x' * 100 + b'\nlast')
+
+    async def run():
+        return [line async for line in read_lines(str(path), max_length=50)]
+
+    assert asyncio.run(run()) == [b'short', None, b'last']
+
+
+async def lines_of(*records):
+    for record in records:
+        yield json.dumps(record).encode()
+
+
+def run_import(path, chat_id, *records):
+    async def scenario():
+        storage = Storage(path, readers=1)
+        await storage.open()
+        try:
+            return await import_messages(storage, chat_id, lines_of(*records))
+        finally:
+            await storage.close()
+
+    return asyncio.run(scenario())
+
+
+@pytest.fixture
+def chat_db(legacy_db):
+    asyncio.run(migrate(legacy_db))
+    conn = connect(legacy_db)
+    # У bob одно непрочитанное сообщение в c-1
+    conn.execute("UPDATE chat_participants SET last_read_seq = 2 WHERE chat_id = 'c-1' AND user_id = 'u-bob'")
+    conn.commit()
+    conn.close()
+    return legacy_db
+
+
+def chat_state(path, chat_id):
+    conn = connect(path)
+    try:
+        last_seq = conn.execute('SELECT last_seq FROM chats WHERE id = ?', (chat_id,)).fetchone()[0]
+        unread = dict(conn.execute(
+            'SELECT user_id, ? - last_read_seq FROM chat_participants WHERE chat_id = ?', (last_seq, chat_id)
+        ).fetchall())
+        summary = conn.execute(
+            'SELECT last_message_id FROM chat_summaries WHERE chat_id = ?', (chat_id,)
+        ).fetchone()[0]
+        return last_seq, unread, summary
+    finally:
+        conn.close()
+
+
+def test_import_of_older_history_keeps_summary_and_unread(chat_db):
+    report = run_import(
+        chat_db, 'c-1',
+        {'id': 'old-1', 'sender_username': 'alice', 'text': 'from 2020', 'timestamp': '2020-01-01T00:00:00'},
+        {'id': 'old-2', 'sender_username': 'bob', 'text': 'also 2020', 'timestamp': '2020-01-02T00:00:00'},
+    )
+
+    assert report.to_dict() == {'imported': 2, 'duplicates': 0, 'skipped': 0, 'errors': []}
+    assert chat_state(chat_db, 'c-1') == (5, {'u-alice': 0, 'u-bob': 1}, 'm-3')
+
+
+def test_import_of_newer_message_updates_summary(chat_db):
+    run_import(
+        chat_db, 'c-1',
+        {'id': 'new-1', 'sender_username': 'alice', 'text': 'latest', 'timestamp': '2030-01-01T00:00:00'},
+        {'id': 'old-3', 'sender_username': 'alice', 'text': 'older', 'timestamp': '2021-01-01T00:00:00'},
+    )
+
+    assert chat_state(chat_db, 'c-1')[2] == 'new-1'
+
+
+def test_reimport_counts_duplicates_and_reports_foreign_ids(chat_db):
+    report = run_import(
+        chat_db, 'c-2',
+        {'id': 'm-4', 'sender_username': 'bob', 'text': 'same chat'},
+        {'id': 'm-1', 'sender_username': 'alice', 'text': 'belongs to c-1'},
+        {'id': 'fresh', 'sender_username': 'bob', 'text': 'new'},
+    )
+
+    assert report.to_dict() == {
+        'imported': 1,
+        'duplicates': 1,
+        'skipped': 1,
+        'errors': [{'line': 2, 'error': 'id belongs to another chat'}],
+    }
+    assert chat_state(chat_db, 'c-2')[0] == 2
+
+
+def test_import_into_missing_chat_returns_none(chat_db):
+    assert run_import(chat_db, 'nope', {'sender_username': 'bob', 'text': 'x'}) is None
@@ -0,0 +1,117 @@
+import asyncio
+import sqlite3
+
+import pytest
+
+from writer import GroupCommitWriter
+
+
+def make_db(path):
+    conn = sqlite3.connect(path)
+    conn.execute('CREATE TABLE items (id INTEGER PRIMARY KEY, name TEXT NOT NULL)')
+    conn.commit()
+    conn.close()
+
+
+def read_names(path):
+    conn = sqlite3.connect(path)
+    try:
+        return [row[0] for row in conn.execute('SELECT name FROM items ORDER BY id')]
+    finally:
+        conn.close()
+
+
+def insert(name):
+    return lambda conn: conn.execute('INSERT INTO items (name) VALUES (?)', (name,)).lastrowid
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    path = str(tmp_path / 'writer.db')
+    make_db(path)
+    return path
+
+
+def test_failed_operation_rolls_back_only_its_savepoint(db_path):
+    def half_written(conn):
+        conn.execute("INSERT INTO items (name) VALUES ('half')")
+        raise RuntimeError('boom')
+
+    async def scenario():
+        writer = GroupCommitWriter(db_path, window=0.05)
+        await writer.start()
+        try:
+            results = await asyncio.gather(
+                writer.submit(insert('first')),
+                writer.submit(half_written),
+                writer.submit(insert('last')),
+                return_exceptions=True
+            )
+            return results, writer.stats()
+        finally:
+            await writer.close()
+
+    results, stats = run(scenario())
+
+    assert isinstance(results[1], RuntimeError)
+    assert isinstance(results[0], int) and isinstance(results[2], int)
+    assert stats['batches'] == 1
+    assert stats['failures'] == 1
+    assert read_names(db_path) == ['first', 'last']
+
+
+def test_executemany_is_atomic(db_path):
+    async def scenario():
+        writer = GroupCommitWriter(db_path)
+        await writer.start()
+        try:
+            with pytest.raises(sqlite3.IntegrityError):
+                await writer.executemany([
+                    ("INSERT INTO items (name) VALUES ('kept?')", ()),
+                    ('INSERT INTO items (name) VALUES (NULL)', ()),
+                ])
+            return await writer.execute("INSERT INTO items (name) VALUES ('after')")
+        finally:
+            await writer.close()
+
+    assert run(scenario()) == 1
+    assert read_names(db_path) == ['after']
+
+
+def test_batches_are_capped_by_max_batch(db_path):
+    async def scenario():
+        writer = GroupCommitWriter(db_path, max_batch=4, window=0.05)
+        await writer.start()
+        try:
+            await asyncio.gather(*(writer.submit(insert(f'item{i}')) for i in range(10)))
+            return writer.stats()
+        finally:
+            await writer.close()
+
+    stats = run(scenario())
+
+    assert stats['operations'] == 10
+    assert stats['batch_size_max'] == 4
+    assert stats['batches'] == 3
+    assert len(read_names(db_path)) == 10
+
+
+def test_close_drains_queued_operations(db_path):
+    async def scenario():
+        writer = GroupCommitWriter(db_path, max_batch=8)
+        await writer.start()
+        pending = [asyncio.create_task(writer.submit(insert(f'item{i}'))) for i in range(50)]
+        # Даём задачам встать в очередь, но не ждём их фиксации
+        await asyncio.sleep(0)
+        assert writer.queue_depth() > 0
+        await writer.close()
+        return [task.result() for task in pending]
+
+    rowids = run(scenario())
+
+    assert rowids == list(range(1, 51))
+    assert read_names(db_path) == [f'item{i}' for i in range(50)]
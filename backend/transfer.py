@@ -0,0 +1,328 @@
+"""Экспорт и импорт истории чатов в NDJSON — по сообщению на строку.
+
+Импорт из командной строки (сервер может работать параллельно — WAL):
+
+    python transfer.py import --db messenger.db --chat <chat_id> history.ndjson
+
+Если сервер запущен, лучше POST /api/chats/{chat_id}/import: он ещё и
+сбрасывает кеш истории чата на всех воркерах.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import sys
+from datetime import datetime, timezone
+
+from ids import generate_id
+
+logger = logging.getLogger(__name__)
+
+# Сколько сообщений импортируется одной транзакцией
+IMPORT_BATCH_SIZE = 5000
+# Сколько ошибочных строк перечислять в отчёте
+MAX_REPORTED_ERRORS = 20
+# Строка длиннее пропускается как ошибочная
+MAX_LINE_BYTES = 1024 * 1024
+# Кусок чтения файла в CLI
+READ_CHUNK_SIZE = 64 * 1024
+MAX_ID_LENGTH = 64
+MAX_TYPE_LENGTH = 32
+
+
+def encode_lines(messages):
+    """Страница сообщений одним куском NDJSON"""
+    return ''.join(json.dumps(m, ensure_ascii=False) + '\n' for m in messages).encode()
+
+
+class ImportReport:
+    def __init__(self):
+        self.imported = 0
+        self.duplicates = 0
+        self.skipped = 0
+        self.errors = []
+
+    def error(self, line_number, reason):
+        self.skipped += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append({'line': line_number, 'error': reason})
+
+    def to_dict(self):
+        return {
+            'imported': self.imported,
+            'duplicates': self.duplicates,
+            'skipped': self.skipped,
+            'errors': self.errors,
+        }
+
+
+def normalize_timestamp(value):
+    """Время записи в формате created_at ('YYYY-MM-DD HH:MM:SS.SSS', UTC).
+    Принимает ISO 8601 (без зоны — UTC) и Unix-время в секундах"""
+    if isinstance(value, bool):
+        raise ValueError('invalid timestamp')
+    if isinstance(value, (int, float)):
+        moment = datetime.fromtimestamp(value, timezone.utc)
+    elif isinstance(value, str):
+        moment = datetime.fromisoformat(value.strip())
+        if moment.tzinfo is not None:
+            moment = moment.astimezone(timezone.utc)
+    else:
+        raise ValueError('invalid timestamp')
+    return moment.strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]
+
+
+def optional_string(record, field, max_length=None):
+    """Строковое поле записи; пустое или отсутствующее — None"""
+    value = record.get(field)
+    if value is None or value == '':
+        return None
+    if not isinstance(value, str) or (max_length and len(value) > max_length):
+        raise ValueError(f'invalid {field}')
+    return value
+
+
+def normalize_record(record):
+    """Проверить типы полей записи и привести время к формату БД.
+    ValueError с причиной — запись пропускается"""
+    if not isinstance(record, dict):
+        raise ValueError('invalid record')
+    username = record.get('sender_username')
+    if not isinstance(username, str) or not username:
+        raise ValueError('invalid sender_username')
+    timestamp = record.get('timestamp')
+    try:
+        timestamp = normalize_timestamp(timestamp) if timestamp not in (None, '') else None
+    except (ValueError, OverflowError, OSError):
+        raise ValueError('invalid timestamp')
+    return {
+        'id': optional_string(record, 'id', MAX_ID_LENGTH),
+        'sender_username': username,
+        'type': optional_string(record, 'type', MAX_TYPE_LENGTH) or 'text',
+        'text': optional_string(record, 'text'),
+        'file_url': optional_string(record, 'file_url'),
+        'filename': optional_string(record, 'filename'),
+        'timestamp': timestamp,
+    }
+
+
+async def split_lines(chunks, max_length=MAX_LINE_BYTES):
+    """Строки из асинхронного потока кусков байт.
+    Вместо строки длиннее max_length выдаётся None — её можно учесть как ошибку"""
+    buffer = bytearray()
+    skipping = False
+    async for chunk in chunks:
+        start = 0
+        while True:
+            end = chunk.find(b'\n', start)
+            if end < 0:
+                break
+            if not skipping and len(buffer) + end - start <= max_length:
+                buffer += chunk[start:end]
+                yield bytes(buffer)
+            elif not skipping:
+                yield None
+            buffer.clear()
+            skipping = False
+            start = end + 1
+        if not skipping:
+            buffer += chunk[start:]
+            if len(buffer) > max_length:
+                buffer.clear()
+                skipping = True
+                yield None
+    if buffer:
+        yield bytes(buffer)
+
+
+def insert_batch(chat_id, rows, preview_length=200):
+    """Операция писателя: дописать пачку в конец чата одной транзакцией.
+
+    Сообщения с уже существующим в этом чате id пропускаются — повторный
+    импорт безопасен. id, занятый сообщением другого чата, — ошибка строки.
+    Импортированное считается прочитанным, сводка чата меняется, только если
+    импорт новее последнего сообщения. Возвращает (вставлено, [строки с конфликтом id])"""
+    def operation(conn):
+        last_seq = conn.execute('SELECT last_seq FROM chats WHERE id = ?', (chat_id,)).fetchone()[0]
+        inserted = 0
+        newest = None
+        conflicts = []
+        for row in rows:
+            cursor = conn.execute('''
+                INSERT OR IGNORE INTO messages
+                    (id, chat_id, sender_id, type, text, file_url, filename, seq, created_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, COALESCE(?, strftime('%Y-%m-%d %H:%M:%f', 'now')))
+            ''', (
+                row['id'], chat_id, row['sender_id'], row['type'], row['text'],
+                row['file_url'], row['filename'], last_seq + 1, row['timestamp']
+            ))
+            if cursor.rowcount:
+                last_seq += 1
+                inserted += 1
+                # Без времени сообщение получает текущее — оно новее любого с временем
+                if newest is None or row['timestamp'] is None or (
+                    newest['timestamp'] is not None and row['timestamp'] >= newest['timestamp']
+                ):
+                    newest = row
+                continue
+            owner = conn.execute('SELECT chat_id FROM messages WHERE id = ?', (row['id'],)).fetchone()
+            if owner is not None and owner[0] != chat_id:
+                conflicts.append(row['line'])
+
+        if newest is not None:
+            conn.execute('UPDATE chats SET last_seq = ? WHERE id = ?', (last_seq, chat_id))
+            # Непрочитанное у участников не меняется
+            conn.execute(
+                'UPDATE chat_participants SET last_read_seq = last_read_seq + ? WHERE chat_id = ?',
+                (inserted, chat_id)
+            )
+            text = newest['text']
+            conn.execute('''
+                INSERT INTO chat_summaries
+                    (chat_id, last_message_id, last_sender_username, last_message_type, last_message_text, last_activity)
+                VALUES (?, ?, ?, ?, ?, COALESCE(?, strftime('%Y-%m-%d %H:%M:%f', 'now')))
+                ON CONFLICT (chat_id) DO UPDATE SET
+                    last_message_id = excluded.last_message_id,
+                    last_sender_username = excluded.last_sender_username,
+                    last_message_type = excluded.last_message_type,
+                    last_message_text = excluded.last_message_text,
+                    last_activity = excluded.last_activity
+                WHERE chat_summaries.last_activity IS NULL
+                   OR julianday(excluded.last_activity) >= julianday(chat_summaries.last_activity)
+            ''', (
+                chat_id, newest['id'], newest['sender_username'], newest['type'],
+                text[:preview_length] if text else None, newest['timestamp']
+            ))
+        return inserted, conflicts
+    return operation
+
+
+async def import_messages(storage, chat_id, lines, batch_size=IMPORT_BATCH_SIZE, on_batch=None):
+    """Импортировать NDJSON-строки из асинхронного итератора в конец чата.
+
+    В памяти держится не больше одной пачки; live-рассылки нет.
+    on_batch(chat_id) вызывается после фиксации каждой пачки.
+    Возвращает ImportReport или None, если чата нет."""
+    if not await storage.fetchone('SELECT id FROM chats WHERE id = ?', (chat_id,)):
+        return None
+
+    report = ImportReport()
+    senders = {}
+    batch = []
+    pending = None
+
+    async def commit(rows):
+        inserted, conflicts = await storage.submit(insert_batch(chat_id, rows))
+        report.imported += inserted
+        report.duplicates += len(rows) - inserted - len(conflicts)
+        for line_number in conflicts:
+            report.error(line_number, 'id belongs to another chat')
+        if on_batch:
+            await on_batch(chat_id)
+
+    async def flush():
+        # Следующая пачка разбирается, пока писатель фиксирует предыдущую;
+        # отправляем строго по очереди, чтобы seq шли в порядке файла
+        nonlocal pending
+        rows = list(batch)
+        batch.clear()
+        if pending is not None:
+            await pending
+        pending = asyncio.ensure_future(commit(rows))
+
+    line_number = 0
+    async for line in lines:
+        line_number += 1
+        if line is None:
+            report.error(line_number, 'line too long')
+            continue
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError:
+            report.error(line_number, 'invalid record')
+            continue
+        try:
+            record = normalize_record(record)
+        except ValueError as e:
+            report.error(line_number, str(e))
+            continue
+        username = record['sender_username']
+
+        if username not in senders:
+            user = await storage.fetchone('SELECT id FROM users WHERE username = ?', (username,))
+            senders[username] = user['id'] if user else None
+        if senders[username] is None:
+            report.error(line_number, f'unknown sender {username}')
+            continue
+
+        record['id'] = record['id'] or generate_id()
+        record['sender_id'] = senders[username]
+        record['line'] = line_number
+        batch.append(record)
+        if len(batch) >= batch_size:
+            await flush()
+
+    if batch:
+        await flush()
+    if pending is not None:
+        await pending
+    return report
+
+
+# === CLI ===
+
+async def read_chunks(path):
+    """Куски файла (или stdin) без загрузки целиком в память"""
+    loop = asyncio.get_running_loop()
+    f = sys.stdin.buffer if path == '-' else open(path, 'rb')
+    try:
+        while True:
+            chunk = await loop.run_in_executor(None, f.read, READ_CHUNK_SIZE)
+            if not chunk:
+                return
+            yield chunk
+    finally:
+        if f is not sys.stdin.buffer:
+            f.close()
+
+
+def read_lines(path, max_length=MAX_LINE_BYTES):
+    """Строки файла с тем же ограничением длины, что и у импорта через API"""
+    return split_lines(read_chunks(path), max_length)
+
+
+async def run_import(args):
+    from storage import Storage, connection_pragmas
+
+    storage = Storage(args.db, readers=1, pragmas=connection_pragmas())
+    await storage.open()
+    try:
+        report = await import_messages(storage, args.chat, read_lines(args.file), args.batch_size)
+    finally:
+        await storage.close()
+    if report is None:
+        logger.error(f"❌ Chat not found: {args.chat}")
+        return 1
+    print(json.dumps(report.to_dict(), ensure_ascii=False, indent=2))
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Messenger history import')
+    commands = parser.add_subparsers(dest='command', required=True)
+    importer = commands.add_parser('import', help='append NDJSON messages to a chat')
+    importer.add_argument('file', help="NDJSON file, '-' for stdin")
+    importer.add_argument('--db', default='messenger.db')
+    importer.add_argument('--chat', required=True)
+    importer.add_argument('--batch-size', type=int, default=IMPORT_BATCH_SIZE)
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    return asyncio.run(run_import(args))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,209 @@
+import asyncio
+import logging
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from metrics import registry as metrics
+
+logger = logging.getLogger(__name__)
+
+# Границы гистограммы размера пакета
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024)
+
+DB_WRITE_SECONDS = metrics.histogram(
+    'messenger_db_write_seconds', 'SQLite write operation duration inside the batch transaction'
+)
+DB_WRITE_LATENCY_SECONDS = metrics.histogram(
+    'messenger_db_write_latency_seconds', 'Time from submitting a write to its durable commit'
+)
+DB_COMMIT_SECONDS = metrics.histogram(
+    'messenger_db_commit_seconds', 'Group commit duration per batch'
+)
+DB_BATCH_SIZE = metrics.histogram(
+    'messenger_db_batch_size', 'Write operations per group commit', buckets=BATCH_SIZE_BUCKETS
+)
+DB_WRITE_FAILURES = metrics.counter(
+    'messenger_db_write_failures_total', 'Write operations that raised and were rolled back'
+)
+
+
+class GroupCommitWriter:
+    """Единственный писатель в БД: операции копятся в очереди и
+    фиксируются группой — одна транзакция и один fsync на пакет"""
+
+    def __init__(self, path, max_batch=256, window=0.002, pragmas=()):
+        self.path = path
+        self.pragmas = list(pragmas)
+        self.max_batch = max_batch
+        self.window = window
+        self._queue = asyncio.Queue()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='db-writer')
+        self._conn = None
+        self._task = None
+        # Метрики
+        self._batches = 0
+        self._operations = 0
+        self._failures = 0
+        self._size_buckets = [0] * (len(BATCH_SIZE_BUCKETS) + 1)
+        self._max_batch_seen = 0
+        self._commit_seconds_total = 0.0
+        self._commit_seconds_max = 0.0
+        self._commit_seconds_last = 0.0
+
+    async def start(self):
+        loop = asyncio.get_running_loop()
+        self._conn = await loop.run_in_executor(self._executor, self._connect)
+        self._task = asyncio.create_task(self._run())
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False, timeout=30)
+        conn.row_factory = sqlite3.Row
+        for pragma in self.pragmas:
+            conn.execute(pragma)
+        return conn
+
+    async def close(self):
+        if self._task:
+            # Дописываем то, что уже стоит в очереди
+            await self._queue.join()
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._conn:
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(self._executor, self._conn.close)
+            self._conn = None
+        self._executor.shutdown(wait=False)
+
+    # === API ===
+
+    async def submit(self, operation):
+        """Выполнить operation(conn) в пакете; результат — после фиксации пакета.
+        Пакет переживает отключение питания только при synchronous = FULL"""
+        future = asyncio.get_running_loop().create_future()
+        started = time.perf_counter()
+        self._queue.put_nowait((operation, future))
+        try:
+            return await future
+        finally:
+            DB_WRITE_LATENCY_SECONDS.observe(time.perf_counter() - started)
+
+    async def execute(self, sql, params=()):
+        return await self.submit(lambda conn: conn.execute(sql, params).rowcount)
+
+    async def executemany(self, statements):
+        """Несколько выражений одной атомарной операцией"""
+        def operation(conn):
+            for sql, params in statements:
+                conn.execute(sql, params)
+        return await self.submit(operation)
+
+    def queue_depth(self):
+        return self._queue.qsize()
+
+    # === ПАКЕТНАЯ ФИКСАЦИЯ ===
+
+    async def _collect(self):
+        batch = [await self._queue.get()]
+        deadline = time.monotonic() + self.window
+        while len(batch) < self.max_batch:
+            if not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+                continue
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._collect()
+            operations = [op for op, _ in batch]
+            started = time.perf_counter()
+            try:
+                results = await loop.run_in_executor(self._executor, self._commit_batch, operations)
+            except Exception as e:
+                logger.error(f"❌ Batch commit failed: {e}")
+                results = [(False, e)] * len(batch)
+            else:
+                self._record(len(batch), time.perf_counter() - started)
+
+            for (_, future), (ok, value) in zip(batch, results):
+                self._queue.task_done()
+                if future.done():
+                    continue
+                if ok:
+                    future.set_result(value)
+                else:
+                    self._failures += 1
+                    DB_WRITE_FAILURES.inc()
+                    future.set_exception(value)
+
+    def _commit_batch(self, operations):
+        """Выполняется в потоке писателя; ошибка одной операции
+        откатывает только её точку сохранения"""
+        conn = self._conn
+        results = []
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            for operation in operations:
+                started = time.perf_counter()
+                conn.execute('SAVEPOINT op')
+                try:
+                    results.append((True, operation(conn)))
+                except Exception as e:
+                    conn.execute('ROLLBACK TO op')
+                    results.append((False, e))
+                conn.execute('RELEASE op')
+                DB_WRITE_SECONDS.observe(time.perf_counter() - started)
+            conn.execute('COMMIT')
+        except Exception:
+            if conn.in_transaction:
+                conn.execute('ROLLBACK')
+            raise
+        return results
+
+    # === МЕТРИКИ ===
+
+    def _record(self, size, seconds):
+        DB_BATCH_SIZE.observe(size)
+        DB_COMMIT_SECONDS.observe(seconds)
+        self._batches += 1
+        self._operations += size
+        self._max_batch_seen = max(self._max_batch_seen, size)
+        self._commit_seconds_total += seconds
+        self._commit_seconds_max = max(self._commit_seconds_max, seconds)
+        self._commit_seconds_last = seconds
+        for i, bound in enumerate(BATCH_SIZE_BUCKETS):
+            if size <= bound:
+                self._size_buckets[i] += 1
+                break
+        else:
+            self._size_buckets[-1] += 1
+
+    def stats(self):
+        batches = self._batches or 1
+        return {
+            'batches': self._batches,
+            'operations': self._operations,
+            'failures': self._failures,
+            'queue_depth': self._queue.qsize(),
+            'batch_size_avg': round(self._operations / batches, 2),
+            'batch_size_max': self._max_batch_seen,
+            'batch_size_buckets': dict(zip(
+                [str(bound) for bound in BATCH_SIZE_BUCKETS] + ['+Inf'],
+                self._size_buckets
+            )),
+            'commit_ms_avg': round(self._commit_seconds_total / batches * 1000, 3),
+            'commit_ms_max': round(self._commit_seconds_max * 1000, 3),
+            'commit_ms_last': round(self._commit_seconds_last * 1000, 3),
+        }
@@ -1,5 +1,6 @@
 // === КОНФИГУРАЦИЯ ===
-const API_URL = 'http://localhost:5000';
+// Фронтенд отдаёт тот же сервер, что и API: запросы идут на свой origin
+const API_URL = '';
 let ws = null;
 
 // === ДАННЫЕ ===
@@ -8,6 +9,47 @@ let currentChat = null;
 let allUsers = [];
 let userChats = [];
 
+// === СПИСОК ПОЛЬЗОВАТЕЛЕЙ ===
+// Список грузится страницами; поиск идёт через автодополнение на сервере
+const USERS_PAGE_SIZE = 50;
+const AUTOCOMPLETE_DELAY_MS = 150;
+let usersCursor = null;
+let usersHasMore = false;
+
+// === ИСТОРИЯ СООБЩЕНИЙ ===
+const HISTORY_PAGE_SIZE = 50;
+let historyCursor = null;
+let historyHasMore = false;
+let historyLoading = false;
+
+// === ПРОТОКОЛ WEBSOCKET ===
+// Сервер склеивает события в пачки; compact — ещё и короткие ключи
+const WS_PROTOCOLS = ['messenger.v2.compact', 'messenger.v2'];
+// Сервер закрывает сокет этим кодом, если сессия истекла
+const WS_SESSION_EXPIRED = 4001;
+const COMPACT_KEYS = {
+    t: 'type', d: 'data', i: 'id', c: 'chat_id', s: 'seq', su: 'sender_username',
+    x: 'text', f: 'file_url', fn: 'filename', ts: 'timestamp', un: 'username',
+    st: 'status', it: 'is_typing', m: 'messages', ls: 'last_seq'
+};
+
+// === СИНХРОНИЗАЦИЯ ===
+// chat_id -> seq последнего сообщения, которое клиент уже видел
+let chatCursors = {};
+let wsWasConnected = false;
+
+// === ИНДИКАТОР ПЕЧАТИ ===
+const TYPING_SEND_INTERVAL = 2000;
+const TYPING_IDLE_TIMEOUT = 3000;
+let lastTypingSentAt = 0;
+let typingIdleTimer = null;
+
+// === ЗАГРУЗКА ФАЙЛОВ ===
+const UPLOAD_MAX_RETRIES = 5;
+// SubtleCrypto не умеет хешировать потоком — файлы крупнее читаются в память только при загрузке
+const UPLOAD_HASH_MAX_SIZE = 64 * 1024 * 1024;
+let pendingFileType = 'image';
+
 // === ИНИЦИАЛИЗАЦИЯ ===
 document.addEventListener('DOMContentLoaded', async () => {
     initializeEventListeners();
@@ -29,6 +71,7 @@ function initializeEventListeners() {
     document.getElementById('messageInput').addEventListener('keydown', handleMessageInput);
     document.getElementById('sendBtn').addEventListener('click', sendMessage);
     document.getElementById('attachBtn').addEventListener('click', openFileModal);
+    document.getElementById('messagesContainer').addEventListener('scroll', handleMessagesScroll);
     
     document.querySelectorAll('.close-btn').forEach(btn => {
         btn.addEventListener('click', (e) => {
@@ -37,6 +80,18 @@ function initializeEventListeners() {
     });
 }
 
+// === API ===
+
+// Запрос к API; по сессии в заголовке сервер считает лимиты на пользователя, а не на IP
+function apiFetch(path, options = {}) {
+    const headers = { ...(options.headers || {}) };
+    const sessionId = localStorage.getItem('sessionId');
+    if (sessionId) {
+        headers['X-Session-Id'] = sessionId;
+    }
+    return fetch(`${API_URL}${path}`, { ...options, headers });
+}
+
 // === АВТОРИЗАЦИЯ ===
 
 async function handleLogin(e) {
@@ -51,7 +106,7 @@ async function handleLogin(e) {
     }
     
     try {
-        const response = await fetch(`${API_URL}/api/users/login`, {
+        const response = await apiFetch(`/api/users/login`, {
             method: 'POST',
             headers: { 'Content-Type': 'application/json' },
             body: JSON.stringify({ username, password })
@@ -103,7 +158,7 @@ async function handleRegister(e) {
     }
     
     try {
-        const response = await fetch(`${API_URL}/api/users/register`, {
+        const response = await apiFetch(`/api/users/register`, {
             method: 'POST',
             headers: { 'Content-Type': 'application/json' },
             body: JSON.stringify({ username, email, password })
@@ -158,9 +213,9 @@ function switchTab(tabName, btn) {
 async function connectWebSocket(sessionId) {
     return new Promise((resolve) => {
         const protocol = window.location.protocol === 'https:' ? 'wss:' : 'ws:';
-        const wsUrl = `${protocol}//${window.location.hostname}:5000/ws/${sessionId}`;
+        const wsUrl = `${protocol}//${window.location.host}/ws/${sessionId}`;
         
-        ws = new WebSocket(wsUrl);
+        ws = new WebSocket(wsUrl, WS_PROTOCOLS);
         
         ws.onopen = () => {
             console.log('✅ WebSocket подключен');
@@ -174,12 +229,28 @@ async function connectWebSocket(sessionId) {
                 }));
             }
             
+            // После переподключения догружаем только пропущенное
+            if (wsWasConnected) {
+                ws.send(JSON.stringify({
+                    type: 'sync',
+                    cursors: chatCursors
+                }));
+            }
+            wsWasConnected = true;
+            
             resolve();
         };
         
         ws.onmessage = (event) => {
-            const message = JSON.parse(event.data);
-            handleWebSocketMessage(message);
+            let message = JSON.parse(event.data);
+            if (event.target.protocol === 'messenger.v2.compact') {
+                message = expandKeys(message);
+            }
+            if (message.type === 'batch') {
+                message.data.forEach(handleWebSocketMessage);
+            } else {
+                handleWebSocketMessage(message);
+            }
         };
         
         ws.onerror = (error) => {
@@ -187,7 +258,14 @@ async function connectWebSocket(sessionId) {
             updateConnectionStatus(false);
         };
         
-        ws.onclose = () => {
+        ws.onclose = (event) => {
+            if (event.code === WS_SESSION_EXPIRED) {
+                // Переподключение не поможет — нужен повторный вход
+                localStorage.removeItem('user');
+                localStorage.removeItem('sessionId');
+                location.reload();
+                return;
+            }
             console.log('⚠️ WebSocket отключен. Переподключение...');
             updateConnectionStatus(false);
             setTimeout(() => connectWebSocket(sessionId), 3000);
@@ -195,14 +273,47 @@ async function connectWebSocket(sessionId) {
     });
 }
 
+function expandKeys(value) {
+    if (Array.isArray(value)) {
+        return value.map(expandKeys);
+    }
+    if (value && typeof value === 'object') {
+        const result = {};
+        for (const [key, item] of Object.entries(value)) {
+            result[COMPACT_KEYS[key] || key] = expandKeys(item);
+        }
+        return result;
+    }
+    return value;
+}
+
 function handleWebSocketMessage(message) {
     const { type, data } = message;
     
-    if (type === 'new_message' && currentChat && data.chat_id === currentChat.id) {
-        displayMessage(data);
+    if (type === 'new_message') {
+        receiveMessage(data);
+    } else if (type === 'sync') {
+        data.messages.forEach(msg => receiveMessage(msg));
+    } else if (type === 'resync_required') {
+        // Разрыв слишком велик: перечитываем чат и список целиком
+        chatCursors[data.chat_id] = data.last_seq;
+        if (currentChat?.id === data.chat_id) {
+            openChat(currentChat);
+        }
+        loadChats();
+    } else if (type === 'sync_complete') {
+        console.log('✅ Синхронизация завершена');
+    } else if (type === 'rate_limited') {
+        console.warn(`⚠️ Слишком часто: ${data.type}, повтор через ${data.retry_after} с`);
+        if (data.type === 'send_message') {
+            alert('Вы отправляете сообщения слишком часто. Подождите немного.');
+        }
+    } else if (type === 'read_receipt') {
+        applyReadReceipt(data);
     } else if (type === 'user_joined') {
         console.log(`✅ ${data.username} присоединился к чату`);
     } else if (type === 'user_typing') {
+        if (data.chat_id && data.chat_id !== currentChat?.id) return;
         if (data.is_typing && data.username !== currentUser.username) {
             document.getElementById('typingIndicator').classList.remove('typing-hidden');
             document.getElementById('typingIndicator').textContent = `${data.username} печатает...`;
@@ -212,6 +323,54 @@ function handleWebSocketMessage(message) {
     }
 }
 
+function advanceCursor(message) {
+    /** Сдвинуть курсор чата; false — сообщение уже было получено */
+    if (message.seq === undefined) return true;
+    const cursor = chatCursors[message.chat_id] || 0;
+    if (message.seq <= cursor) return false;
+    chatCursors[message.chat_id] = message.seq;
+    return true;
+}
+
+function receiveMessage(message) {
+    if (!advanceCursor(message)) return;
+    updateChatSummary(message);
+    if (currentChat && message.chat_id === currentChat.id) {
+        displayMessage(message);
+    }
+}
+
+// === ОТМЕТКИ О ПРОЧТЕНИИ ===
+
+function applyReadReceipt(data) {
+    const chat = userChats.find(c => c.id === data.chat_id);
+    if (!chat) return;
+    
+    data.readers.forEach(({ username, seq }) => {
+        if (username === currentUser.username) {
+            // Прочитано с другого устройства
+            chat.last_read_seq = Math.max(chat.last_read_seq || 0, seq);
+            chat.unread_count = Math.max(0, (chatCursors[chat.id] || 0) - chat.last_read_seq);
+        } else {
+            chat.peer_read_seq = Math.max(chat.peer_read_seq || 0, seq);
+        }
+    });
+    
+    renderChatsList();
+    if (currentChat?.id === chat.id) {
+        updateReadMarks(chat);
+    }
+}
+
+function updateReadMarks(chat) {
+    const readSeq = chat.peer_read_seq || 0;
+    document.querySelectorAll('#messagesContainer .message.sent:not(.read)').forEach(el => {
+        if (Number(el.dataset.seq) <= readSeq) {
+            el.classList.add('read');
+        }
+    });
+}
+
 // === ОБНОВЛЕНИЕ СТАТУСА СОЕДИНЕНИЯ ===
 
 function updateConnectionStatus(isConnected) {
@@ -239,9 +398,14 @@ function updateConnectionStatus(isConnected) {
 
 async function loadChats() {
     try {
-        const response = await fetch(`${API_URL}/api/chats/${currentUser.username}`);
+        const response = await apiFetch(`/api/chats/${currentUser.username}`);
         if (response.ok) {
             userChats = await response.json();
+            userChats.forEach(chat => {
+                if (!(chat.id in chatCursors)) {
+                    chatCursors[chat.id] = chat.last_seq || 0;
+                }
+            });
             renderChatsList();
         }
     } catch (error) {
@@ -250,15 +414,54 @@ async function loadChats() {
 }
 
 async function loadAllUsers() {
+    allUsers = [];
+    usersCursor = null;
+    usersHasMore = false;
+    return loadMoreUsers();
+}
+
+async function loadMoreUsers() {
+    /** Следующая страница пользователей; возвращает только что загруженных */
+    const params = new URLSearchParams({ limit: USERS_PAGE_SIZE });
+    if (usersCursor) {
+        params.set('after', usersCursor);
+    }
     try {
-        const response = await fetch(`${API_URL}/api/users`);
+        const response = await apiFetch(`/api/users?${params}`);
         if (response.ok) {
-            allUsers = await response.json();
-            allUsers = allUsers.filter(u => u.username !== currentUser.username);
+            const page = await response.json();
+            usersCursor = page.next;
+            usersHasMore = page.has_more;
+            return rememberUsers(page.users);
         }
     } catch (error) {
         console.error('❌ Load users error:', error);
     }
+    return [];
+}
+
+function rememberUsers(users) {
+    /** Добавить в allUsers тех, кого там ещё нет (кроме себя) */
+    const fresh = users.filter(u =>
+        u.username !== currentUser.username && !allUsers.some(known => known.username === u.username)
+    );
+    allUsers.push(...fresh);
+    return fresh;
+}
+
+async function autocompleteUsers(query) {
+    try {
+        const params = new URLSearchParams({ q: query });
+        const response = await apiFetch(`/api/autocomplete/users?${params}`);
+        if (response.ok) {
+            const data = await response.json();
+            rememberUsers(data.users);
+            return data.users.filter(u => u.username !== currentUser.username);
+        }
+    } catch (error) {
+        console.error('❌ Autocomplete error:', error);
+    }
+    return [];
 }
 
 // === РЕНДЕРИНГ ЧАТОВ ===
@@ -282,17 +485,76 @@ function createChatItem(chat) {
         ? chat.participants.find(p => p !== currentUser.username) 
         : chat.name;
     
+    const preview = chat.last_message
+        ? `${chat.last_message.sender_username}: ${escapeHtml(chat.last_message.text || chat.last_message.type)}`
+        : (chat.type === 'group' ? '👥 Группа' : '👤 Приватный');
+    const time = chat.last_activity
+        ? new Date(chat.last_activity).toLocaleTimeString('ru-RU', { hour: '2-digit', minute: '2-digit' })
+        : 'Сейчас';
+    const unread = chat.unread_count > 0 ? `<span class="unread">${chat.unread_count}</span>` : '';
+    
     div.innerHTML = `
         <img src="${chat.avatar}" class="avatar" alt="">
         <div class="info">
             <span class="name">${chatName}</span>
-            <span class="preview">${chat.type === 'group' ? '👥 Группа' : '👤 Приватный'}</span>
+            <span class="preview">${preview}</span>
         </div>
-        <span class="time">Сейчас</span>
+        <span class="time">${time}</span>
+        ${unread}
     `;
     return div;
 }
 
+function updateChatSummary(message) {
+    const index = userChats.findIndex(c => c.id === message.chat_id);
+    if (index === -1) return;
+    
+    const chat = userChats[index];
+    chat.last_message = {
+        id: message.id,
+        sender_username: message.sender_username,
+        type: message.type,
+        text: message.text
+    };
+    chat.last_activity = message.timestamp;
+    
+    const isOpen = currentChat?.id === chat.id;
+    if (!isOpen && message.sender_username !== currentUser.username) {
+        chat.unread_count = (chat.unread_count || 0) + 1;
+    }
+    
+    // Поднимаем чат наверх списка
+    userChats.splice(index, 1);
+    userChats.unshift(chat);
+    renderChatsList();
+    
+    if (isOpen) {
+        markChatRead(chat);
+    }
+}
+
+async function markChatRead(chat) {
+    chat.unread_count = 0;
+    const seq = chatCursors[chat.id] || 0;
+    if (seq <= (chat.last_read_seq || 0)) return;
+    chat.last_read_seq = seq;
+    
+    // Сервер копит отметки и пишет их пачкой — слать можно на каждое сообщение
+    if (ws && ws.readyState === WebSocket.OPEN) {
+        ws.send(JSON.stringify({ type: 'mark_read', chat_id: chat.id, seq }));
+        return;
+    }
+    try {
+        await apiFetch(`/api/chats/${chat.id}/read`, {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({ username: currentUser.username, seq })
+        });
+    } catch (error) {
+        console.error('❌ Mark read error:', error);
+    }
+}
+
 // === ОТКРЫТИЕ ЧАТА ===
 
 async function openChat(chat) {
@@ -315,12 +577,16 @@ async function openChat(chat) {
     }
     
     document.getElementById('messagesContainer').innerHTML = '';
+    historyCursor = null;
+    historyHasMore = false;
     
     try {
-        const response = await fetch(`${API_URL}/api/messages/${chat.id}`);
-        if (response.ok) {
-            const messages = await response.json();
-            messages.forEach(msg => displayMessage(msg));
+        const page = await fetchMessagesPage(chat.id, null);
+        if (page && currentChat?.id === chat.id) {
+            page.messages.forEach(msg => displayMessage(msg));
+            page.messages.forEach(msg => advanceCursor(msg));
+            historyCursor = page.before;
+            historyHasMore = page.has_more;
         }
     } catch (error) {
         console.error('❌ Load messages error:', error);
@@ -334,15 +600,94 @@ async function openChat(chat) {
         }));
     }
     
+    if (chat.unread_count > 0) {
+        markChatRead(chat);
+    }
+    
     renderChatsList();
 }
 
+// === ПОСТРАНИЧНАЯ ИСТОРИЯ ===
+
+async function fetchMessagesPage(chatId, before) {
+    const params = new URLSearchParams({ limit: HISTORY_PAGE_SIZE });
+    if (before) {
+        params.set('before', before);
+    }
+    
+    const response = await apiFetch(`/api/messages/${chatId}?${params}`);
+    return response.ok ? await response.json() : null;
+}
+
+async function handleMessagesScroll(e) {
+    const container = e.target;
+    if (container.scrollTop > 50 || !currentChat || !historyHasMore || historyLoading) return;
+    
+    const chatId = currentChat.id;
+    historyLoading = true;
+    
+    try {
+        const page = await fetchMessagesPage(chatId, historyCursor);
+        if (!page || currentChat?.id !== chatId) return;
+        
+        // Сохраняем позицию прокрутки при добавлении сообщений сверху
+        const previousHeight = container.scrollHeight;
+        const firstMessage = container.querySelector('.message');
+        page.messages.forEach(msg => {
+            container.insertBefore(createMessageElement(msg), firstMessage);
+        });
+        container.scrollTop += container.scrollHeight - previousHeight;
+        
+        historyCursor = page.before;
+        historyHasMore = page.has_more;
+    } catch (error) {
+        console.error('❌ Load older messages error:', error);
+    } finally {
+        historyLoading = false;
+    }
+}
+
 // === ОТПРАВКА СООБЩЕНИЙ ===
 
 function handleMessageInput(e) {
     if (e.key === 'Enter' && !e.shiftKey) {
         e.preventDefault();
         sendMessage();
+    } else {
+        notifyTyping();
+    }
+}
+
+function notifyTyping() {
+    if (!currentChat || !ws || ws.readyState !== WebSocket.OPEN) return;
+    
+    // Не чаще одного typing за интервал — сервер троттлит так же
+    const now = Date.now();
+    if (now - lastTypingSentAt >= TYPING_SEND_INTERVAL) {
+        lastTypingSentAt = now;
+        ws.send(JSON.stringify({
+            type: 'typing',
+            username: currentUser.username,
+            chat_id: currentChat.id
+        }));
+    }
+    
+    clearTimeout(typingIdleTimer);
+    const chatId = currentChat.id;
+    typingIdleTimer = setTimeout(() => stopTyping(chatId), TYPING_IDLE_TIMEOUT);
+}
+
+function stopTyping(chatId) {
+    clearTimeout(typingIdleTimer);
+    if (!lastTypingSentAt) return;
+    lastTypingSentAt = 0;
+    
+    if (ws && ws.readyState === WebSocket.OPEN) {
+        ws.send(JSON.stringify({
+            type: 'stop_typing',
+            username: currentUser.username,
+            chat_id: chatId
+        }));
     }
 }
 
@@ -351,6 +696,10 @@ async function sendMessage() {
     
     if (!text || !currentChat) return;
     
+    // Сервер сам гасит индикатор при отправке сообщения
+    clearTimeout(typingIdleTimer);
+    lastTypingSentAt = 0;
+    
     const message = {
         type: 'send_message',
         sender_username: currentUser.username,
@@ -364,7 +713,7 @@ async function sendMessage() {
     }
     
     try {
-        await fetch(`${API_URL}/api/messages/${currentChat.id}`, {
+        await apiFetch(`/api/messages/${currentChat.id}`, {
             method: 'POST',
             headers: { 'Content-Type': 'application/json' },
             body: JSON.stringify({
@@ -390,8 +739,20 @@ function displayMessage(message) {
         emptyState.remove();
     }
     
+    container.appendChild(createMessageElement(message));
+    container.scrollTop = container.scrollHeight;
+}
+
+function createMessageElement(message) {
     const div = document.createElement('div');
     div.className = 'message ' + (message.sender_username === currentUser.username ?  'sent' : 'received');
+    if (message.seq !== undefined) {
+        div.dataset.seq = message.seq;
+        const chat = userChats.find(c => c.id === message.chat_id);
+        if (chat && message.seq <= (chat.peer_read_seq || 0)) {
+            div.classList.add('read');
+        }
+    }
     
     let content = '';
     switch (message.type) {
@@ -399,13 +760,13 @@ function displayMessage(message) {
             content = `<div class="message-text">${escapeHtml(message.text)}</div>`;
             break;
         case 'image':
-            content = `<img src="${message.file_url}" class="message-image" alt="">`;
+            content = `<img src="${mediaUrl(message.file_url)}" class="message-image" alt="">`;
             break;
         case 'video':
-            content = `<video controls class="message-video"><source src="${message.file_url}"></video>`;
+            content = `<video controls class="message-video"><source src="${mediaUrl(message.file_url)}"></video>`;
             break;
         case 'audio':
-            content = `<audio controls class="message-audio"><source src="${message.file_url}"></audio>`;
+            content = `<audio controls class="message-audio"><source src="${mediaUrl(message.file_url)}"></audio>`;
             break;
     }
     
@@ -421,8 +782,7 @@ function displayMessage(message) {
         </div>
     `;
     
-    container.appendChild(div);
-    container.scrollTop = container.scrollHeight;
+    return div;
 }
 
 // === МОДАЛЬНЫЕ ОКНА ===
@@ -448,30 +808,50 @@ function renderUsersList() {
     
     const grid = usersList.querySelector('#privateUsersGrid');
     
-    allUsers.forEach(user => {
-        const card = createUserCard(user);
-        card.addEventListener('click', () => {
-            createPrivateChat(user);
-            document.getElementById('newChatModal').classList.add('modal-hidden');
+    const renderGrid = (users) => {
+        grid.innerHTML = '';
+        users.forEach(user => {
+            const card = createUserCard(user);
+            card.addEventListener('click', () => {
+                createPrivateChat(user);
+                document.getElementById('newChatModal').classList.add('modal-hidden');
+            });
+            grid.appendChild(card);
         });
-        grid.appendChild(card);
-    });
+    };
+    renderGrid(allUsers);
     
+    // Поиск по префиксу username на сервере, с задержкой между нажатиями
+    let searchTimer = null;
+    let searchQuery = '';
     usersList.querySelector('#privateUserSearch').addEventListener('input', (e) => {
-        const query = e.target.value.toLowerCase();
-        const cards = grid.querySelectorAll('.user-card');
-        cards.forEach(card => {
-            const username = card.querySelector('.name').textContent.toLowerCase();
-            card.style.display = username.includes(query) ? '' : 'none';
-        });
+        clearTimeout(searchTimer);
+        searchQuery = e.target.value.trim();
+        if (!searchQuery) {
+            renderGrid(allUsers);
+            return;
+        }
+        searchTimer = setTimeout(async () => {
+            const query = searchQuery;
+            const users = await autocompleteUsers(query);
+            if (query === searchQuery) {
+                renderGrid(users);
+            }
+        }, AUTOCOMPLETE_DELAY_MS);
     });
 }
 
 function renderGroupUsersList() {
     const usersList = document.getElementById('groupUsersList');
     usersList.innerHTML = '';
+    appendGroupUserCards(allUsers);
+}
+
+function appendGroupUserCards(users) {
+    const usersList = document.getElementById('groupUsersList');
+    usersList.querySelector('.load-more-users')?.remove();
     
-    allUsers.forEach(user => {
+    users.forEach(user => {
         const card = createUserCard(user);
         card.dataset.username = user.username;
         card.addEventListener('click', (e) => {
@@ -480,6 +860,19 @@ function renderGroupUsersList() {
         });
         usersList.appendChild(card);
     });
+    
+    // Карточки дописываются, а не перерисовываются — выбор сохраняется
+    if (usersHasMore) {
+        const more = document.createElement('button');
+        more.type = 'button';
+        more.className = 'load-more-users';
+        more.textContent = 'Показать ещё';
+        more.addEventListener('click', async () => {
+            more.disabled = true;
+            appendGroupUserCards(await loadMoreUsers());
+        });
+        usersList.appendChild(more);
+    }
 }
 
 function createUserCard(user) {
@@ -519,7 +912,7 @@ function updateSelectedUsers() {
 
 async function createPrivateChat(user) {
     try {
-        const response = await fetch(`${API_URL}/api/chats/create`, {
+        const response = await apiFetch(`/api/chats/create`, {
             method: 'POST',
             headers: { 'Content-Type': 'application/json' },
             body: JSON.stringify({
@@ -531,7 +924,7 @@ async function createPrivateChat(user) {
         
         if (response.ok) {
             const data = await response.json();
-            userChats.push(data.chat);
+            userChats.unshift(data.chat);
             renderChatsList();
             await openChat(data.chat);
         } else {
@@ -559,7 +952,7 @@ async function createGroup() {
     });
     
     try {
-        const response = await fetch(`${API_URL}/api/chats/create`, {
+        const response = await apiFetch(`/api/chats/create`, {
             method: 'POST',
             headers: { 'Content-Type': 'application/json' },
             body: JSON.stringify({
@@ -571,7 +964,7 @@ async function createGroup() {
         
         if (response.ok) {
             const data = await response.json();
-            userChats.push(data.chat);
+            userChats.unshift(data.chat);
             renderChatsList();
             await openChat(data.chat);
             document.getElementById('newChatModal').classList.add('modal-hidden');
@@ -606,10 +999,112 @@ function openFileModal() {
 
 document.querySelectorAll('.file-type-btn').forEach(btn => {
     btn.addEventListener('click', () => {
+        pendingFileType = btn.dataset.type === 'sticker' ? 'image' : btn.dataset.type;
         document.getElementById('fileInput').click();
     });
 });
 
+document.getElementById('fileInput').addEventListener('change', handleFileSelected);
+
+function mediaUrl(url) {
+    // Файлы, загруженные на наш сервер, приходят относительным путём
+    return url && url.startsWith('/') ? `${API_URL}${url}` : url;
+}
+
+async function handleFileSelected(e) {
+    const file = e.target.files[0];
+    e.target.value = '';
+    if (!file || !currentChat) return;
+    
+    const chat = currentChat;
+    document.getElementById('fileModal').classList.add('modal-hidden');
+    
+    try {
+        const media = await uploadFile(file);
+        await apiFetch(`/api/messages/${chat.id}`, {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({
+                sender_username: currentUser.username,
+                type: pendingFileType,
+                file_url: media.file_url,
+                filename: file.name
+            })
+        });
+    } catch (error) {
+        console.error('❌ Upload error:', error);
+        alert('Не удалось загрузить файл');
+    }
+}
+
+async function fileDigest(file) {
+    // Хеш нужен серверу, чтобы не принимать уже известный файл повторно
+    if (!window.crypto || !window.crypto.subtle || file.size > UPLOAD_HASH_MAX_SIZE) return null;
+    try {
+        const digest = await crypto.subtle.digest('SHA-256', await file.arrayBuffer());
+        return Array.from(new Uint8Array(digest), b => b.toString(16).padStart(2, '0')).join('');
+    } catch (error) {
+        return null;
+    }
+}
+
+async function uploadFile(file) {
+    const sha256 = await fileDigest(file);
+    const response = await apiFetch(`/api/uploads`, {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        body: JSON.stringify({
+            username: currentUser.username,
+            filename: file.name,
+            size: file.size,
+            mime: file.type,
+            sha256
+        })
+    });
+    const upload = await response.json();
+    if (!response.ok) throw new Error(upload.error);
+    if (upload.complete) return upload;
+    
+    const url = `/api/uploads/${upload.upload_id}`;
+    let offset = 0;
+    let retries = 0;
+    
+    while (true) {
+        const chunk = file.slice(offset, offset + upload.chunk_size);
+        try {
+            const response = await apiFetch(url, {
+                method: 'PUT',
+                headers: { 'Upload-Offset': String(offset) },
+                body: chunk
+            });
+            const data = await response.json();
+            
+            if (response.status === 409 && data.offset !== undefined) {
+                offset = data.offset;
+                continue;
+            }
+            if (!response.ok) {
+                const error = new Error(data.error);
+                // Отказ сервера (например, не совпал sha256) повтором не исправить
+                error.final = response.status < 500 && response.status !== 429;
+                throw error;
+            }
+            if (data.complete) return data;
+            
+            offset = data.offset;
+            retries = 0;
+        } catch (error) {
+            // Обрыв сети: узнаём, сколько сервер успел принять, и продолжаем
+            if (error.final || ++retries > UPLOAD_MAX_RETRIES) throw error;
+            await new Promise(resolve => setTimeout(resolve, 1000 * retries));
+            const status = await apiFetch(url).then(r => r.json()).catch(() => null);
+            if (status && status.offset !== undefined) {
+                offset = status.offset;
+            }
+        }
+    }
+}
+
 // === УТИЛИТЫ ===
 
 function escapeHtml(text) {